@@ -1,15 +1,20 @@
-import shutil, threading, tempfile, re
+import itertools, threading, tempfile, re, time
 from concurrent.futures import ThreadPoolExecutor
 
 import execnet
 
 from tornado.concurrent import run_on_executor
 
+from rclient import staging
+from rclient.metrics import REGISTRY, ExecutorMetrics
+
 # todo: make abstract base class for these things
 # todo: call Group.terminate explicitly to close the gateways out?
 
 DEFAULT_TIMEOUT = 10
 
+_pool_names = ('execnet{}'.format(i) for i in itertools.count(1))
+
 
 def _exception_handler(message):
     """ todo """
@@ -38,9 +43,13 @@ class ExecnetTornado:
 
         ioLoop.add_callback(main)
 
+        Queue depth, queue wait, call and gateway start times are recorded in rclient.metrics.REGISTRY, labelled with
+        name.
+
     """
 
-    def __init__(self, max_workers=None, initializer="", support_files=None, python="python3", *args, **kwargs):
+    def __init__(self, max_workers=None, initializer="", support_files=None, python="python3", *args, name=None,
+                 metrics=None, **kwargs):
         self._t_local = threading.local()
         self._pool = ThreadPoolExecutor(max_workers=max_workers)
 
@@ -50,9 +59,32 @@ class ExecnetTornado:
         self._r_conn_args = args
         self._r_conn_kwargs = kwargs
         self._python = python
+        self.name = name or next(_pool_names)
+        self._metrics = ExecutorMetrics('ExecnetTornado', self.name, REGISTRY if metrics is None else metrics)
+
+    def shutdown(self, wait=True):
+        """ stop taking calls and drop the executor's metrics
+
+            :param wait: wait for the calls already submitted to finish
+        """
+        self._pool.shutdown(wait=wait)
+        self._metrics.remove()
 
-    @run_on_executor(executor='_pool')
     def call_function(self, function, *args, **kwargs):
+        return self._call_function(function, args, kwargs, self._metrics.enqueued())
+
+    @run_on_executor(executor='_pool')
+    def _call_function(self, function, args, kwargs, queued):
+        start = self._metrics.started(queued)
+        try:
+            return self._call(function, args, kwargs)
+        except BaseException:
+            self._metrics.failed.inc()
+            raise
+        finally:
+            self._metrics.run_time.observe(time.monotonic() - start)
+
+    def _call(self, function, args, kwargs):
         print("calling", function, "on", threading.current_thread().ident, "with", args)
         try:
             self._t_local.channel.send((function, args, kwargs))
@@ -69,10 +101,13 @@ class ExecnetTornado:
 
     def _connect_and_init(self):
         """ These need to be called inside a worker thread, as they rely on thread local storage """
+        start = time.monotonic()
         self._initialize_gateway()
         self._prepare_support_files()
         self._prepare_initializer()
         self._start_channel_responder()
+        self._metrics.reconnects.inc()
+        self._metrics.connect.observe(time.monotonic() - start)
 
     @staticmethod
     def _upload(file, dest_dir):
@@ -80,7 +115,7 @@ class ExecnetTornado:
             todo: maybe we can do this with execnet.RSync(), but this requires a dir rather than a file
         """
         print("uploading", file, "to", dest_dir)
-        shutil.copy(file, dest_dir)
+        staging.default_cache().link_into(file, dest_dir)
 
     def _prepare_support_files(self):
         """ Copy any support files into working dir """
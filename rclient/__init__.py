@@ -1,8 +1,15 @@
-
-from . import connector, rservecontext, tornado_executor
+from . import aio, cache, connector, fleet, metrics, multihost, profiling, registry, rservecontext, tornado_executor
 
 RServeConnection = connector.RServeConnection
 RContext = rservecontext.RContext
+AsyncRServePool = aio.AsyncRServePool
+ModelRegistry = registry.ModelRegistry
+ModelBundle = registry.ModelBundle
+ResultCache = cache.ResultCache
+MultiHostPool = multihost.MultiHostPool
+RserveFleet = fleet.RserveFleet
+Preload = fleet.Preload
+Profiler = profiling.Profiler
 
 RPool = connector.RServeConnection  # for backwards compatibility
 rpool = connector
@@ -0,0 +1,476 @@
+"""
+asyncio client and pool for Rserve
+
+Speaks QAP1 on asyncio streams instead of pinning a blocking pyRserve socket to a thread, so in-flight evaluations
+cost sockets rather than threads. Message encoding and decoding is pyRserve's own. Works on any asyncio loop,
+including Tornado's IOLoop.
+
+# Usage:
+
+pool = AsyncRServePool(pool_size=10, max_size=100)
+await pool.start()
+
+result = await pool.eval('''some r code''')
+
+# Interactive usage:
+
+c = await pool.connect()
+r1 = await c.eval('''some r code''')
+await c.close()
+
+# Context usage:
+
+async with pool.connect() as c:
+    r1 = await c.eval('''some r code''')
+    r2 = await c.eval('''some other r code''')
+
+"""
+
+import asyncio
+import inspect
+import logging
+import time
+
+import pyRserve
+from pyRserve import rtypes
+from pyRserve.rexceptions import PyRserveClosed, REvalError, RConnectionRefused
+from pyRserve.rparser import rparse, OOBMessage
+from pyRserve.rserializer import rEval, rAssign, rSerializeResponse
+
+from .connector import (DEFAULT_MAX_SIZE_SCALE, MIN_MAINTENANCE_INTERVAL, RESET_RECONNECT, RESET_WORKSPACE,
+                        RESET_STRATEGIES, _RECORD_BASELINE, _RESTORE_BASELINE, MethodNotAllowed, PoolEmpty)
+from .protocol import HEADER, message_length
+
+__all__ = ['AsyncRConnector', 'AsyncRServePool']
+
+logger = logging.getLogger(__name__)
+
+RSERVEPORT = pyRserve.rconn.RSERVEPORT
+
+ID_STRING_LENGTH = 32
+
+
+def _defaultOOBCallback(data, code=0):
+    return None
+
+
+class AsyncRConnector(object):
+    """ an asyncio counterpart of pyRserve's RConnector
+
+        c = AsyncRConnector(port=6311)
+        await c.connect()
+        await c.eval('2 + 2')
+        await c.close()
+
+        :param oobCallback: called with (data, code) for out-of-band messages. may be a coroutine function.
+    """
+
+    def __init__(self, host='localhost', port=RSERVEPORT, unix_socket=None, atomicArray=False,
+                 oobCallback=_defaultOOBCallback):
+        self.host = host or 'localhost'
+        self.port = port
+        self.unix_socket = unix_socket
+        self.atomicArray = atomicArray
+        self.oobCallback = oobCallback
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    def __repr__(self):
+        txt = 'Closed async handle' if self.isClosed else 'Async handle'
+        where = self.unix_socket or '{}:{}'.format(self.host, self.port)
+        return '<{} to Rserve on {}>'.format(txt, where)
+
+    @property
+    def isClosed(self):
+        return self._writer is None
+
+    async def connect(self):
+        try:
+            if self.unix_socket:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.unix_socket)
+            else:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            raise RConnectionRefused('Connection denied, server not reachable or not accepting connections')
+
+        hdr = await self._reader.readexactly(ID_STRING_LENGTH)
+        if not hdr.startswith(b'Rsrv01'):
+            await self.close()
+            raise RConnectionRefused('Protocol error with Rserv, obtained invalid header string')
+        return self
+
+    async def close(self):
+        if self._writer is None:
+            return
+        writer, self._reader, self._writer = self._writer, None, None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    def _abort(self):
+        if self._writer is not None:
+            writer, self._reader, self._writer = self._writer, None, None
+            writer.close()
+
+    async def eval(self, aString, atomicArray=None, void=False):
+        """ Evaluate a string expression through Rserve and return the result transformed into python objects """
+        if atomicArray is None:
+            atomicArray = self.atomicArray
+
+        async with self._lock:
+            try:
+                message = await self._request(rEval(aString, void=void), atomicArray)
+            except REvalError:
+                # R has reported an evaluation error. ask R why, like pyRserve does.
+                errorMsg = await self._request(rEval('geterrmessage()'), atomicArray)
+                raise REvalError(errorMsg.strip())
+        return message
+
+    async def voidEval(self, aString):
+        """ Evaluate a string expression through Rserve without returning any result data """
+        await self.eval(aString, void=True)
+
+    async def setRexp(self, name, o):
+        """ Convert a python object into an RExp and bind it to a variable called "name" in the R namespace """
+        async with self._lock:
+            await self._request(rAssign(name, o), self.atomicArray)
+
+    async def assign(self, aDict):
+        """ Assign all items of the dictionary to the default R namespace """
+        for k, v in aDict.items():
+            await self.setRexp(k, v)
+
+    async def getRexp(self, name):
+        return await self.eval(name)
+
+    async def _request(self, data, atomicArray):
+        """ send one message and parse its response, answering any OOB messages that come before it """
+        if self.isClosed:
+            raise PyRserveClosed('Connection to Rserve already closed')
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+            message = rparse(await self._receive(), atomicArray=atomicArray)
+            while isinstance(message, OOBMessage):
+                ret = self.oobCallback(message.data, message.userCode)
+                if inspect.isawaitable(ret):
+                    ret = await ret
+                if message.type == rtypes.OOB_MSG:
+                    self._writer.write(rSerializeResponse(ret))
+                    await self._writer.drain()
+                message = rparse(await self._receive(), atomicArray=atomicArray)
+            return message
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            raise PyRserveClosed('Connection to Rserve already closed')
+        except REvalError:
+            raise
+        except BaseException:
+            # cancelled, or an OOB callback failed, before the answer was read. the connection is out of step, so
+            # drop it without awaiting anything more.
+            self._abort()
+            raise
+
+    async def _receive(self):
+        """ read one complete QAP1 message """
+        header = await self._reader.readexactly(HEADER.size)
+        return header + await self._reader.readexactly(message_length(header))
+
+    async def reset(self, strategy=RESET_RECONNECT):
+        """ clean the R session, see _PooledPyRserve.reset
+
+            :return: True if a new R session was started
+        """
+        if strategy == RESET_WORKSPACE and await self.restore_baseline():
+            return False
+
+        await self.close()
+        await self.connect()
+        return True
+
+    async def record_baseline(self):
+        await self.voidEval(_RECORD_BASELINE)
+
+    async def restore_baseline(self):
+        try:
+            return (await self.eval(_RESTORE_BASELINE)) is True
+        except REvalError as e:
+            logger.info("could not restore baseline, reconnecting: %s", e)
+            return False
+
+    def shutdown(self):
+        """" don't want a connection shutting down the r server. """
+        raise MethodNotAllowed('''Shutting down the R server is not allowed from pooled connections.''')
+
+
+class AsyncRServePool(object):
+    """ asyncio version of connector.RServeConnection
+
+        takes the same sizing and reset arguments. connection arguments are passed to AsyncRConnector.
+        call start() (or use the pool as an async context manager) before checking out connections.
+    """
+
+    def __init__(self, pool_size=1, realtime=False, *cargs, blocking_init=True, max_size=None, checkout_timeout=None,
+                 idle_timeout=None, reset_strategy=RESET_RECONNECT, **ckwargs):
+        if max_size is None:
+            max_size = max(pool_size * DEFAULT_MAX_SIZE_SCALE, 1)
+
+        if pool_size < 0 or max_size < max(pool_size, 1):
+            raise ValueError("need 0 <= pool_size <= max_size and max_size >= 1")
+
+        if reset_strategy not in RESET_STRATEGIES:
+            raise ValueError("reset_strategy must be one of {}".format(RESET_STRATEGIES))
+
+        self._cargs = cargs
+        self._ckwargs = ckwargs
+
+        self._pool_size = pool_size
+        self._max_size = max_size
+        self._checkout_timeout = checkout_timeout
+        self._idle_timeout = idle_timeout
+        self._realtime = realtime
+        self._blocking_init = blocking_init
+        self._reset_strategy = reset_strategy
+        self.pool = []
+        self._size = 0
+        self._warming = 0
+        self._pool_ready = None
+        self._tasks = set()
+        self._closed = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def min_size(self):
+        return self._pool_size
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        """ number of open connections, whether idle or checked out """
+        return self._size
+
+    async def start(self):
+        """ open the initial connections concurrently. if we aren't blocking, return while they connect. """
+        self._pool_ready = asyncio.Condition()
+        warmups = [self._warm_up() for _ in range(self._pool_size)]
+        self._size += len(warmups)
+        self._warming += len(warmups)
+        if self._blocking_init:
+            errors = [e for e in await asyncio.gather(*warmups, return_exceptions=True) if e is not None]
+            if errors:
+                raise errors[0]
+        else:
+            for w in warmups:
+                self._spawn(w)
+
+        if self._idle_timeout is not None:
+            self._spawn(self._reap_idle_periodically())
+        return self
+
+    async def close(self):
+        """ close idle connections and stop background work. checked out connections are closed on checkin. """
+        self._closed = True
+        for t in list(self._tasks):
+            t.cancel()
+        idle, self.pool = self.pool, []
+        self._size -= len(idle)
+        for c in idle:
+            await c.close()
+
+    async def eval(self, expression):
+        """ checkout a connection, execute an expression, then close the connection """
+        c = await self.connect()
+        try:
+            return await c.eval(expression)
+        finally:
+            await c.close()
+
+    def connect(self, timeout=None):
+        """ check out a connection. await the result, or use it as an async context manager.
+
+            :param timeout: overrides the pool's checkout_timeout. PoolEmpty is raised on timeout.
+        """
+        return _AsyncCheckout(self, timeout)
+
+    async def _checkout(self, timeout=None):
+        if timeout is None:
+            timeout = self._checkout_timeout
+        try:
+            c = await asyncio.wait_for(self._acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolEmpty("no connection available after {}s".format(timeout))
+        return _AsyncPooledConnectionInteractor(pool=self, connection=c)
+
+    async def _acquire(self):
+        async with self._pool_ready:
+            while True:
+                if self.pool:
+                    return self.pool.pop()
+                if not self._warming and self._size < self._max_size:
+                    self._size += 1
+                    break
+                await self._pool_ready.wait()
+
+        try:
+            return await self._new_connection()
+        except BaseException:
+            await self._release_slot()
+            raise
+
+    async def checkin(self, c):
+        """ Returns the connection to the pool. non-realtime pools reset it in a background task first.
+            closed connections, e.g. after a cancelled eval or a server restart, are discarded.
+        """
+        if self._closed or c.isClosed:
+            await self._release_slot()
+            await c.close()
+        elif self._realtime:
+            await self._make_idle(c)
+        else:
+            self._spawn(self._recycle(c))
+
+    async def _new_connection(self):
+        c = AsyncRConnector(*self._cargs, **self._ckwargs)
+        await c.connect()
+        await self._prepare_connection(c)
+        return c
+
+    async def _prepare_connection(self, c):
+        """ set up a fresh R session, either new or after a reconnecting reset """
+        if self._reset_strategy == RESET_WORKSPACE:
+            await c.record_baseline()
+
+    async def _warm_up(self):
+        try:
+            c = await self._new_connection()
+        except Exception as e:
+            async with self._pool_ready:
+                self._warming -= 1
+                self._size -= 1
+                self._pool_ready.notify()
+            logger.error("could not open pooled connection: %s", e)
+            return e
+        async with self._pool_ready:
+            self._warming -= 1
+        await self._make_idle(c)
+
+    async def _recycle(self, c):
+        try:
+            if await c.reset(self._reset_strategy):
+                await self._prepare_connection(c)
+        except Exception:
+            logger.exception("could not reset connection %s", id(c))
+            await self._release_slot()
+            await c.close()
+            return
+        await self._make_idle(c)
+
+    async def _make_idle(self, c):
+        async with self._pool_ready:
+            c.idle_since = time.monotonic()
+            self.pool.append(c)
+            self._pool_ready.notify()
+
+    async def _release_slot(self):
+        async with self._pool_ready:
+            self._size -= 1
+            self._pool_ready.notify()
+
+    async def _reap_idle_periodically(self):
+        interval = max(self._idle_timeout / 2, MIN_MAINTENANCE_INTERVAL)
+        while True:
+            await asyncio.sleep(interval)
+            await self._reap_idle()
+
+    async def _reap_idle(self):
+        """ close idle connections above pool_size that have been idle longer than idle_timeout """
+        deadline = time.monotonic() - self._idle_timeout
+        reaped = []
+        async with self._pool_ready:
+            while self._size > self._pool_size and self.pool and self.pool[0].idle_since < deadline:
+                reaped.append(self.pool.pop(0))
+                self._size -= 1
+            self._pool_ready.notify(len(reaped))
+        for c in reaped:
+            await c.close()
+
+    def _spawn(self, coroutine):
+        """ run a background task, keeping a reference so it isn't garbage collected """
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+class _AsyncCheckout(object):
+    """ awaitable and async context manager returned by AsyncRServePool.connect """
+
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._interactor = None
+
+    def __await__(self):
+        return self._pool._checkout(self._timeout).__await__()
+
+    async def __aenter__(self):
+        self._interactor = await self._pool._checkout(self._timeout)
+        return self._interactor
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._interactor.close()
+
+
+class _AsyncPooledConnectionInteractor(object):
+    """ A wrapper for an AsyncRConnector that you've taken out of the pool.
+
+        knows what pool it came from and how to check itself back in.
+    """
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, item):
+        if self._connection is None:
+            raise PyRserveClosed('Connection was already returned to the pool')
+        return getattr(self._connection, item)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def pool(self):
+        return self._pool
+
+    async def close(self):
+        """ return our connection to the pool, and remove our reference to it """
+        if self._connection is None:
+            return
+        c, self._connection = self._connection, None
+        pool, self._pool = self._pool, None
+        await pool.checkin(c)
+
+    @staticmethod
+    def shutdown():
+        """ don't allow shutting down of rserve """
+        raise MethodNotAllowed('''Please don't shut down the RServe from here''')
@@ -0,0 +1,216 @@
+"""
+Move numpy arrays to and from R without pyRserve's intermediate copies.
+
+pyRserve serializes an array into a BytesIO, copies that into the message, and decodes results element by element
+into new arrays. Here, a numeric array is sent straight from its own buffer after a few header bytes: a Fortran-ordered
+(or one dimensional) float64, int32 or complex128 array isn't copied at all before the socket gets it, other layouts
+and numeric types are converted once. Results are received straight into the buffer of the array that is returned,
+reshaped to R's dims in Fortran order without copying.
+
+Rserve refuses messages bigger than its maxinbuf, which is 256MB by default. Raise it in rserve.conf to send bigger
+arrays.
+
+Usage:
+
+with pool.connect() as c:
+    c.assign_array('features', features)             # a 2 dimensional array becomes an R matrix
+    scores = c.fetch_array('predict(model, features)')
+
+assign_array(conn, 'x', numpy.arange(10.))           # on a pyRserve connection
+"""
+
+import logging
+import struct
+
+import numpy
+from pyRserve import rtypes
+from pyRserve.rconn import checkIfClosed
+from pyRserve.rexceptions import REvalError
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rEval
+
+from .protocol import HEADER, message_length, qap_string, read_answer, read_exactly, read_into
+
+__all__ = ['assign_array', 'fetch_array', 'receive_array']
+
+logger = logging.getLogger(__name__)
+
+SMALL_HEADER = struct.Struct('<I')
+MAX_SMALL_LENGTH = 0xfffff0  # longer SEXPs and parameters need the large header
+MIN_INT = -2 ** 31 + 1  # -2 ** 31 is NA
+MAX_INT = 2 ** 31 - 1
+
+# numpy dtype kind -> (R array type, the dtype R sends it as)
+_TYPES = {
+    'f': (rtypes.XT_ARRAY_DOUBLE, numpy.dtype('<f8')),
+    'i': (rtypes.XT_ARRAY_INT, numpy.dtype('<i4')),
+    'c': (rtypes.XT_ARRAY_CPLX, numpy.dtype('<c16')),
+}
+_DTYPES = dict(_TYPES.values())
+
+
+def _header(type, length, large_flag):
+    """ a data or SEXP header: the type and a 3 byte length, or a 7 byte one with the large flag """
+    if length > MAX_SMALL_LENGTH:
+        return struct.pack('<BQ', type | large_flag, length)[:8]
+    return SMALL_HEADER.pack(type | (length << 8))
+
+
+def _dim_attribute(shape):
+    """ the attribute pairlist giving an R array its dims """
+    dims = numpy.array(shape, dtype='<i4').tobytes()
+    tag = qap_string('dim')
+    pairs = (_header(rtypes.XT_ARRAY_INT, len(dims), rtypes.XT_LARGE) + dims +
+             _header(rtypes.XT_SYMNAME, len(tag), rtypes.XT_LARGE) + tag)
+    return _header(rtypes.XT_LIST_TAG, len(pairs), rtypes.XT_LARGE) + pairs
+
+
+def _as_r_array(array):
+    """ :return: the R type and array in a dtype R reads, unchanged if it already is one """
+    array = numpy.asanyarray(array)
+    kind = array.dtype.kind
+    if kind == 'u':
+        kind = 'i'
+    if kind not in _TYPES:
+        raise TypeError("can't send {} arrays as R numbers, use the connection's assign".format(array.dtype))
+    if kind == 'i' and array.dtype.itemsize >= 4 and array.dtype != numpy.int32 and array.size:
+        # like pyRserve, send 64 bit integers as R integers if they fit
+        if array.min() < MIN_INT or array.max() > MAX_INT:
+            raise ValueError("R integers are 32 bit. convert the array to float to send it.")
+    r_type, dtype = _TYPES[kind]
+    return r_type, numpy.asarray(array, dtype=dtype)
+
+
+@checkIfClosed
+def assign_array(conn, name, array):
+    """ assign a numeric numpy array to an R variable. arrays with several dimensions keep their dims.
+
+        float arrays become doubles, integer arrays become integers and complex arrays become complex.
+        64 bit and unsigned integers must fit in R's 32 bit integers.
+
+        :param conn: a pyRserve connection. it must not be used by anyone else meanwhile.
+    """
+    r_type, array = _as_r_array(array)
+    # R's order. no copy when the array already is Fortran contiguous, and the buffer is contiguous either way, so
+    # nothing can fail between the header and the data.
+    array = numpy.require(array, requirements='F')
+    data = array.reshape(-1, order='F')
+    attribute = _dim_attribute(array.shape) if array.ndim > 1 else b''
+    if attribute:
+        r_type |= rtypes.XT_HAS_ATTR
+
+    sexp_length = len(attribute) + data.nbytes
+    sexp = _header(r_type, sexp_length, rtypes.XT_LARGE) + attribute
+    symbol = qap_string(name)
+    parameters = (_header(rtypes.DT_STRING, len(symbol), rtypes.DT_LARGE) + symbol +
+                  _header(rtypes.DT_SEXP, len(sexp) + data.nbytes, rtypes.DT_LARGE) + sexp)
+    length = len(parameters) + data.nbytes
+
+    buffer = memoryview(data).cast('B')
+    try:
+        conn.sock.sendall(HEADER.pack(rtypes.CMD_setSEXP, length & 0xffffffff, 0, length >> 32) + parameters)
+        conn.sock.sendall(buffer)
+        # a bare RESP_OK parses to None. errors are raised.
+        rparse(conn.sock)
+    except REvalError:
+        raise
+    except BaseException:
+        # the message is cut short or its answer unread, so the connection is out of step. close it, which keeps a
+        # pool from handing it out again.
+        _close_quietly(conn)
+        raise
+    logger.debug("assigned a %s %s array to %s", array.shape, array.dtype, name)
+
+
+@checkIfClosed
+def fetch_array(conn, expression):
+    """ evaluate expression and return its value as a numpy array.
+
+        numeric results are received straight into the returned array, and R's dims become its shape, in
+        Fortran order. other results are parsed by pyRserve and passed through numpy.asarray.
+
+        :param conn: a pyRserve connection. it must not be used by anyone else meanwhile.
+    """
+    conn.sock.sendall(rEval(expression))
+    return receive_array(conn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def receive_array(conn):
+    """ read the answer to an eval already sent on conn, like fetch_array does """
+    def read():
+        header = read_exactly(conn.sock, HEADER.size)
+        status = HEADER.unpack(header)[0]
+        length = message_length(header)
+        if status == rtypes.RESP_OK and length:
+            return _read_array(conn, header, length)
+        # errors and out of band messages are pyRserve's business
+        return rparse(bytes(header + read_exactly(conn.sock, length)), atomicArray=True)
+
+    return numpy.asarray(read_answer(conn, read))
+
+
+def _read_length(sock, first_word, large_flag):
+    """ :return: the type byte, the length, and the header's bytes """
+    (word,) = SMALL_HEADER.unpack(first_word)
+    type, length = word & 0xff, word >> 8
+    if type & large_flag:
+        rest = read_exactly(sock, 4)
+        length |= SMALL_HEADER.unpack(rest)[0] << 24
+        return type & ~large_flag, length, bytes(first_word + rest)
+    return type, length, bytes(first_word)
+
+
+def _read_array(conn, header, length):
+    """ read an RESP_OK message's SEXP, straight into an array if it is numeric """
+    sock = conn.sock
+    _, _, dt_header = _read_length(sock, read_exactly(sock, 4), rtypes.DT_LARGE)
+    r_type, sexp_length, sexp_header = _read_length(sock, read_exactly(sock, 4), rtypes.XT_LARGE)
+    has_attribute = bool(r_type & rtypes.XT_HAS_ATTR)
+    r_type &= ~rtypes.XT_HAS_ATTR
+
+    dtype = _DTYPES.get(r_type)
+    if dtype is None:
+        rest = read_exactly(sock, length - len(dt_header) - len(sexp_header))
+        message = bytes(header) + dt_header + sexp_header + bytes(rest)
+        return numpy.asarray(rparse(message, atomicArray=True))
+
+    shape = None
+    if has_attribute:
+        _, attribute_length, attribute_header = _read_length(sock, read_exactly(sock, 4), rtypes.XT_LARGE)
+        attribute = read_exactly(sock, attribute_length)
+        sexp_length -= len(attribute_header) + attribute_length
+        shape = _dims(attribute)
+
+    array = numpy.empty(sexp_length // dtype.itemsize, dtype=dtype)
+    read_into(sock, memoryview(array).cast('B'))
+    if shape is not None:
+        array = array.reshape(shape, order='F')
+    return array
+
+
+def _dims(pairs):
+    """ the dim attribute in a tagged pairlist's content, None without one """
+    pos, value = 0, None
+    while pos < len(pairs):
+        (word,) = SMALL_HEADER.unpack_from(pairs, pos)
+        type, length, pos = word & 0xff, word >> 8, pos + 4
+        if type & rtypes.XT_LARGE:
+            length |= SMALL_HEADER.unpack_from(pairs, pos)[0] << 24
+            pos += 4
+        content = bytes(pairs[pos:pos + length])
+        pos += length
+        if value is None:
+            value = (type & ~(rtypes.XT_LARGE | rtypes.XT_HAS_ATTR), content)
+            continue
+        # value, then its tag
+        if content.split(b'\0', 1)[0] == b'dim' and value[0] == rtypes.XT_ARRAY_INT:
+            return tuple(numpy.frombuffer(value[1], dtype='<i4'))
+        value = None
+    return None
@@ -0,0 +1,312 @@
+"""
+Benchmarks of the pools and executors against the fake Rserve, so they run offline on any box, without R.
+
+Each target is driven by a closed loop of `concurrency` clients, each sending its next request as soon as the last one
+is answered, after a warm-up. Every request evaluates an expression that takes `delay` seconds in the fake server and
+returns `payload` doubles. The results are JSON: throughput and latency percentiles per target and concurrency level,
+plus the time it took to set the target up.
+
+Usage:
+
+python -m rclient.bench --delay .005 --payload 1000 --concurrency 1 4 16 --requests 200 > bench_output.txt
+python -m rclient.bench --targets realtime tornado --in-process
+
+The fake server runs in a subprocess by default, so it doesn't compete with the clients for the GIL.
+threadpool.RPool always connects to localhost:6311, so its target only runs with the default port.
+The execnet target needs execnet and runs python functions rather than R.
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+from . import connector
+from .fake_rserve import FakeRserve
+from .fleet import FAKE_RSERVE_COMMAND, RserveFleet
+
+__all__ = ['run', 'main', 'TARGETS']
+
+logger = logging.getLogger(__name__)
+
+TARGETS = ('realtime', 'workspace', 'reconnect', 'threadpool', 'tornado', 'execnet')
+DEFAULT_CONCURRENCY = (1, 4, 16)
+DEFAULT_REQUESTS = 200
+DEFAULT_DELAY = .005
+DEFAULT_PAYLOAD = 1000
+
+_EXECNET_MODULE = 'rclient_bench_functions'
+_EXECNET_SOURCE = """
+import time
+
+def work(delay, payload):
+    time.sleep(delay)
+    return [0.0] * payload
+"""
+
+
+class Skipped(Exception):
+    """ a target that can't run here """
+    pass
+
+
+def expression(delay, payload):
+    """ R code taking delay seconds and returning payload doubles """
+    value = 'numeric({})'.format(payload) if payload else 'TRUE'
+    return 'Sys.sleep({}); {}'.format(delay, value) if delay else value
+
+
+def closed_loop(call, concurrency, requests):
+    """ call() requests times from concurrency threads, each calling again as soon as its last call returns
+
+        :return: latencies of the successful calls, number of failed calls, wall time
+    """
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        while next(counter) < requests:
+            start = time.perf_counter()
+            try:
+                call()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    if errors:
+        logger.warning("%s of %s calls failed, the first with: %r", len(errors), requests, errors[0])
+    return latencies, len(errors), seconds
+
+
+def summarize(latencies, errors, seconds, setup):
+    latencies = numpy.array(latencies)
+    done = len(latencies)
+    return {
+        'requests': done + errors,
+        'errors': errors,
+        'seconds': seconds,
+        'setup_seconds': setup,
+        'throughput': done / seconds if seconds else None,
+        'mean': float(latencies.mean()) if done else None,
+        'p50': float(numpy.percentile(latencies, 50)) if done else None,
+        'p99': float(numpy.percentile(latencies, 99)) if done else None,
+        'max': float(latencies.max()) if done else None,
+    }
+
+
+def bench_pool(port, concurrency, requests, code, **pool_kwargs):
+    start = time.perf_counter()
+    pool = connector.RServeConnection(pool_size=concurrency, max_size=concurrency, port=port, **pool_kwargs)
+    setup = time.perf_counter() - start
+    try:
+        closed_loop(lambda: pool.eval(code), concurrency, concurrency)
+        return summarize(*closed_loop(lambda: pool.eval(code), concurrency, requests), setup=setup)
+    finally:
+        pool.close()
+
+
+def bench_threadpool(port, concurrency, requests, code):
+    if port != connector.RSERVEPORT:
+        raise Skipped("threadpool.RPool only connects to port {}".format(connector.RSERVEPORT))
+    from .threadpool import RPool
+
+    start = time.perf_counter()
+    pool = RPool(workers=concurrency, support_files=[])
+    pool.start()
+    setup = time.perf_counter() - start
+    try:
+        def call():
+            return pool.submit('bench', code).result()
+        closed_loop(call, concurrency, concurrency)
+        return summarize(*closed_loop(call, concurrency, requests), setup=setup)
+    finally:
+        pool.stop()
+
+
+def bench_tornado(port, concurrency, requests, code):
+    from tornado.ioloop import IOLoop
+    from .tornado_executor import RPoolTornado
+
+    start = time.perf_counter()
+    pool = RPoolTornado(max_workers=concurrency, port=port)
+    setup = time.perf_counter() - start
+    try:
+        return _bench_on_ioloop(lambda: pool.r_eval(code), concurrency, requests, setup, IOLoop)
+    finally:
+        pool.shutdown()
+
+
+def bench_execnet(port, concurrency, requests, delay, payload):
+    try:
+        from pyclient.tornado_executor import ExecnetTornado
+    except ImportError as e:
+        raise Skipped("execnet isn't available: {}".format(e))
+    from tornado.ioloop import IOLoop
+
+    # ExecnetTornado imports its initializer by file name from the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, _EXECNET_MODULE + '.py'), 'w') as f:
+            f.write(_EXECNET_SOURCE)
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            pool = ExecnetTornado(max_workers=concurrency, initializer=_EXECNET_MODULE + '.py',
+                                  python=sys.executable)
+            setup = time.perf_counter() - start
+            try:
+                return _bench_on_ioloop(lambda: pool.call_function('work', delay, payload), concurrency, requests,
+                                        setup, IOLoop)
+            finally:
+                pool.shutdown()
+        finally:
+            os.chdir(cwd)
+
+
+def _bench_on_ioloop(submit, concurrency, requests, setup, IOLoop):
+    """ closed_loop for executors returning tornado futures: concurrency coroutines on a fresh IOLoop """
+    from tornado import gen
+
+    async def run(n):
+        counter = itertools.count()
+        latencies = []
+        errors = []
+
+        async def client():
+            while next(counter) < n:
+                start = time.perf_counter()
+                try:
+                    await submit()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await gen.multi([client() for _ in range(concurrency)])
+        if errors:
+            logger.warning("%s of %s calls failed, the first with: %r", len(errors), n, errors[0])
+        return latencies, len(errors), time.perf_counter() - start
+
+    loop = IOLoop(make_current=False)
+    try:
+        loop.run_sync(lambda: run(concurrency))
+        return summarize(*loop.run_sync(lambda: run(requests)), setup=setup)
+    finally:
+        loop.close()
+
+
+@contextlib.contextmanager
+def fake_server(port, in_process=False):
+    """ a fake Rserve on port, in a subprocess unless in_process """
+    if in_process:
+        server = FakeRserve(port=port).start()
+        try:
+            yield server
+        finally:
+            server.stop()
+        return
+
+    # the daemon runs in its own directory. let it import rclient from wherever this process did.
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = os.pathsep.join(p for p in (package_parent, os.environ.get('PYTHONPATH')) if p)
+    with RserveFleet(daemons=1, base_port=port, conf=None, command=FAKE_RSERVE_COMMAND,
+                     env={'PYTHONPATH': pythonpath}) as fleet:
+        yield fleet
+
+
+def run(targets=TARGETS, concurrency=DEFAULT_CONCURRENCY, requests=DEFAULT_REQUESTS, delay=DEFAULT_DELAY,
+        payload=DEFAULT_PAYLOAD, port=connector.RSERVEPORT, in_process=False):
+    """ run the benchmarks
+
+        :return: {'meta': {...}, 'results': [{'target': ..., 'concurrency': ..., 'throughput': ..., ...}, ...]}
+    """
+    code = expression(delay, payload)
+    results = []
+    with fake_server(port, in_process=in_process):
+        for target, c in itertools.product(targets, concurrency):
+            logger.info("benchmarking %s with %s clients", target, c)
+            try:
+                if target == 'realtime':
+                    result = bench_pool(port, c, requests, code, realtime=True)
+                elif target == 'workspace':
+                    result = bench_pool(port, c, requests, code, reset_strategy=connector.RESET_WORKSPACE)
+                elif target == 'reconnect':
+                    result = bench_pool(port, c, requests, code, reset_strategy=connector.RESET_RECONNECT)
+                elif target == 'threadpool':
+                    result = bench_threadpool(port, c, requests, code)
+                elif target == 'tornado':
+                    result = bench_tornado(port, c, requests, code)
+                elif target == 'execnet':
+                    result = bench_execnet(port, c, requests, delay, payload)
+                else:
+                    raise ValueError("unknown target {}".format(target))
+            except Skipped as e:
+                result = {'skipped': str(e)}
+            results.append(dict(target=target, concurrency=c, **result))
+
+    return {
+        'meta': {
+            'delay': delay,
+            'payload': payload,
+            'requests': requests,
+            'in_process': in_process,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='timed requests per run')
+    parser.add_argument('--delay', type=float, default=DEFAULT_DELAY, help='seconds of R compute per request')
+    parser.add_argument('--payload', type=int, default=DEFAULT_PAYLOAD, help='doubles returned per request')
+    parser.add_argument('--port', type=int, default=connector.RSERVEPORT)
+    parser.add_argument('--in-process', action='store_true', help='run the fake server in this process')
+    parser.add_argument('--output', default=None, help='file to write the JSON to, instead of stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(message)s')
+    # some executors print as they work. keep stdout for the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args.targets, args.concurrency, args.requests, args.delay, args.payload, args.port,
+                     args.in_process)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
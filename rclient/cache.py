@@ -0,0 +1,167 @@
+"""
+Result cache for deterministic evaluations.
+
+Results are keyed on the expression text and a content version of the code the connections run (the bundle,
+initializer and uploads), so a changed bundle never serves old results. Entries are evicted least recently used
+first once the cache holds more than max_bytes, and expire after ttl seconds. Cached results are shared between
+callers, so don't modify them.
+
+Usage:
+
+cache = ResultCache(max_bytes=64 << 20, ttl=300)
+rpool = RServeConnection(pool_size=4, cache=cache)
+
+rpool.eval('lookup_table()')                # goes to R
+rpool.eval('lookup_table()')                # served from the cache
+rpool.eval('runif(1)', cached=False)        # always goes to R
+
+cache.stats()
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+
+from . import staging
+
+__all__ = ['ResultCache', 'content_version']
+
+DEFAULT_MAX_BYTES = 64 << 20
+
+
+class ResultCache(object):
+    """ a thread-safe LRU cache with a size limit in bytes and an optional time to live
+
+        :param max_bytes: estimated size of the cached results above which the least recently used are evicted
+        :param ttl: seconds an entry stays valid. None keeps entries until they are evicted.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ :return: (True, value) on a hit, (False, None) on a miss """
+        with self._lock:
+            try:
+                value, size, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        """ cache a result. results bigger than the whole cache aren't kept. """
+        size = _sizeof(value) + _sizeof(key)
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key):
+        """ call while holding self._lock """
+        value, size, expires = self._entries.pop(key)
+        self._bytes -= size
+
+
+def content_version(*paths):
+    """ a digest of the content of files and directories, for keying cached results.
+        paths that don't exist contribute only their name, so e.g. files sourced from R's working dir still count.
+    """
+    h = hashlib.sha256()
+    cache = staging.default_cache()
+    for path in paths:
+        if path is None:
+            continue
+        h.update(str(path).encode('utf-8') + b'\0')
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    full = os.path.join(root, f)
+                    h.update(os.path.relpath(full, path).encode('utf-8') + cache.digest(full).encode('ascii'))
+        elif os.path.isfile(path):
+            h.update(cache.digest(path).encode('ascii'))
+    return h.hexdigest()
+
+
+def _sizeof(value, seen=None):
+    """ rough size in bytes of a result. a buffer shared by several arrays is counted once.
+
+        :param seen: ids of the buffers already counted
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(value, numpy.ndarray):
+        # getsizeof counts the buffer of arrays that own it, but not of views
+        size = sys.getsizeof(value) - (value.nbytes if value.flags.owndata else 0)
+        owner = _buffer_owner(value)
+        if id(owner) not in seen:
+            seen.add(id(owner))
+            size += owner.nbytes if isinstance(owner, numpy.ndarray) else memoryview(owner).nbytes
+        return size
+    if hasattr(value, 'nbytes'):
+        # columnar Frames and Factors
+        return value.nbytes + sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_sizeof(v, seen) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in value.items())
+    if isinstance(getattr(value, 'values', None), list):
+        # pyRserve's TaggedList, which data frames and named lists come back as
+        return sys.getsizeof(value) + _sizeof(value.values, seen) + _sizeof(getattr(value, 'keys', None), seen)
+    return sys.getsizeof(value)
+
+
+def _buffer_owner(array):
+    """ the array or buffer object whose memory array views """
+    while isinstance(array, numpy.ndarray) and array.base is not None:
+        array = array.base
+    return array
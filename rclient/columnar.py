@@ -0,0 +1,270 @@
+"""
+Data frames as columns of numpy arrays, decoded straight from Rserve's answer.
+
+pyRserve decodes a data frame into a TaggedList of per-column objects, going through python objects on the way.
+In columnar mode, the answer is received into one buffer, and a data frame's numeric columns become numpy arrays
+viewing that buffer, with no per-element work. Factors stay integer codes plus their levels, strings become one
+object array per column. A pandas DataFrame is only built when asked for, and pandas is only needed then.
+
+Results that aren't data frames are decoded by pyRserve as usual.
+
+Usage:
+
+frame = rpool.eval('read.csv("wide.csv")', columnar=True)
+frame.names, frame.nrow
+frame['price']                          # a float64 array
+frame['region'].levels                  # a Factor: codes and levels
+frame.to_pandas()
+
+with rpool.connect() as c:
+    frame = c.eval_columnar('iris')
+"""
+
+import logging
+import struct
+
+import numpy
+from pyRserve import rtypes
+from pyRserve.rconn import checkIfClosed
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rEval
+
+from .protocol import HEADER, read_answer, read_message
+
+__all__ = ['Frame', 'Factor', 'eval_columnar', 'parse']
+
+logger = logging.getLogger(__name__)
+
+NA_INTEGER = -2 ** 31
+NA_STRING = b'\xff'
+NA_LOGICAL = 2
+
+_NUMERIC = {
+    rtypes.XT_ARRAY_DOUBLE: numpy.dtype('<f8'),
+    rtypes.XT_ARRAY_INT: numpy.dtype('<i4'),
+    rtypes.XT_ARRAY_CPLX: numpy.dtype('<c16'),
+}
+
+
+class Unsupported(Exception):
+    """ a value columnar decoding leaves to pyRserve """
+    pass
+
+
+class Factor(object):
+    """ an R factor: 1-based integer codes into levels. NA codes are NA_INTEGER. """
+
+    __slots__ = ('codes', 'levels', 'ordered')
+
+    def __init__(self, codes, levels, ordered=False):
+        self.codes = codes
+        self.levels = levels
+        self.ordered = ordered
+
+    def __repr__(self):
+        return '<Factor {} values, {} levels>'.format(len(self.codes), len(self.levels))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.levels.nbytes
+
+    def values(self):
+        """ the levels as an object array, None for NA """
+        values = numpy.empty(len(self.codes), dtype=object)
+        na = self.codes == NA_INTEGER
+        values[~na] = self.levels[self.codes[~na] - 1]
+        return values
+
+    def to_pandas(self):
+        import pandas
+        codes = self.codes.astype(numpy.int64) - 1
+        codes[self.codes == NA_INTEGER] = -1
+        return pandas.Categorical.from_codes(codes, categories=self.levels, ordered=self.ordered)
+
+
+class Frame(object):
+    """ an R data frame's columns, by name and in order
+
+        numeric columns are numpy arrays viewing the buffer the answer was received into, integer columns keep R's
+        NA_INTEGER for NA, factors are Factors and strings are object arrays with None for NA.
+    """
+
+    __slots__ = ('names', 'columns', 'row_names', 'nrow', '_pandas')
+
+    def __init__(self, names, columns, row_names=None, nrow=None):
+        self.names = list(names)
+        self.columns = list(columns)
+        self.row_names = row_names
+        self.nrow = nrow if nrow is not None else (len(self.columns[0]) if self.columns else 0)
+        self._pandas = None
+
+    def __repr__(self):
+        return '<Frame {} rows x {} columns>'.format(self.nrow, len(self.columns))
+
+    def __len__(self):
+        return self.nrow
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, name):
+        try:
+            return self.columns[self.names.index(name)]
+        except ValueError:
+            raise KeyError(name)
+
+    def items(self):
+        return zip(self.names, self.columns)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(c, 'nbytes', 0) for c in self.columns)
+
+    def to_pandas(self):
+        """ a pandas DataFrame of the columns, built on the first call. factors become categoricals and integer
+            columns with NAs become nullable Int32.
+        """
+        if self._pandas is None:
+            import pandas
+            data = {}
+            for name, column in self.items():
+                if isinstance(column, Factor):
+                    column = column.to_pandas()
+                elif isinstance(column, numpy.ndarray) and column.dtype == _NUMERIC[rtypes.XT_ARRAY_INT]:
+                    na = column == NA_INTEGER
+                    if na.any():
+                        column = pandas.arrays.IntegerArray(numpy.where(na, 0, column), na)
+                data[name] = column
+            self._pandas = pandas.DataFrame(data, index=self.row_names, columns=self.names)
+        return self._pandas
+
+
+def parse(message, atomicArray=False):
+    """ decode a whole Rserve answer, data frames into Frames and everything else with pyRserve
+
+        :param message: the answer's header and body, ideally a bytearray the columns can keep viewing
+    """
+    status, _, _, _ = HEADER.unpack_from(message)
+    if status == rtypes.RESP_OK and len(message) > HEADER.size:
+        view = memoryview(message)
+        try:
+            pos = _skip_data_header(view, HEADER.size)
+            if _is_data_frame(view, pos):
+                return _value(view, pos)[0]
+        except Unsupported as e:
+            logger.debug("decoding with pyRserve: %s", e)
+    return rparse(bytes(message), atomicArray=atomicArray)
+
+
+@checkIfClosed
+def eval_columnar(conn, expression):
+    """ evaluate expression like conn.eval, returning a data frame as a Frame
+
+        :param conn: a pyRserve connection
+    """
+    conn.sock.sendall(rEval(expression))
+    # received into one buffer, which the columns keep viewing
+    return read_answer(conn, lambda: parse(read_message(conn.sock), atomicArray=conn.atomicArray))
+
+
+def _skip_data_header(view, pos):
+    type = view[pos]
+    if type & ~rtypes.DT_LARGE != rtypes.DT_SEXP:
+        raise Unsupported("not a SEXP")
+    return pos + (8 if type & rtypes.DT_LARGE else 4)
+
+
+def _header(view, pos):
+    """ :return: the type without flags, whether attributes follow, the content's position and its end """
+    (word,) = struct.unpack_from('<I', view, pos)
+    type, length, pos = word & 0xff, word >> 8, pos + 4
+    if type & rtypes.XT_LARGE:
+        length |= struct.unpack_from('<I', view, pos)[0] << 24
+        pos += 4
+    return type & 0x3f, bool(type & rtypes.XT_HAS_ATTR), pos, pos + length
+
+
+def _is_data_frame(view, pos):
+    type, has_attributes, pos, _ = _header(view, pos)
+    if type != rtypes.XT_VECTOR or not has_attributes:
+        return False
+    attributes, _ = _value(view, pos)
+    return 'data.frame' in list(attributes.get('class', ()))
+
+
+def _value(view, pos):
+    """ decode the SEXP at pos
+        :return: the value and the position after it
+    """
+    type, has_attributes, pos, end = _header(view, pos)
+    attributes = {}
+    if has_attributes:
+        attributes, pos = _value(view, pos)
+
+    if type in _NUMERIC:
+        dtype = _NUMERIC[type]
+        value = numpy.frombuffer(view, dtype=dtype, count=(end - pos) // dtype.itemsize, offset=pos)
+        if 'levels' in attributes:
+            classes = list(attributes.get('class', ()))
+            value = Factor(value, attributes['levels'], ordered='ordered' in classes)
+        elif 'dim' in attributes:
+            value = value.reshape(tuple(attributes['dim']), order='F')
+    elif type == rtypes.XT_ARRAY_STR:
+        value = _strings(view[pos:end])
+    elif type == rtypes.XT_ARRAY_BOOL:
+        (n,) = struct.unpack_from('<i', view, pos)
+        raw = numpy.frombuffer(view, dtype=numpy.uint8, count=n, offset=pos + 4)
+        na = raw == NA_LOGICAL
+        if na.any():
+            value = numpy.where(na, None, raw == 1)
+        else:
+            value = raw == 1
+    elif type in (rtypes.XT_VECTOR, rtypes.XT_LIST_NOTAG, rtypes.XT_VECTOR_EXP):
+        value = []
+        while pos < end:
+            item, pos = _value(view, pos)
+            value.append(item)
+        if 'class' in attributes and 'data.frame' in list(attributes['class']):
+            value = _frame(value, attributes)
+    elif type in (rtypes.XT_LIST_TAG, rtypes.XT_LANG_TAG):
+        # attributes: value, then its tag
+        value = {}
+        while pos < end:
+            item, pos = _value(view, pos)
+            tag, pos = _value(view, pos)
+            value[tag] = item
+    elif type in (rtypes.XT_SYMNAME, rtypes.XT_STR, rtypes.XT_SYM):
+        value = bytes(view[pos:end]).split(b'\0', 1)[0].decode('utf-8')
+    elif type == rtypes.XT_NULL:
+        value = None
+    else:
+        raise Unsupported("values of type {}".format(type))
+    return value, end
+
+
+def _strings(view):
+    """ null terminated strings, padded with \\x01 to a multiple of 4 bytes """
+    strings = bytes(view).split(b'\0')[:-1]
+    values = numpy.empty(len(strings), dtype=object)
+    for i, s in enumerate(strings):
+        values[i] = None if s == NA_STRING else s.decode('utf-8')
+    return values
+
+
+def _frame(columns, attributes):
+    names = attributes.get('names', ())
+    row_names = attributes.get('row.names')
+    nrow = None
+    if isinstance(row_names, numpy.ndarray) and row_names.dtype.kind == 'i' and len(row_names) == 2 and \
+            row_names[0] == NA_INTEGER:
+        # R's compact form of automatic row names 1:n, c(NA, -n)
+        nrow, row_names = abs(int(row_names[1])), None
+    elif row_names is not None:
+        nrow = len(row_names)
+    return Frame(list(names), columns, row_names, nrow)
@@ -25,15 +25,16 @@ with rpool.connect() as c:
     r1 = c.eval('''some r code''')
     r2 = c.eval('''some other r code''')
 
-todo:
+# Bulk usage, spread over every connection in the pool:
 
-upload a shared model bundle that all pool processes have access to
-Perhaps as interpreters boot up, they source some file(s) in the bundle? For the purpose of loading functions.
-Problem would arise if sourcing the files runs the model.
+scores = rpool.map('score({})', range(1000), chunksize=50)
+for result in rpool.imap(lambda row: 'score({})'.format(row), rows, chunksize=50):
+    ...
+sums = rpool.starmap('sum({}, {})', [(1, 2), (3, 4)])
 
-clean up temp folders
+todo:
 
-possible other methods to implement: map, map_async, star_map
+clean up temp folders
 
 don't need inter-process communication or synchronization. just need to maintain a pool of processes on which
 a model may be evaluated.
@@ -51,10 +52,29 @@ the pool will be of rserve connections
 
 """
 
+import itertools
 import logging
-from functools import wraps
-
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial, wraps
+
+import numpy
 import pyRserve
+from pyRserve.rconn import checkIfClosed
+from pyRserve.rserializer import rAssign, rEval
+
+from . import arrays, columnar, fileio, prepared, profiling, streaming
+from .cache import content_version
+from .columnar import parse as parse_columnar
+from .metrics import REGISTRY, weak_attribute
+from .protocol import r_string
 
 __all__ = ['RServeConnection']
 
@@ -64,6 +84,68 @@ RSERVEPORT = pyRserve.rconn.RSERVEPORT
 
 _defaultOOBCallback = pyRserve.rconn._defaultOOBCallback
 
+DEFAULT_MAX_SIZE_SCALE = 2
+MIN_MAINTENANCE_INTERVAL = .05
+DEFAULT_VALIDATE_AFTER = 30
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = .1
+
+_pool_names = ('pool{}'.format(i) for i in itertools.count(1))
+
+# errors that mean the connection, rather than the R code, failed
+CONNECTION_ERRORS = (pyRserve.rexceptions.PyRserveClosed, pyRserve.rexceptions.EndOfDataError,
+                     pyRserve.rexceptions.RConnectionRefused, socket.error)
+
+RESET_RECONNECT = 'reconnect'  # close the socket and fork a new R session
+RESET_WORKSPACE = 'workspace'  # restore the recorded baseline in place, reconnecting only if that fails
+RESET_STRATEGIES = (RESET_RECONNECT, RESET_WORKSPACE)
+
+BASELINE_ENV = '.rclient_baseline'
+
+# records the current session state in an environment attached to the search path, out of reach of rm(list=ls())
+_RECORD_BASELINE = """
+local({{
+    if ("{env}" %in% search()) detach("{env}", character.only = TRUE)
+    objects <- mget(ls(globalenv(), all.names = TRUE), envir = globalenv())
+    b <- attach(NULL, name = "{env}")
+    assign("objects", objects, envir = b)
+    assign("options", options(), envir = b)
+    assign("search", search(), envir = b)
+    assign("wd", getwd(), envir = b)
+    invisible(NULL)
+}})
+""".format(env=BASELINE_ENV)
+
+_RESTORE_BASELINE = """
+local({{
+    b <- as.environment("{env}")
+    rm(list = ls(globalenv(), all.names = TRUE), envir = globalenv())
+    list2env(get("objects", envir = b), envir = globalenv())
+    for (p in setdiff(search(), get("search", envir = b))) detach(p, character.only = TRUE)
+    if (length(setdiff(get("search", envir = b), search())) > 0) stop("baseline packages were detached")
+    added <- setdiff(names(options()), names(get("options", envir = b)))
+    options(setNames(vector("list", length(added)), added))
+    options(get("options", envir = b))
+    setwd(get("wd", envir = b))
+    invisible(gc())
+    TRUE
+}})
+""".format(env=BASELINE_ENV)
+
+BATCH_VAR = '.rclient_batch'
+
+# evaluates the expressions assigned to BATCH_VAR one by one, catching each one's error.
+# returns list(succeeded, values) where a failed expression's value is its error message.
+_EVAL_MANY = """
+local({{
+    expressions <- get("{var}", envir = globalenv())
+    rm("{var}", envir = globalenv())
+    results <- lapply(expressions, function(e) tryCatch(list(TRUE, eval(parse(text = e), envir = globalenv())),
+                                                        error = function(err) list(FALSE, conditionMessage(err))))
+    list(vapply(results, function(r) r[[1]], logical(1)), lapply(results, function(r) r[[2]]))
+}})
+""".format(var=BATCH_VAR)
+
 
 class PoolEmpty(KeyError):
     pass
@@ -77,110 +159,897 @@ class MethodNotAllowed(BaseException):
     pass
 
 
-def if_pool_is_not_full(wrapped_method):
-    @wraps(wrapped_method)
-    def wrapper(self, *args, **kw):
-        if len(self.pool) < self._pool_size:
-            return wrapped_method(self, *args, **kw)
+class EvalTimeout(Exception):
+    """ an evaluation ran past its timeout, and its R process was killed.
+        not a connection error, so it's never retried.
+    """
+    pass
 
-    return wrapper
+
+def r_pid(conn):
+    """ pid of the forked Rserve child serving a connection """
+    return int(conn.eval('Sys.getpid()'))
+
+
+def kill_r_process(conn, pid):
+    """ kill the Rserve child behind conn, aborting whatever it's evaluating, and close conn.
+        the kill is sent with R's tools::pskill through a new connection, which works whichever host Rserve runs
+        on and as whatever user. if that fails and Rserve is local, we signal the process ourselves.
+    """
+    try:
+        if pid is not None:
+            try:
+                killer = pyRserve.rconn.RConnector(conn.host, conn.port, conn.unix_socket, False, False)
+                try:
+                    killer.voidEval('tools::pskill({}, tools::SIGKILL)'.format(pid))
+                finally:
+                    killer.close()
+            except Exception as e:
+                if not fileio.is_local(conn):
+                    raise
+                logger.info("could not kill R process %s through Rserve, signalling it: %s", pid, e)
+                os.kill(pid, signal.SIGKILL)
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def run_with_timeout(conn, timeout, work):
+    """ run work() with a deadline on conn's socket. past the deadline, kill conn's R process and raise EvalTimeout.
+        the pid of the R process is kept in conn.pid. connections that don't know it yet fetch it before the first
+        timed work.
+
+        :param timeout: seconds, or None to wait forever
+    """
+    if timeout is None or conn.isClosed:
+        # a closed connection raises PyRserveClosed straight away
+        return work()
+    if getattr(conn, 'pid', None) is None:
+        # once the deadline has passed, the socket is busy, so ask now
+        conn.pid = r_pid(conn)
+    conn.sock.settimeout(timeout)
+    try:
+        return work()
+    except socket.timeout:
+        pid = getattr(conn, 'pid', None)
+        logger.warning("evaluation took longer than %ss, killing R process %s", timeout, pid)
+        try:
+            kill_r_process(conn, pid)
+        except Exception as e:
+            logger.error("could not kill R process %s: %s", pid, e)
+        raise EvalTimeout("evaluation took longer than {}s".format(timeout))
+    finally:
+        if not conn.isClosed:
+            conn.sock.settimeout(None)
+
+
+def _run_periodically(pool_ref, method_name, stop, interval):
+    """ maintenance loop for background pool threads.
+        only holds a weak reference to the pool, so the pool can still be garbage collected.
+    """
+    while not stop.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        try:
+            getattr(pool, method_name)()
+        except Exception:
+            logger.exception("pool maintenance failed")
+        del pool
+
+
+def _run_reset_worker(pool_ref, dirty):
+    """ background refill loop: resets dirty connections and returns them to the pool.
+        a None on the queue stops the worker.
+    """
+    while True:
+        c = dirty.get()
+        if c is None:
+            return
+        pool = pool_ref()
+        if pool is None:
+            # the pool is gone. drain the queue up to our stop sentinel.
+            RServeConnection._close_quietly(c)
+            continue
+        pool._recycle(c)
+        del pool
+
+
+def _expression(template_or_fn, item, star=False):
+    """ the R expression for one item of a map """
+    args = tuple(item) if star else (item,)
+    if callable(template_or_fn):
+        return template_or_fn(*args)
+    return template_or_fn.format(*args)
 
 
 class RServeConnection(object):
 
-    def __init__(self, pool_size=1, realtime=False, *cargs, **ckwargs):
+    def __init__(self, pool_size=1, realtime=False, *cargs, blocking_init=True, max_size=None, checkout_timeout=None,
+                 idle_timeout=None, background_reset=True, reset_workers=None,
+                 reset_strategy=RESET_RECONNECT, validate_after=DEFAULT_VALIDATE_AFTER, sweep_interval=None,
+                 retries=DEFAULT_RETRIES, initializer=None, bundle_dir=None, cache=None, eval_timeout=None,
+                 name=None, metrics=None, profiler=None, upload_chunk_size=None, **ckwargs):
         """
         todo: :param model_dir: read-only location where uploads are stored
         todo: in lieu of save_files=False, have a periodic cleanup routine
 
-        fixme: wouldn't it make sense for each model to have its own pool and model directory?
-               then, RServe's tmp directory would truly be isolated tmp.
-               then we could call pool.eval("some r expression") and it would just work.
-               Any setup/teardown R code would need to be called when the connection is made.
-               Such code should be minimal, as it is going to cause latency in getting a pool up, and for overflow connections.
-               We don't need to evaluate multiple expressions, just some 'main' entrypoint to their model.
+        each model should have its own pool and model directory, see registry.ModelRegistry.
+        then, RServe's tmp directory is truly isolated tmp, and pool.eval("some r expression") just works.
+        the initializer is sourced when a connection is made. Such code should be minimal, as it is going to cause
+        latency in getting a pool up, and for overflow connections.
 
         todo: :param constructor: function/class that will return a connection
         :param cargs: args passed to constructor: constructor(*cargs, **ckwargs)
         :param ckwargs: see cargs
-        :param pool_size: minimum number of connections. This is the initial size of the pool
+        :param pool_size: minimum number of connections (min_size). This is the initial size of the pool
         :param realtime: realtime pools will not close connections before returning to pool
 
+        the parameters below are keyword only, so positional arguments after realtime still go to the constructor.
+
+        :param blocking_init: if False, return before the initial connections are open.
+                              callers are served as connections become ready.
+        :param max_size: maximum number of open connections, including checked out ones.
+                         defaults to DEFAULT_MAX_SIZE_SCALE * pool_size
+        :param checkout_timeout: seconds to wait for a connection when the pool is at max_size.
+                                 None waits forever. PoolEmpty is raised on timeout.
+        :param idle_timeout: seconds an idle connection above pool_size is kept before it is closed.
+                             None keeps them forever.
+        :param background_reset: non-realtime pools reset checked in connections on background workers,
+                                 so closing a connection never waits for a new R session.
+                                 a connection only goes back in the pool once its fresh session is ready.
+        :param reset_workers: number of background reset workers. defaults to max_size, so connections checked in
+                              together are reset in parallel rather than one after another.
+        :param reset_strategy: how non-realtime pools clean a connection.
+                               RESET_RECONNECT starts a new R session.
+                               RESET_WORKSPACE clears the global environment and restores the options, attached
+                               packages and objects recorded when the connection was opened, then runs gc.
+                               it falls back to a reconnect if the baseline can't be restored.
+        :param validate_after: ping a connection on checkout if it hasn't been seen alive for this many seconds.
+                               broken connections are discarded and another one is checked out.
+                               None never validates.
+        :param sweep_interval: every sweep_interval seconds, ping idle connections in the background, remove the
+                               broken ones and refill the pool to pool_size. None disables the sweeper.
+        :param retries: how many times eval retries an idempotent expression on a fresh connection
+                        when the connection fails
+        :param initializer: R file sourced in every new R session, relative to bundle_dir if given.
+                            objects it creates are part of the RESET_WORKSPACE baseline.
+        :param bundle_dir: read-only directory holding the model's files, shared by every connection.
+                           R code finds it with getOption("rclient.bundle")
+        :param cache: optional cache.ResultCache for eval results. results are keyed on the expression and the
+                      content of the bundle, initializer and uploads, so changing them invalidates old results.
+        :param eval_timeout: seconds an evaluation may take. past it, the connection's R process is killed, its slot
+                             is refilled in the background, and EvalTimeout is raised. None waits forever.
+        :param name: the pool's label in its metrics
+        :param metrics: metrics.MetricsRegistry recording occupancy, checkout waits, connect and reset times and eval
+                        latency. defaults to metrics.REGISTRY
+        :param profiler: optional profiling.Profiler tracing where each eval's time goes
+        :param upload_chunk_size: bytes per write command when upload streams files to a remote Rserve.
+                                  defaults to fileio.DEFAULT_CHUNK_SIZE. servers with a smaller maxinbuf need
+                                  fileio.chunk_size_for(maxinbuf)
+
         """
 
+        self._closed = True  # until there is something to close, for __del__ if we raise
+
+        if max_size is None:
+            max_size = max(pool_size * DEFAULT_MAX_SIZE_SCALE, 1)
+
+        if pool_size < 0 or max_size < max(pool_size, 1):
+            raise ValueError("need 0 <= pool_size <= max_size and max_size >= 1")
+
+        if reset_strategy not in RESET_STRATEGIES:
+            raise ValueError("reset_strategy must be one of {}".format(RESET_STRATEGIES))
+
         self._cargs = cargs
         self._ckwargs = ckwargs
 
         self._pool_size = pool_size
+        self._max_size = max_size
+        self._checkout_timeout = checkout_timeout
+        self._idle_timeout = idle_timeout
         self._realtime = realtime
+        self._blocking_init = blocking_init
+        self._background_reset = background_reset and not realtime
+        self._reset_workers = max_size if reset_workers is None else reset_workers
+        self._reset_strategy = reset_strategy
+        self._validate_after = validate_after
+        self._sweep_interval = sweep_interval
+        self._retries = retries
+        self._initializer = initializer
+        self._bundle_dir = bundle_dir
+        self._uploads = []  # paths uploaded to every R session
+        self._upload_chunk_size = upload_chunk_size
+        self._prepared = {}  # name -> R source of the prepared functions
+        self._session_steps = []  # step(c) run on every R session after the initializer, in order
+        self._cache = cache
+        self._cache_version = None
+        self._eval_timeout = eval_timeout
+        self._profiler = profiler
+        self._update_cache_version()
+        self._dirty = queue.Queue()
         self.pool = None
+        self._size = 0  # open connections: idle, checked out, or still connecting
+        self._warming = set()
+        self._pool_ready = threading.Condition()
+        self._stop_maintenance = threading.Event()
+        self._closed = False
+        self._waiting = 0  # callers waiting for a connection
+        self.name = name or next(_pool_names)
+        self._metrics = REGISTRY if metrics is None else metrics
+        self._init_metrics()
         self._init_pool()
+        self._start_maintenance()
 
     def __del__(self):
         try:
-            self._close_all()
+            self.close()
         except pyRserve.rexceptions.PyRserveClosed:
             pass
 
-    def eval(self, expression):
+    def close(self):
+        """ stop background work and close idle connections.
+            connections that are checked out are closed when they are checked in.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop_maintenance.set()
+        self._stop_reset_workers()
+        self._close_all()
+        # unless a newer pool with our name has taken the metrics over
+        if self._metrics.gauge('rclient_pool_open_connections', pool=self.name).function is self._m_size:
+            self._metrics.remove(pool=self.name)
+
+    @property
+    def min_size(self):
+        return self._pool_size
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        """ number of open connections, whether idle or checked out """
+        return self._size
+
+    @property
+    def idle(self):
+        """ number of connections waiting in the pool """
+        return len(self.pool)
+
+    @property
+    def in_use(self):
+        """ number of connections checked out, being reset, or still connecting """
+        return self._size - len(self.pool)
+
+    @property
+    def overflow(self):
+        """ number of open connections above pool_size """
+        return max(self._size - self._pool_size, 0)
+
+    @property
+    def waiting(self):
+        """ number of callers waiting for a connection """
+        return self._waiting
+
+    @property
+    def pending_resets(self):
+        """ number of checked in connections waiting for a background reset """
+        return self._dirty.qsize()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def eval(self, expression, idempotent=True, cached=True, timeout=None, columnar=False):
         """ checkout a connection, execute an expression, then close the connection
             connection will check itself back in
+
+            if the connection fails, it's discarded. idempotent expressions are retried on a fresh connection,
+            with backoff so a restarting Rserve has time to come back.
+
+            :param idempotent: False if the expression must not run twice. it then isn't retried or cached.
+            :param cached: False to bypass the pool's result cache for this call
+            :param timeout: overrides the pool's eval_timeout
+            :param columnar: return a data frame as a columnar.Frame of numpy arrays instead of a TaggedList
         """
-        c = self._checkout()
-        retval = c.eval(expression)
-        c.close()
-        return retval
+        if self._profiler is not None:
+            evaluate = partial(self._traced_eval, expression, idempotent, timeout, parse_columnar if columnar else None)
+        elif columnar:
+            evaluate = partial(self._retrying, lambda c: c.eval_columnar(expression), idempotent, timeout)
+        else:
+            evaluate = partial(self._retrying, lambda c: c.eval(expression), idempotent, timeout)
+
+        if self._cache is None or not cached or not idempotent:
+            return evaluate()
+
+        key = (self._cache_version, expression, 'columnar') if columnar else (self._cache_version, expression)
+        hit, result = self._cache.get(key)
+        if not hit:
+            result = evaluate()
+            self._cache.put(key, result)
+        return result
+
+    def _traced_eval(self, expression, idempotent, timeout, parse=None):
+        """ eval, handing a trace of where the time went to the profiler """
+        trace = profiling.Trace(expression, self.name)
+
+        def work(c):
+            trace.mark('checkout')
+            return profiling.traced_eval(c.connection, expression, trace, parse)
+
+        try:
+            return self._retrying(work, idempotent, timeout)
+        except BaseException as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            self._profiler.record(trace)
+
+    def map(self, template_or_fn, iterable, chunksize=1, idempotent=True, workers=None):
+        """ evaluate an expression for each item, spread over the pool's connections
+
+            :param template_or_fn: a format string like 'score({})', or a function returning an R expression
+                                   for an item
+            :param chunksize: items evaluated one after another on a single checkout
+            :param workers: chunks evaluated concurrently. defaults to max_size.
+            :return: list of results, in order
+        """
+        return list(self.imap(template_or_fn, iterable, chunksize, ordered=True, idempotent=idempotent,
+                              workers=workers))
+
+    def starmap(self, template_or_fn, iterable, chunksize=1, idempotent=True, workers=None):
+        """ like map, but each item is a tuple of arguments: template.format(*args) or fn(*args) """
+        expressions = (_expression(template_or_fn, args, star=True) for args in iterable)
+        return list(self._imap(expressions, chunksize, True, idempotent, workers))
+
+    def imap(self, template_or_fn, iterable, chunksize=1, ordered=False, idempotent=True, workers=None):
+        """ like map, but results are yielded as chunks finish, in no particular order unless ordered is True.
+            the iterable is read lazily, and at most 2 * workers chunks are in flight, so memory stays bounded
+            however long it is. an expression that fails raises its REvalError where its result would have been.
+        """
+        expressions = (_expression(template_or_fn, item) for item in iterable)
+        return self._imap(expressions, chunksize, ordered, idempotent, workers)
+
+    def _imap(self, expressions, chunksize, ordered, idempotent, workers):
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        workers = workers or self._max_size
+        chunks = iter(lambda: list(itertools.islice(expressions, chunksize)), [])
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rclient-map')
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(self.eval_many, chunk, idempotent))
+                if len(pending) >= 2 * workers:
+                    yield from self._next_done(pending, ordered)
+            while pending:
+                yield from self._next_done(pending, ordered)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _next_done(pending, ordered):
+        """ wait for a chunk, the oldest one if ordered, and yield its results.
+            an expression that failed raises its REvalError once the results before it have been yielded.
+        """
+        if ordered:
+            done = pending.popleft()
+        else:
+            done = next(as_completed(pending))
+            pending.remove(done)
+        for result in done.result():
+            if isinstance(result, pyRserve.rexceptions.REvalError):
+                raise result
+            yield result
+
+    def eval_many(self, expressions, idempotent=True, timeout=None):
+        """ evaluate a batch of expressions on one connection in a single round trip
+
+            :param timeout: for the whole batch. overrides the pool's eval_timeout
+            :return: list of results, with an REvalError in place of each expression that failed
+        """
+        expressions = list(expressions)
+        return self._retrying(lambda c: c.eval_many(expressions), idempotent, timeout)
+
+    def _retrying(self, work, idempotent, timeout=None):
+        """ run work(connection) on a checked out connection, retrying on a fresh one if it fails.
+            a timeout kills the connection's R process and isn't retried.
+        """
+        if timeout is None:
+            timeout = self._eval_timeout
+        for attempt in itertools.count():
+            try:
+                c = self._checkout()
+                start = time.monotonic()
+                try:
+                    result = run_with_timeout(c.connection, timeout, lambda: work(c))
+                except EvalTimeout:
+                    self._m_eval_timeouts.inc()
+                    c.discard()
+                    self._refill_in_background()
+                    raise
+                except CONNECTION_ERRORS:
+                    c.discard()
+                    raise
+                finally:
+                    c.close()
+                self._m_eval.observe(time.monotonic() - start)
+                return result
+            except CONNECTION_ERRORS as e:
+                self._m_connection_errors.inc()
+                if not idempotent or attempt >= self._retries:
+                    raise
+                self._m_retries.inc()
+                logger.warning("connection failed, retrying: %s", e)
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    def _init_metrics(self):
+        """ register the pool's metrics. gauges are read from the pool when the metrics are collected. """
+        m, pool = self._metrics, self.name
+        self._m_size = weak_attribute(self, 'size')
+        m.gauge('rclient_pool_open_connections', 'open connections, idle or checked out', function=self._m_size,
+                pool=pool)
+        for attr, metric, help in (
+                ('idle', 'rclient_pool_idle_connections', 'connections waiting in the pool'),
+                ('in_use', 'rclient_pool_in_use_connections', 'connections checked out, resetting or connecting'),
+                ('overflow', 'rclient_pool_overflow_connections', 'open connections above pool_size'),
+                ('max_size', 'rclient_pool_max_connections', 'the most connections the pool opens'),
+                ('waiting', 'rclient_pool_waiting_callers', 'callers waiting for a connection'),
+                ('pending_resets', 'rclient_pool_pending_resets', 'connections waiting for a background reset')):
+            m.gauge(metric, help, function=weak_attribute(self, attr), pool=pool)
+
+        self._m_checkouts = m.counter('rclient_pool_checkouts_total', 'connections checked out', pool=pool)
+        self._m_checkout_timeouts = m.counter('rclient_pool_checkout_timeouts_total',
+                                              'checkouts that raised PoolEmpty', pool=pool)
+        self._m_overflow_opened = m.counter('rclient_pool_overflow_opened_total',
+                                            'connections opened above pool_size', pool=pool)
+        self._m_discarded = m.counter('rclient_pool_discarded_total', 'connections closed as broken', pool=pool)
+        self._m_connection_errors = m.counter('rclient_pool_connection_errors_total',
+                                              'evaluations whose connection failed', pool=pool)
+        self._m_retries = m.counter('rclient_pool_retries_total', 'evaluations retried on a fresh connection',
+                                    pool=pool)
+        self._m_eval_timeouts = m.counter('rclient_pool_eval_timeouts_total', 'evaluations killed by their timeout',
+                                          pool=pool)
+        self._m_reset_failures = m.counter('rclient_pool_reset_failures_total', 'connections that failed to reset',
+                                           pool=pool)
+        self._m_checkout_wait = m.histogram('rclient_pool_checkout_wait_seconds',
+                                            'time to check out a connection, including opening one', pool=pool)
+        self._m_connect = m.histogram('rclient_pool_connect_seconds',
+                                      'time to open and prepare a new connection', pool=pool)
+        self._m_reset = m.histogram('rclient_pool_reset_seconds', 'time to reset a checked in connection',
+                                    pool=pool)
+        self._m_eval = m.histogram('rclient_pool_eval_seconds', 'time evaluating on a checked out connection',
+                                   pool=pool)
 
     def _init_pool(self):
-        # todo: can we parallelize this?
-        self.pool = [self._new_connection() for _ in range(self._pool_size)]
+        """ open the initial connections concurrently, so cold start costs the slowest single connect
+            rather than the sum of all of them.
+            if we aren't blocking, connections are added to the pool as they become ready.
+        """
+        self.pool = deque()
+        if self._pool_size < 1:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self._pool_size)
+        futures = [executor.submit(self._new_connection) for _ in range(self._pool_size)]
+        with self._pool_ready:
+            self._size += len(futures)
+            self._warming = set(futures)
+        for f in futures:
+            f.add_done_callback(self._warmed)
+        executor.shutdown(wait=self._blocking_init)
+
+        if self._blocking_init:
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                raise errors[0]
+
+    def _warmed(self, future):
+        """ done callback for warm-up connections. runs in the warm-up thread. """
+        with self._pool_ready:
+            self._warming.discard(future)
+            if future.exception() is None:
+                self._make_idle(future.result())
+            else:
+                self._size -= 1
+                logger.error("could not open pooled connection: %s", future.exception())
+            self._pool_ready.notify()
+
+    def _start_maintenance(self):
+        """ start the background reset workers, and the idle reaper if idle connections should time out """
+        if self._background_reset:
+            for _ in range(self._reset_workers):
+                threading.Thread(target=_run_reset_worker, name="rclient-pool-reset", daemon=True,
+                                 args=(weakref.ref(self), self._dirty)).start()
+
+        if self._idle_timeout is not None:
+            interval = max(self._idle_timeout / 2, MIN_MAINTENANCE_INTERVAL)
+            threading.Thread(target=_run_periodically, name="rclient-pool-reaper", daemon=True,
+                             args=(weakref.ref(self), '_reap_idle', self._stop_maintenance, interval)).start()
+
+        if self._sweep_interval is not None:
+            interval = max(self._sweep_interval, MIN_MAINTENANCE_INTERVAL)
+            threading.Thread(target=_run_periodically, name="rclient-pool-sweeper", daemon=True,
+                             args=(weakref.ref(self), '_sweep', self._stop_maintenance, interval)).start()
+
+    def _stop_reset_workers(self):
+        if self._background_reset:
+            for _ in range(self._reset_workers):
+                self._dirty.put(None)
+
+    def _recycle(self, c):
+        """ reset a dirty connection, then make it available again. runs on a reset worker.
+            connections of a closed pool are closed instead.
+        """
+        if self._closed:
+            self._discard(c)
+            return
+        start = time.monotonic()
+        try:
+            if c.reset(self._reset_strategy):
+                self._prepare_connection(c)
+        except Exception:
+            logger.exception("could not reset connection %s", id(c))
+            self._m_reset_failures.inc()
+            self._discard(c)
+            return
+        self._m_reset.observe(time.monotonic() - start)
+
+        with self._pool_ready:
+            if not self._closed:
+                self._make_idle(c)
+                self._pool_ready.notify()
+                return
+        # the pool was closed while we reset
+        self._discard(c)
+
+    def _reap_idle(self):
+        """ close idle connections above pool_size that have been idle longer than idle_timeout """
+        deadline = time.monotonic() - self._idle_timeout
+        reaped = []
+        with self._pool_ready:
+            # the pool is used LIFO, so the longest idle connections are at the front
+            while self._size > self._pool_size and self.pool and self.pool[0].idle_since < deadline:
+                reaped.append(self.pool.popleft())
+                self._size -= 1
+            if reaped:
+                self._pool_ready.notify(len(reaped))
+        for c in reaped:
+            logger.debug("reaping idle connection %s", id(c))
+            self._close_quietly(c)
+
+    def _sweep(self):
+        """ ping idle connections one at a time, discarding broken ones, then refill the pool to pool_size """
+        with self._pool_ready:
+            idle = list(self.pool)
+        for c in idle:
+            with self._pool_ready:
+                try:
+                    self.pool.remove(c)
+                except ValueError:
+                    continue  # checked out or reaped since we looked
+            if c.ping():
+                with self._pool_ready:
+                    self.pool.appendleft(c)
+                    self._pool_ready.notify()
+            else:
+                logger.info("sweeper removed broken connection %s", id(c))
+                self._discard(c)
+
+        self._refill()
+
+    def ping_time(self):
+        """ time a ping on an idle connection, without checking it out, so it isn't reset afterwards.
+            a broken connection is discarded, and its error raised.
+
+            :return: the round trip in seconds, or None if no connection is idle
+        """
+        with self._pool_ready:
+            if not self.pool:
+                return None
+            # the longest idle, the one least likely to be wanted next
+            c = self.pool.popleft()
+        start = time.monotonic()
+        try:
+            c.eval('TRUE')
+        except BaseException:
+            self._discard(c)
+            raise
+        seconds = time.monotonic() - start
+        c.last_seen = time.monotonic()
+        with self._pool_ready:
+            self.pool.appendleft(c)
+            self._pool_ready.notify()
+        return seconds
+
+    def _refill(self):
+        """ open connections until the pool is back to pool_size """
+        while True:
+            with self._pool_ready:
+                if self._closed or self._warming or self._size >= self._pool_size:
+                    return
+                self._size += 1
+            try:
+                c = self._new_connection()
+            except Exception as e:
+                logger.warning("could not refill pool: %s", e)
+                self._release_slot()
+                return
+            with self._pool_ready:
+                self._make_idle(c)
+                self._pool_ready.notify()
+
+    def _refill_in_background(self):
+        threading.Thread(target=self._refill, name="rclient-pool-refill", daemon=True).start()
 
     def _new_connection(self):
         """ creates the connections for storage in the pool.
             don't use this for interactive connections
         """
-        return _PooledPyRserve(*self._cargs, **self._ckwargs)
+        start = time.monotonic()
+        c = _PooledPyRserve(*self._cargs, **self._ckwargs)
+        self._prepare_connection(c)
+        self._m_connect.observe(time.monotonic() - start)
+        return c
+
+    def _prepare_connection(self, c):
+        """ set up a fresh R session, either new or after a reconnecting reset """
+        if self._bundle_dir is not None:
+            c.voidEval('options(rclient.bundle = {})'.format(r_string(self._bundle_dir)))
+        if self._initializer is not None:
+            path = self._initializer
+            if self._bundle_dir is not None:
+                path = os.path.join(self._bundle_dir, path)
+            c.voidEval('source({}, chdir = TRUE)'.format(r_string(path)))
+        c.steps_done = 0
+        self._catch_up(c, record_baseline=False)
+        if self._reset_strategy == RESET_WORKSPACE:
+            c.record_baseline()
+
+    def _update_cache_version(self):
+        """ key cached results on what the R sessions are running, so old results aren't served after a change """
+        if self._cache is None:
+            return
+        initializer = self._initializer
+        if initializer is not None and self._bundle_dir is not None:
+            initializer = os.path.join(self._bundle_dir, initializer)
+        self._cache_version = content_version(self._bundle_dir, initializer,
+                                              *self._uploads) + repr(sorted(self._prepared.items()))
+
+    def _catch_up(self, c, record_baseline=True):
+        """ run the session steps c's R session hasn't had yet.
+            with RESET_WORKSPACE, the baseline is recorded again so a reset keeps what the steps made.
+        """
+        steps = self._session_steps[c.steps_done:]
+        for step in steps:
+            step(c)
+            c.steps_done += 1
+        if steps and record_baseline and self._reset_strategy == RESET_WORKSPACE:
+            c.record_baseline()
+
+    def _make_idle(self, c):
+        """ put a connection in the pool. call while holding self._pool_ready """
+        c.idle_since = c.last_seen = time.monotonic()
+        self.pool.append(c)
+
+    def _release_slot(self):
+        with self._pool_ready:
+            self._size -= 1
+            self._pool_ready.notify()
+
+    def _discard(self, c):
+        """ close a connection that won't go back in the pool, freeing its slot """
+        self._m_discarded.inc()
+        self._release_slot()
+        self._close_quietly(c)
+
+    def _is_stale(self, c):
+        """ has c been idle long enough that it should be pinged before use? """
+        return self._validate_after is not None and time.monotonic() - c.last_seen > self._validate_after
+
+    @staticmethod
+    def _close_quietly(c):
+        try:
+            c.close()
+        except pyRserve.rexceptions.PyRserveClosed:
+            pass
 
     def _close_all(self):
         """ clean up each connection """
         if self.pool is not None:
-            for c in self.pool:
-                logger.debug("closing ", id(c))
+            with self._pool_ready:
+                idle, self.pool = self.pool, deque()
+                self._size -= len(idle)
+            for c in idle:
+                logger.debug("closing %s", id(c))
                 c.close()
 
-    def _checkout(self):
-        """ pulls a connection from the pool, or creates a new one.
+    def _checkout(self, timeout=None):
+        """ pulls a connection from the pool, or creates a new one if we are below max_size.
+            blocks while the pool is at max_size, raising PoolEmpty after timeout seconds.
             returns an wrapper for the connection which knows how to check itself back in
+
+            :param timeout: overrides the pool's checkout_timeout
         """
-        try:
-            c = self.pool.pop()
-        except IndexError:
-            c = self._new_connection()
-        return _PooledConnectionInteractor(pool=self, connection=c)
+        if timeout is None:
+            timeout = self._checkout_timeout
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        while True:
+            try:
+                c = self._acquire(timeout, deadline)
+            except PoolEmpty:
+                self._m_checkout_timeouts.inc()
+                raise
+            if c is None:
+                if self._size > self._pool_size:
+                    self._m_overflow_opened.inc()
+                try:
+                    c = self._new_connection()
+                except BaseException:
+                    self._release_slot()
+                    raise
+            elif self._is_stale(c) and not c.ping():
+                logger.info("discarding broken connection %s", id(c))
+                self._discard(c)
+                continue
+            elif c.steps_done < len(self._session_steps):
+                try:
+                    self._catch_up(c)
+                except BaseException:
+                    self._discard(c)
+                    raise
+            self._m_checkouts.inc()
+            self._m_checkout_wait.observe(time.monotonic() - start)
+            return _PooledConnectionInteractor(pool=self, connection=c)
+
+    def _acquire(self, timeout, deadline):
+        """ take an idle connection, or reserve a slot for a new one and return None """
+        with self._pool_ready:
+            while True:
+                if self.pool:
+                    return self.pool.pop()
+                if not self._warming and self._size < self._max_size:
+                    # reserve the slot now, connect once we've released the lock
+                    self._size += 1
+                    return None
+                # the pool is warming up or at max_size. wait for a connection to come back.
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolEmpty("no connection available after {}s".format(timeout))
+                self._waiting += 1
+                try:
+                    self._pool_ready.wait(remaining)
+                finally:
+                    self._waiting -= 1
 
     connect = _checkout
 
-    @if_pool_is_not_full
     def _checkin(self, c):
         """ Returns the connection to the pool
-            If pool is full, allow the connection to be garbage collected. (do nothing)
-            If we aren't real-time, reset the connection.
+            If we aren't real-time, reset the connection. With background_reset, the connection is queued as dirty
+            and a reset worker puts it back in the pool once it has a fresh session.
+            Idle connections above pool_size are closed by the reaper after idle_timeout.
+            Connections that were closed underneath us are discarded.
 
         """
 
+        if c.isClosed or self._closed:
+            self._discard(c)
+            return
+
         if self._realtime is False:
-            c.reset()
+            if self._background_reset:
+                self._dirty.put(c)
+            else:
+                self._recycle(c)
+            return
 
-        self.pool.append(c)
+        with self._pool_ready:
+            self._make_idle(c)
+            self._pool_ready.notify()
 
     checkin = _checkin
 
     def terminate(self, c):
-        """kill a connection harshly"""
-        raise NotImplementedError
+        """ kill a checked out connection harshly: its R process is killed, aborting whatever it's evaluating.
+            the slot is freed and the pool refilled in the background.
+
+            :param c: the connection returned by connect()
+        """
+        conn = c.connection
+        if conn is None:
+            return
+        kill_r_process(conn, conn.pid)
+        c.discard()
+        self._refill_in_background()
+
+    def upload(self, archive, unpack=True, chunk_size=None):
+        """ put a file, or an archive's contents, in the working directory of every connection, now and in
+            future R sessions. idle connections get it in parallel, checked out ones on their next checkout.
+            remote Rservers get it streamed through the connection in chunk_size pieces, by default the pool's
+            upload_chunk_size. see fileio.upload_file
+        """
+        if chunk_size is None:
+            chunk_size = self._upload_chunk_size
+
+        def step(c):
+            fileio.upload(c, archive, unpack=unpack, chunk_size=chunk_size)
+
+        self._uploads.append(archive)
+        self._add_session_step(step)
+
+    def prepare(self, name, r_source):
+        """ define an R function on every connection, now and in future R sessions, so it can be called with
+            binary arguments instead of formatting them into R source
+
+            :param r_source: the function, like 'function(x, scale) sum(x) * scale'
+            :return: a python function calling it on the pool
+        """
+        prepared.check_name(name)
 
-    def upload(self, archive):
-        raise NotImplementedError
+        def step(c):
+            prepared.define(c, name, r_source)
+
+        self._prepared[name] = r_source
+        self._add_session_step(step)
+        return partial(self.call, name)
+
+    def call(self, name, *args, **kwargs):
+        """ call a prepared function on a pooled connection. the arguments are sent as binary R objects.
+            like eval, it's retried on a fresh connection if the connection fails.
+        """
+        return self._retrying(lambda c: c.call(name, *args, **kwargs), idempotent=True)
+
+    def stream(self, expression, chunk_size=streaming.DEFAULT_CHUNK_SIZE, as_arrays=False):
+        """ evaluate expression on a pooled connection and yield its value in slices of chunk_size rows or elements.
+            the connection stays checked out until the generator is exhausted or closed. see streaming.stream
+        """
+        c = self._checkout()
+        try:
+            yield from c.stream(expression, chunk_size, as_arrays)
+        except CONNECTION_ERRORS:
+            c.discard()
+            raise
+        finally:
+            c.close()
+
+    def _add_session_step(self, step):
+        """ run step(c) on every R session: idle connections now, in parallel, checked out ones on their next
+            checkout, and new sessions once their initializer has run
+        """
+        with self._pool_ready:
+            self._session_steps.append(step)
+            idle, self.pool = self.pool, deque()
+        self._update_cache_version()
+
+        def catch_up(c):
+            try:
+                self._catch_up(c)
+            except Exception as e:
+                logger.error("could not update connection %s: %s", id(c), e)
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(len(idle), 1)) as executor:
+            updated = list(executor.map(catch_up, idle))
+
+        failed = []
+        with self._pool_ready:
+            for c, ok in zip(idle, updated):
+                if ok:
+                    self.pool.appendleft(c)
+                else:
+                    failed.append(c)
+            self._pool_ready.notify(len(idle))
+        for c in failed:
+            self._discard(c)
 
 RPool = RServeConnection  # For backwards-compatibitily
 
@@ -251,6 +1120,18 @@ class _PooledConnectionInteractor(object):
         self._checkin()
         self._connection = None
 
+    @only_if_open
+    def discard(self):
+        """ drop a broken connection instead of returning it to the pool """
+        try:
+            self.pool._discard(self.connection)
+        except AttributeError:
+            """pool is probably already None"""
+            pass
+
+        self._pool = None
+        self._connection = None
+
     @staticmethod
     def shutdown():
         """ don't allow shutting down of rserve
@@ -264,12 +1145,15 @@ class _PooledPyRserve(pyRserve.rconn.RConnector):
 
         prevents shutting down the R server from an individual connection
 
-        adds the ability to reset the connection, starting a new R interpreter
+        adds the ability to reset the connection, either in place or by starting a new R interpreter
     """
 
     def __init__(self, host='', port=RSERVEPORT, atomicArray=False, defaultVoid=False,
                  oobCallback=_defaultOOBCallback):
         super().__init__(host, port, atomicArray, defaultVoid, oobCallback)
+        self.idle_since = time.monotonic()
+        self.last_seen = time.monotonic()  # when we last knew the connection was alive
+        self.steps_done = 0  # how many of the pool's session steps this R session has had
 
     def __del__(self):
         """ prevent stale RServe handles, since the parent class doesn't do this. """
@@ -278,20 +1162,103 @@ class _PooledPyRserve(pyRserve.rconn.RConnector):
         except pyRserve.rexceptions.PyRserveClosed:
             pass
 
+    def connect(self):
+        """ connect, and fetch the new R process's pid so a timeout or terminate can kill it """
+        super().connect()
+        self.pid = r_pid(self)
+
     @property
     def wd(self):
         return self.r.getwd()
 
-    def reset(self):
-        """ make a new connection
+    def ping(self):
+        """ cheap liveness check
+
+            :return: False if the connection is broken
+        """
+        try:
+            alive = self.eval('TRUE') is True
+        except Exception:
+            return False
+        if alive:
+            self.last_seen = time.monotonic()
+        return alive
+
+    def reset(self, strategy=RESET_RECONNECT):
+        """ clean the R session.
+            RESET_WORKSPACE restores the recorded baseline in place. if that's not possible,
+            or with RESET_RECONNECT, close and make a new connection, starting a new R interpreter.
+
+            :return: True if a new R session was started
         """
+        if strategy == RESET_WORKSPACE and self.restore_baseline():
+            return False
+
         self.close()
         self.connect()
+        return True
 
-    def shutdown(self):
-        """" don't want a connection shutting down the r server. """
-        raise MethodNotAllowed('''Shutting down the R server is not allowed from pooled connections.''')
+    @checkIfClosed
+    def eval_many(self, expressions):
+        """ evaluate a batch of expressions in one round trip. the batch is assigned and evaluated in a single
+            pipelined write, and R evaluates the expressions one after another.
 
+            :return: list of results. an expression that failed has an REvalError in its place, the others
+                     still run.
+        """
+        expressions = [str(e) for e in expressions]
+        if not expressions:
+            return []
+        responses = prepared.pipeline(self, [rAssign(BATCH_VAR, numpy.array(expressions)), rEval(_EVAL_MANY)])
+        for response in responses:
+            if isinstance(response, Exception):
+                raise pyRserve.rexceptions.REvalError(self.eval('geterrmessage()').strip())
+
+        succeeded, values = responses[1]
+        return [value if ok else pyRserve.rexceptions.REvalError(value)
+                for ok, value in zip(numpy.atleast_1d(succeeded), values)]
+
+    @checkIfClosed
+    def call(self, name, *args, **kwargs):
+        """ call a function defined in this R session with binary arguments. see prepared.call """
+        return prepared.call(self, name, *args, **kwargs)
+
+    @checkIfClosed
+    def assign_array(self, name, array):
+        """ assign a numeric numpy array to an R variable, sent straight from its buffer. see arrays.assign_array """
+        arrays.assign_array(self, name, array)
+
+    @checkIfClosed
+    def fetch_array(self, expression):
+        """ evaluate expression into a numpy array, received straight into its buffer. see arrays.fetch_array """
+        return arrays.fetch_array(self, expression)
+
+    @checkIfClosed
+    def eval_columnar(self, expression):
+        """ evaluate expression, returning a data frame as a columnar.Frame. see columnar.eval_columnar """
+        return columnar.eval_columnar(self, expression)
+
+    def stream(self, expression, chunk_size=streaming.DEFAULT_CHUNK_SIZE, as_arrays=False):
+        """ evaluate expression and yield its value in slices of chunk_size rows or elements. see streaming.stream """
+        return streaming.stream(self, expression, chunk_size, as_arrays)
+
+    def record_baseline(self):
+        """ remember global objects, options, attached packages and working directory,
+            so reset(RESET_WORKSPACE) can restore them
+        """
+        self.voidEval(_RECORD_BASELINE)
 
+    def restore_baseline(self):
+        """ return the session to its recorded baseline without reconnecting.
 
+            :return: False if there is no baseline or it couldn't be restored
+        """
+        try:
+            return self.eval(_RESTORE_BASELINE) is True
+        except pyRserve.rexceptions.REvalError as e:
+            logger.info("could not restore baseline, reconnecting: %s", e)
+            return False
 
+    def shutdown(self):
+        """" don't want a connection shutting down the r server. """
+        raise MethodNotAllowed('''Shutting down the R server is not allowed from pooled connections.''')
@@ -0,0 +1,539 @@
+"""
+A fake Rserve that speaks enough QAP1 to exercise the pools without R.
+
+Each connection gets its own session, like the forked R process Rserve gives each client. Sessions understand a
+tiny subset of R: numbers, strings, arithmetic, assignment with <-, simple function definitions, c(), and a handful
+of functions (see FakeRSession.functions). The R snippets rclient itself sends, like the workspace baseline, are
+recognised verbatim and emulated in python. Anything else is an R error, which is reported the way Rserve reports it.
+The file commands (createFile, writeFile, closeFile) write into the session's working directory.
+
+Usage:
+
+with FakeRserve(delay=.01) as server:
+    conn = pyRserve.connect(port=server.port)
+    conn.eval('2 + 2')
+
+or as a separate process:
+
+python -m rclient.fake_rserve --port 6311 --delay .01
+python -m rclient.fake_rserve --conf rserve.conf --pidfile rserve.pid
+
+"""
+
+import argparse
+import ast
+import itertools
+import logging
+import os
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+import numpy
+import pyRserve
+from pyRserve import rtypes
+from pyRserve.rexceptions import EndOfDataError
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rSerializeResponse
+
+from . import connector, fleet, streaming
+from .protocol import HEADER, message_length, read_exactly
+
+__all__ = ['FakeRserve', 'FakeRSession']
+
+logger = logging.getLogger(__name__)
+
+ID_STRING = b'Rsrv0103QAP1\r\n\r\n--------------\r\n'
+
+R_EVAL_ERROR = 127  # the status Rserve reports when R signals an error during eval
+
+_pids = itertools.count(10000)
+
+
+class RError(Exception):
+    """ an error in the fake R code """
+    pass
+
+
+class FakeRSession(object):
+    """ interpreter state for one connection """
+
+    def __init__(self, workdir, scripts=None, kill=None):
+        self.pid = next(_pids)
+        self.killed = threading.Event()
+        self.wd = tempfile.mkdtemp(prefix='conn', dir=workdir)
+        self.variables = {}
+        self.last_error = ''
+        self.baseline = None
+        self.options = {}
+        self.scripts = {
+            connector._RECORD_BASELINE: self._record_baseline,
+            connector._RESTORE_BASELINE: self._restore_baseline,
+            connector._EVAL_MANY: self._eval_many,
+            streaming._DEFINE_SLICE: self._define_slice,
+        }
+        self.scripts.update(scripts or {})
+        self.functions = {
+            'c': lambda *args: numpy.concatenate([numpy.atleast_1d(a) for a in args]) if args else None,
+            'Sys.sleep': self._sleep,
+            'tools::pskill': lambda pid, signal=15: kill(int(pid)) if kill else False,
+            'Sys.getpid': lambda: self.pid,
+            'getwd': lambda: self.wd,
+            'setwd': self._setwd,
+            'geterrmessage': lambda: self.last_error,
+            'numeric': lambda n: numpy.zeros(int(n)),
+            'rnorm': lambda n: numpy.random.standard_normal(int(n)),
+            'seq_len': lambda n: numpy.arange(1, int(n) + 1, dtype=numpy.int32),
+            'length': lambda x: len(numpy.atleast_1d(x)),
+            'NROW': lambda x: len(numpy.atleast_1d(x)),
+            'sum': lambda *args: float(sum(numpy.sum(a) for a in args)),
+            'paste': lambda *args: ' '.join(str(a) for a in args),
+            'identity': lambda x: x,
+            'invisible': lambda x=None: x,
+            'library': lambda *args, **kwargs: None,
+            'source': self._source,
+            'options': self._options,
+            'getOption': lambda name: self.options.get(name),
+            'stop': self._stop,
+            'rm': self._rm,
+            'globalenv': lambda: None,
+            'file.remove': lambda *paths: all([os.remove(self._path(f)) is None for f in paths]),
+            'untar': lambda path, exdir='.': shutil.unpack_archive(self._path(path), self._path(exdir)),
+            'unzip': lambda path, exdir='.': shutil.unpack_archive(self._path(path), self._path(exdir), 'zip'),
+        }
+        self.open_file = None
+
+    def evaluate(self, expression):
+        """ evaluate ;- or newline-separated statements, returning the last value """
+        if expression in self.scripts:
+            return self.scripts[expression]()
+
+        result = None
+        for statement in _split_statements(expression):
+            match = re.match(r'^([A-Za-z.][\w.]*)\s*<-(.*)$', statement, re.S)
+            if match and match.group(2).strip().startswith('function'):
+                result = self.functions[match.group(1)] = self._function(match.group(2))
+            elif match:
+                result = self.variables[match.group(1)] = self._eval_node(_parse(match.group(2)))
+            else:
+                result = self._eval_node(_parse(statement))
+        return result
+
+    def assign(self, name, value):
+        self.variables[name] = value
+
+    def _eval_many(self):
+        succeeded, values = [], []
+        for expression in numpy.atleast_1d(self.variables.pop(connector.BATCH_VAR)):
+            try:
+                values.append(self.evaluate(str(expression)))
+                succeeded.append(True)
+            except Exception as e:
+                values.append(str(e))
+                succeeded.append(False)
+        return [numpy.array(succeeded), values]
+
+    def _function(self, source):
+        """ a closure for 'function(a, b) body'. defaults are ignored. """
+        match = re.match(r'^function\s*\(([^)]*)\)\s*(.*)$', source.strip(), re.S)
+        if not match:
+            raise RError('parse error')
+        params = [p.split('=')[0].strip() for p in match.group(1).split(',') if p.strip()]
+        body = match.group(2).strip()
+        if body.startswith('{') and body.endswith('}'):
+            body = body[1:-1]
+
+        def function(*args, **kwargs):
+            saved = self.variables
+            self.variables = dict(saved, **dict(zip(params, args)), **kwargs)
+            try:
+                return self.evaluate(body)
+            finally:
+                self.variables = saved
+        return function
+
+    def _define_slice(self):
+        def rows(start, end):
+            return numpy.atleast_1d(self.variables[streaming.STREAM_VAR])[int(start) - 1:int(end)]
+        self.functions[streaming.SLICE_FUNCTION] = rows
+
+    def _sleep(self, seconds):
+        # a killed session stops evaluating, like a killed R process
+        if self.killed.wait(seconds):
+            raise ConnectionError('killed')
+
+    def _rm(self, *names, list=(), envir=None):
+        for name in names + tuple(numpy.atleast_1d(list)):
+            self.variables.pop(str(name), None)
+
+    def _record_baseline(self):
+        self.baseline = (dict(self.variables), dict(self.options), self.wd)
+
+    def _restore_baseline(self):
+        if self.baseline is None:
+            raise RError("object '{}' not found".format(connector.BASELINE_ENV))
+        variables, options, self.wd = self.baseline
+        self.variables = dict(variables)
+        self.options = dict(options)
+        return True
+
+    def create_file(self, name):
+        self.close_file()
+        self.open_file = open(self._path(name), 'wb')
+
+    def write_file(self, data):
+        if self.open_file is None:
+            raise RError("no file is open")
+        self.open_file.write(data)
+
+    def close_file(self):
+        if self.open_file is not None:
+            self.open_file.close()
+            self.open_file = None
+
+    def _path(self, path):
+        return os.path.join(self.wd, path)
+
+    def _source(self, path, chdir=False, **kwargs):
+        with open(self._path(path)) as f:
+            self.evaluate(f.read())
+
+    def _options(self, **options):
+        old = dict((k.replace(_DOT, '.'), self.options.get(k.replace(_DOT, '.'))) for k in options)
+        self.options.update((k.replace(_DOT, '.'), v) for k, v in options.items())
+        return old
+
+    def _setwd(self, path):
+        old, self.wd = self.wd, path
+        return old
+
+    @staticmethod
+    def _stop(*message):
+        raise RError(''.join(str(m) for m in message))
+
+    def _eval_node(self, node):
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                return node.value
+            return float(node.value)  # R numbers are doubles
+        if isinstance(node, ast.Name):
+            return self._lookup(_dotted_name(node))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            value = self._eval_node(node.operand)
+            return -value if isinstance(node.op, ast.USub) else value
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            return _BINARY_OPERATORS[type(node.op)](self._eval_node(node.left), self._eval_node(node.right))
+        if isinstance(node, ast.Call):
+            name = _dotted_name(node.func)
+            if name == 'is.function':
+                return _dotted_name(node.args[0]) in self.functions
+            try:
+                function = self.functions[name]
+            except KeyError:
+                raise RError('could not find function "{}"'.format(name))
+            args = [self._eval_node(a) for a in node.args]
+            kwargs = dict((k.arg, self._eval_node(k.value)) for k in node.keywords)
+            return function(*args, **kwargs)
+        raise RError('unsupported expression')
+
+    def _lookup(self, name):
+        constants = {'TRUE': True, 'FALSE': False, 'NULL': None, 'T': True, 'F': False,
+                     'tools::SIGTERM': 15.0, 'tools::SIGKILL': 9.0}
+        if name in constants:
+            return constants[name]
+        try:
+            return self.variables[name]
+        except KeyError:
+            raise RError("object '{}' not found".format(name))
+
+
+_BINARY_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+    ast.Pow: lambda a, b: a ** b,
+}
+
+
+_DOT = '__dot__'  # R names may contain dots, and parts of them may be python keywords (is.function)
+_NS = '__ns__'  # pkg::name
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id.replace(_NS, '::').replace(_DOT, '.')
+    raise RError('unsupported function call')
+
+
+def _parse(source):
+    # mangle dotted names outside of string literals
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', source.strip())
+    parts[::2] = [re.sub(r'(?<=[A-Za-z_])\.(?=[A-Za-z_])|(?<![\w.])\.(?=[A-Za-z_])', _DOT, p) for p in parts[::2]]
+    source = ''.join(parts).replace('::', _NS)
+    try:
+        return ast.parse(source.replace('^', '**'), mode='eval').body
+    except SyntaxError:
+        raise RError('parse error')
+
+
+def _split_statements(expression):
+    """ split on ; and newlines that aren't inside brackets or strings """
+    statements, current, depth, quote = [], [], 0, None
+    for ch in expression:
+        if quote:
+            quote = None if ch == quote else quote
+        elif ch in '"\'':
+            quote = ch
+        elif ch in '([{':
+            depth += 1
+        elif ch in ')]}':
+            depth -= 1
+        elif ch in ';\n' and depth == 0:
+            statements.append(''.join(current))
+            current = []
+            continue
+        current.append(ch)
+    statements.append(''.join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def _read_parameters(body):
+    """ split a QAP1 message body into its (type, payload) parameters """
+    params, pos = [], 0
+    while pos < len(body):
+        code = body[pos]
+        if code & rtypes.DT_LARGE:
+            length = int.from_bytes(body[pos + 1:pos + 8], 'little')
+            pos += 8
+        else:
+            length = int.from_bytes(body[pos + 1:pos + 4], 'little')
+            pos += 4
+        params.append((code & ~rtypes.DT_LARGE, body[pos:pos + length]))
+        pos += length
+    return params
+
+
+def _string_parameter(payload):
+    return payload.split(b'\0', 1)[0].decode('utf-8')
+
+
+def _sexp_parameter(payload):
+    """ decode a DT_SEXP parameter with pyRserve's own parser """
+    dt_header = struct.pack('<BQ', rtypes.DT_SEXP | rtypes.DT_LARGE, len(payload))[:8]
+    message = dt_header + payload
+    return rparse(HEADER.pack(rtypes.RESP_OK, len(message), 0, 0) + message)
+
+
+def _ok(body=b''):
+    return HEADER.pack(rtypes.RESP_OK, len(body), 0, 0) + body
+
+
+def _error(code):
+    return HEADER.pack(rtypes.RESP_ERR | (code << 24), 0, 0, 0)
+
+
+class _FakeRserveHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.session = FakeRSession(self.server.workdir, self.server.scripts, kill=self.server.kill)
+        self.server.preload_into(self.session)
+        self.server.track(self.request, self.session)
+
+    def finish(self):
+        self.session.close_file()
+        self.server.untrack(self.request)
+
+    def handle(self):
+        self.request.sendall(ID_STRING)
+        while True:
+            try:
+                header = read_exactly(self.request, HEADER.size)
+                command, length = HEADER.unpack(header)[0], message_length(header)
+                body = bytes(read_exactly(self.request, length))
+            except (EndOfDataError, OSError):
+                return
+            if self.server.maxinbuf is not None and length > self.server.maxinbuf:
+                self.request.sendall(_error(rtypes.ERR_data_overflow))
+                continue
+            try:
+                response = self.respond(command, _read_parameters(body))
+            except ConnectionError:
+                return
+            if response is None:
+                return
+            try:
+                self.request.sendall(response)
+            except OSError:
+                return
+
+    def respond(self, command, params):
+        """ handle one command. returning None closes the connection """
+        if command in (rtypes.CMD_eval, rtypes.CMD_voidEval):
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            try:
+                result = self.session.evaluate(_string_parameter(params[0][1]))
+            except Exception as e:
+                self.session.last_error = 'Error: {}\n'.format(e)
+                return _error(R_EVAL_ERROR)
+            if command == rtypes.CMD_voidEval:
+                return _ok()
+            return rSerializeResponse(result)
+
+        if command in (rtypes.CMD_setSEXP, rtypes.CMD_assignSEXP):
+            self.session.assign(_string_parameter(params[0][1]), _sexp_parameter(params[1][1]))
+            return _ok()
+
+        if command in (rtypes.CMD_createFile, rtypes.CMD_writeFile, rtypes.CMD_closeFile):
+            try:
+                if command == rtypes.CMD_createFile:
+                    self.session.create_file(_string_parameter(params[0][1]))
+                elif command == rtypes.CMD_writeFile:
+                    self.session.write_file(params[0][1])
+                else:
+                    self.session.close_file()
+            except (OSError, RError):
+                return _error(rtypes.ERR_IOerror)
+            return _ok()
+
+        if command == rtypes.CMD_shutdown:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return None
+
+        return _error(rtypes.ERR_unknownCmd)
+
+
+class FakeRserve(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ a threaded fake Rserve. port=0 picks a free port.
+
+        :param delay: seconds of simulated compute added to every eval
+        :param workdir: parent directory for session working directories
+        :param scripts: {r source: python callable} emulating R code the fake interpreter can't run
+        :param maxinbuf: largest message in bytes the server accepts, like Rserve's maxinbuf. None for no limit.
+        :param preload: [('source', path) or ('eval', expression), ...] server-level code, like Rserve's config.
+                        it is replayed in each new session, standing in for the state a forked session inherits.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, host='localhost', port=0, delay=0, workdir=None, scripts=None, maxinbuf=None, preload=()):
+        super().__init__((host, port), _FakeRserveHandler)
+        self.delay = delay
+        self.maxinbuf = maxinbuf
+        self.preload = list(preload)
+        self.scripts = scripts
+        self.workdir = workdir or tempfile.mkdtemp(prefix='fake_rserve')
+        self._connections = {}  # socket -> session
+        self._connections_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def preload_into(self, session):
+        for key, value in self.preload:
+            if key == 'source':
+                session._source(value)
+            else:
+                session.evaluate(value)
+
+    def track(self, sock, session):
+        with self._connections_lock:
+            self._connections[sock] = session
+
+    def untrack(self, sock):
+        with self._connections_lock:
+            self._connections.pop(sock, None)
+
+    def kill(self, pid):
+        """ kill the session with this pid, like killing a forked Rserve child """
+        with self._connections_lock:
+            victims = [(sock, s) for sock, s in self._connections.items() if s.pid == pid]
+        for sock, session in victims:
+            session.killed.set()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return bool(victims)
+
+    def start(self):
+        """ serve on a background thread """
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-rserve", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ stop accepting connections and drop the ones we have, like a killed Rserve """
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, {}
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--delay', type=float, default=0, help='seconds of simulated compute per eval')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--conf', default=None, help='Rserve config to take port, workdir and maxinbuf from')
+    parser.add_argument('--pidfile', default=None)
+    args = parser.parse_args(argv)
+
+    settings = fleet.read_config(args.conf) if args.conf else []
+    conf = dict(settings)
+    port = args.port or int(conf.get('port', pyRserve.rconn.RSERVEPORT))
+    workdir = args.workdir or conf.get('workdir')
+    if workdir:
+        os.makedirs(workdir, exist_ok=True)
+    maxinbuf = int(conf['maxinbuf']) * 1024 if int(conf.get('maxinbuf', 0)) else None
+
+    preload = [(key, value) for key, value in settings if key in ('source', 'eval')]
+    server = FakeRserve(args.host, port, delay=args.delay, workdir=workdir, maxinbuf=maxinbuf, preload=preload)
+    if args.pidfile:
+        with open(args.pidfile, 'w') as f:
+            f.write('{}\n'.format(os.getpid()))
+    print("fake Rserve listening on {}:{}".format(server.host, server.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.pidfile:
+            try:
+                os.remove(args.pidfile)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    main()
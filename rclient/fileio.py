@@ -0,0 +1,169 @@
+"""
+Upload files through Rserve's own file commands, so Rserve doesn't have to share our filesystem.
+
+Files are streamed in chunks from a single reused buffer, so memory use stays flat whatever the file size.
+Chunks are DEFAULT_CHUNK_SIZE unless told otherwise. For a server whose maxinbuf is smaller, pass
+chunk_size=chunk_size_for(maxinbuf), reading the limit once, e.g. with read_maxinbuf from that server's config.
+Rserve must have fileio enabled, which is its default.
+
+Usage:
+
+conn = pyRserve.connect(host='r-host')
+upload_file(conn, 'big_text.txt')
+upload_archive(conn, 'mybundle.tar.gz')  # unpacked into the session's working directory
+upload_file(conn, 'big_text.txt', chunk_size=chunk_size_for(64 * 1024))  # a server with maxinbuf 64
+
+upload_to_all(connections, ['WordCount.R', 'big_text.txt'])
+"""
+
+import logging
+import os
+import re
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from pyRserve import rtypes
+from pyRserve.rparser import rparse
+
+from . import staging
+from .protocol import HEADER, qap_string, r_string
+
+__all__ = ['upload_file', 'upload_archive', 'upload_to_all', 'upload', 'is_local', 'read_maxinbuf', 'chunk_size_for']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DATA_HEADER_SIZE = 8  # large data headers: type byte and 7 length bytes
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+# R code unpacking an uploaded archive in the working directory, by extension
+_UNPACK = (
+    (re.compile(r'\.zip$'), 'unzip({name}, exdir = "."); invisible(file.remove({name}))'),
+    (re.compile(r'\.(tar|tar\.gz|tgz|tar\.bz2|tbz2|tar\.xz|txz)$'),
+     'untar({name}, exdir = "."); invisible(file.remove({name}))'),
+)
+
+
+def read_maxinbuf(conf):
+    """ Rserve's maxinbuf from its config file, in bytes. None if the file can't be read or doesn't set it. """
+    try:
+        with open(conf) as f:
+            for line in f:
+                match = re.match(r'^\s*maxinbuf\s+(\d+)', line)
+                if match:
+                    return int(match.group(1)) * 1024  # the config is in kb
+    except OSError:
+        pass
+    return None
+
+
+def chunk_size_for(maxinbuf=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ the largest chunk no bigger than chunk_size whose message fits in maxinbuf """
+    if maxinbuf:
+        chunk_size = min(chunk_size, maxinbuf - HEADER.size - DATA_HEADER_SIZE)
+    if chunk_size <= 0:
+        raise ValueError("maxinbuf is too small to upload anything")
+    return chunk_size
+
+
+def is_local(conn):
+    """ does this pyRserve connection's server share our filesystem? """
+    if getattr(conn, 'unix_socket', None):
+        return True
+    return conn.host in LOCAL_HOSTS or conn.host == socket.gethostname()
+
+
+def upload_file(conn, path, remote_name=None, chunk_size=None):
+    """ stream a file into the connection's working directory
+
+        :param conn: pyRserve connection. it must not be used by anyone else during the upload.
+        :param remote_name: file name on the server, defaults to the local base name
+        :param chunk_size: bytes per write command. defaults to DEFAULT_CHUNK_SIZE.
+                           see chunk_size_for for servers with a smaller maxinbuf.
+    """
+    if remote_name is None:
+        remote_name = os.path.basename(path)
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    _command(conn.sock, rtypes.CMD_createFile, rtypes.DT_STRING, qap_string(remote_name))
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                _command(conn.sock, rtypes.CMD_writeFile, rtypes.DT_BYTESTREAM, view[:n])
+    finally:
+        _command(conn.sock, rtypes.CMD_closeFile)
+    logger.debug("uploaded %s to %s as %s", path, conn, remote_name)
+    return remote_name
+
+
+def upload_archive(conn, path, chunk_size=None):
+    """ upload an archive and unpack it in the connection's working directory.
+        files that aren't zip or tar archives are uploaded as they are.
+    """
+    name = upload_file(conn, path, chunk_size=chunk_size)
+    for pattern, code in _UNPACK:
+        if pattern.search(name):
+            conn.voidEval(code.format(name=r_string(name)))
+            break
+    return name
+
+
+def upload(conn, path, local_dir=None, unpack=False, chunk_size=None):
+    """ put a file in the connection's working directory by whichever way works for this server:
+        linked from the staging cache when Rserve is local, uploaded through Rserve otherwise.
+
+        :param local_dir: the working directory, if already known
+        :param unpack: unpack archives
+    """
+    if is_local(conn):
+        if local_dir is None:
+            local_dir = conn.eval('getwd()')
+        return staging.default_cache().link_into(path, local_dir, unpack=unpack)
+    if unpack:
+        return upload_archive(conn, path, chunk_size=chunk_size)
+    return upload_file(conn, path, chunk_size=chunk_size)
+
+
+def upload_to_all(connections, paths, unpack=False, chunk_size=None, max_workers=None):
+    """ upload files to several connections in parallel. each connection gets its files one after another.
+
+        :return: list of exceptions, one per connection, None where the upload succeeded
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    connections = list(connections)
+    if not connections:
+        return []
+
+    def upload_all(conn):
+        try:
+            for path in paths:
+                upload(conn, path, unpack=unpack, chunk_size=chunk_size)
+        except Exception as e:
+            logger.error("upload to %s failed: %s", conn, e)
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(connections)) as executor:
+        return list(executor.map(upload_all, connections))
+
+
+def _command(sock, command, data_type=None, payload=b''):
+    """ send a command with at most one parameter and wait for Rserve's answer.
+        the payload is sent straight from the caller's buffer.
+    """
+    if data_type is None:
+        sock.sendall(HEADER.pack(command, 0, 0, 0))
+    else:
+        length = DATA_HEADER_SIZE + len(payload)
+        data_header = struct.pack('<BQ', data_type | rtypes.DT_LARGE, len(payload))[:DATA_HEADER_SIZE]
+        sock.sendall(HEADER.pack(command, length & 0xffffffff, 0, length >> 32) + data_header)
+        sock.sendall(payload)
+    # a bare RESP_OK parses to None. errors are raised.
+    rparse(sock)
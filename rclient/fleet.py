@@ -0,0 +1,421 @@
+"""
+A supervised fleet of local Rserve daemons.
+
+rserve_init.sh starts a single Rserve, and a single Rserve is a single accept loop, a single working directory and a
+single point of failure. A fleet starts several daemons on consecutive ports, each with its own working directory,
+pidfile and a config generated from rserve.conf. A monitor thread restarts daemons that die. The fleet's endpoints
+go straight into a MultiHostPool, which spreads connections, and with them the forked R sessions, over the daemons.
+
+Usage:
+
+with RserveFleet(daemons=4, base_port=6311, conf='rserve.conf') as fleet:
+    pool = fleet.pool(pool_size=2)
+    pool.eval('some r code')
+    fleet.status()
+
+Packages and scripts every session needs can be preloaded by the daemons themselves. Rserve forks each session from
+the daemon, so the sessions start with them loaded, sharing the memory copy-on-write:
+
+fleet = RserveFleet(daemons=4, preload=Preload(packages=['data.table'], scripts=['/models/wordcount/model.R']))
+
+or from the command line, until interrupted:
+
+python -m rclient.fleet --daemons 4 --base-port 6311
+"""
+
+import argparse
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+from . import connector
+from .multihost import MultiHostPool
+
+__all__ = ['RserveFleet', 'RserveDaemon', 'Preload', 'read_config', 'write_config', 'RSERVE_COMMAND',
+           'FAKE_RSERVE_COMMAND']
+
+logger = logging.getLogger(__name__)
+
+# the command rserve_init.sh runs. {conf} and {pidfile} are filled in per daemon.
+RSERVE_COMMAND = ('R', 'CMD', 'Rserve', '--vanilla', '--slave', '--RS-conf', '{conf}', '--RS-pidfile', '{pidfile}')
+# the fake server, for trying a fleet out without R
+FAKE_RSERVE_COMMAND = (sys.executable, '-m', 'rclient.fake_rserve', '--conf', '{conf}', '--pidfile', '{pidfile}')
+
+DEFAULT_CHECK_INTERVAL = 1
+DEFAULT_START_TIMEOUT = 30
+DEFAULT_STOP_TIMEOUT = 10
+MAX_RESTART_DELAY = 60
+STARTUP_GRACE = 5  # seconds a daemonized Rserve may take to write its pidfile
+
+
+def read_config(path):
+    """ the settings in an Rserve config file, as [(key, value), ...] in file order. keys can repeat. """
+    settings = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition(' ')
+            settings.append((key, value.strip()))
+    return settings
+
+
+def write_config(path, template=None, extra=(), **settings):
+    """ write an Rserve config: the template's lines, with the given keys replaced.
+        a list value writes the key once per item, e.g. source=['a.R', 'b.R']. None drops the key.
+
+        :param extra: more (key, value) settings, written last and in order. keys can repeat.
+    """
+    lines = []
+    if template is not None:
+        with open(template) as f:
+            for line in f:
+                match = re.match(r'^\s*(\w+)', line)
+                if match and match.group(1) in settings:
+                    continue
+                lines.append(line.rstrip('\n'))
+    for key, value in settings.items():
+        if value is None:
+            continue
+        for v in value if isinstance(value, (list, tuple)) else [value]:
+            lines.append('{} {}'.format(key, v))
+    lines.extend('{} {}'.format(key, value) for key, value in extra)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+    return path
+
+
+class Preload(object):
+    """ R code a daemon runs once when it starts, before it forks any session: Rserve's server-level config
+
+        :param packages: packages to attach
+        :param scripts: R files to source, relative to base_dir unless absolute
+        :param expressions: R expressions to evaluate, each on one line
+        :param base_dir: directory the scripts are relative to
+    """
+
+    def __init__(self, packages=(), scripts=(), expressions=(), base_dir=None):
+        if isinstance(packages, str):
+            packages = [packages]
+        if isinstance(scripts, str):
+            scripts = [scripts]
+        if isinstance(expressions, str):
+            expressions = [expressions]
+
+        self.packages = tuple(packages)
+        self.scripts = tuple(scripts)
+        self.expressions = tuple(expressions)
+        self.base_dir = base_dir
+
+    def __repr__(self):
+        return '<Preload packages={} scripts={}>'.format(list(self.packages), list(self.scripts))
+
+    def __bool__(self):
+        return bool(self.packages or self.scripts or self.expressions)
+
+    def relative_to(self, base_dir):
+        """ the same preload, with relative scripts resolved against base_dir """
+        return Preload(self.packages, self.scripts, self.expressions, base_dir)
+
+    def config(self):
+        """ [(key, value), ...] of Rserve config lines: packages, then scripts, then expressions """
+        lines = [('eval', 'library("{}")'.format(p)) for p in self.packages]
+        for script in self.scripts:
+            if self.base_dir is not None:
+                script = os.path.join(self.base_dir, script)
+            lines.append(('source', os.path.abspath(script)))
+        for expression in self.expressions:
+            if '\n' in expression:
+                raise ValueError("config lines can't hold multi-line expressions, put them in a script")
+            lines.append(('eval', expression))
+        return lines
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RserveDaemon(object):
+    """ one Rserve daemon of a fleet, with its own directory holding its config, pidfile, log and working directory
+
+        :param port: port the daemon listens on
+        :param run_dir: the daemon's directory
+        :param template: Rserve config the daemon's config is generated from
+        :param command: the command starting the daemon. see RSERVE_COMMAND.
+        :param config: more settings for the generated config
+        :param preload: Preload the daemon runs when it starts
+        :param env: environment variables for the daemon, on top of this process's
+    """
+
+    def __init__(self, port, run_dir, template=None, command=RSERVE_COMMAND, host='localhost', config=None,
+                 preload=None, env=None):
+        self.host = host
+        self.port = port
+        self.run_dir = run_dir
+        self.template = template
+        self.command = command
+        self.config = dict(config or {})
+        self.preload = preload
+        self.env = dict(env or {})
+
+        self.conf = os.path.join(run_dir, 'rserve.conf')
+        self.pidfile = os.path.join(run_dir, 'rserve.pid')
+        self.log = os.path.join(run_dir, 'rserve.log')
+        self.workdir = os.path.join(run_dir, 'work')
+
+        self.restarts = 0
+        self.started_at = None
+        self._process = None
+
+    def __repr__(self):
+        return '<RserveDaemon {}:{}>'.format(self.host, self.port)
+
+    @property
+    def endpoint(self):
+        return self.host, self.port
+
+    @property
+    def pid(self):
+        """ the daemon's pid from its pidfile. None before it has written one. """
+        try:
+            with open(self.pidfile) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def alive(self):
+        """ is the daemon, or the command still starting it, running? """
+        # poll also reaps the command, which exits as soon as a real Rserve has daemonized
+        starting = self._process is not None and self._process.poll() is None
+        pid = self.pid
+        if pid is None:
+            daemonizing = (self._process is not None and self._process.returncode == 0 and
+                           time.monotonic() - self.started_at < STARTUP_GRACE)
+            return starting or daemonizing
+        if self._process is not None and pid == self._process.pid:
+            return starting
+        return _pid_alive(pid)
+
+    def ready(self, timeout=1):
+        """ does the daemon accept connections? """
+        try:
+            socket.create_connection(self.endpoint, timeout=timeout).close()
+        except OSError:
+            return False
+        return True
+
+    def start(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        write_config(self.conf, self.template, self.preload.config() if self.preload else (),
+                     port=self.port, workdir=self.workdir, socket=None, **self.config)
+        try:
+            os.remove(self.pidfile)
+        except FileNotFoundError:
+            pass
+
+        args = [a.format(conf=self.conf, pidfile=self.pidfile, port=self.port, workdir=self.workdir)
+                for a in self.command]
+        env = dict(os.environ, **self.env) if self.env else None
+        with open(self.log, 'ab') as log:
+            self._process = subprocess.Popen(args, cwd=self.run_dir, stdin=subprocess.DEVNULL, stdout=log,
+                                             stderr=subprocess.STDOUT, start_new_session=True, env=env)
+        self.started_at = time.monotonic()
+        logger.info("started %s", self)
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        """ SIGTERM the daemon, like rserve_init.sh stop, then SIGKILL it if it doesn't go within timeout """
+        pids = {p for p in (self.pid, self._process and self._process.pid) if p is not None}
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + timeout
+        while self.alive() and time.monotonic() < deadline:
+            time.sleep(.05)
+        if self.alive():
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        if self._process is not None:
+            self._process.wait()
+        try:
+            os.remove(self.pidfile)
+        except FileNotFoundError:
+            pass
+        logger.info("stopped %s", self)
+
+
+class RserveFleet(object):
+    """ starts, monitors and restarts several local Rserve daemons
+
+        :param daemons: how many daemons. defaults to one per cpu.
+        :param base_port: the first daemon's port. the others get the following ports.
+        :param conf: Rserve config each daemon's config is generated from. its port, workdir and socket are replaced.
+        :param run_dir: where the daemons' directories go. defaults to a new temporary directory, removed on stop.
+        :param command: the command starting a daemon. see RSERVE_COMMAND and FAKE_RSERVE_COMMAND.
+        :param check_interval: how often the monitor checks on the daemons
+        :param start_timeout: seconds start waits for the daemons to accept connections
+        :param config: more settings for every daemon's config
+        :param preload: Preload every daemon runs when it starts, so every session starts with it loaded
+        :param env: environment variables for the daemons, on top of this process's
+    """
+
+    def __init__(self, daemons=None, base_port=connector.RSERVEPORT, conf='rserve.conf', run_dir=None,
+                 command=RSERVE_COMMAND, host='localhost', check_interval=DEFAULT_CHECK_INTERVAL,
+                 start_timeout=DEFAULT_START_TIMEOUT, config=None, preload=None, env=None):
+        daemons = daemons or os.cpu_count() or 1
+        template = conf if conf is not None and os.path.exists(conf) else None
+        if conf is not None and template is None:
+            logger.warning("%s not found, the daemons get a minimal config", conf)
+
+        self._own_run_dir = run_dir is None
+        self.run_dir = run_dir or tempfile.mkdtemp(prefix='rserve-fleet')
+        self.daemons = [RserveDaemon(base_port + i, os.path.join(self.run_dir, str(base_port + i)), template,
+                                     command, host, config, preload, env)
+                        for i in range(daemons)]
+
+        self._check_interval = check_interval
+        self._start_timeout = start_timeout
+        self._restart_at = {}  # daemon -> when to try restarting it
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self, wait=True):
+        """ start every daemon and the monitor
+
+            :param wait: wait until every daemon accepts connections. raises TimeoutError if they don't in time.
+                         the daemons started so far are stopped again if one fails to start or isn't ready in time.
+        """
+        self._running = True
+        self._stop.clear()
+        try:
+            for d in self.daemons:
+                d.start()
+            threading.Thread(target=connector._run_periodically, name="rclient-fleet-monitor", daemon=True,
+                             args=(weakref.ref(self), '_check', self._stop, self._check_interval)).start()
+            if wait:
+                self.wait_ready(self._start_timeout)
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def wait_ready(self, timeout=DEFAULT_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        waiting = list(self.daemons)
+        while waiting:
+            waiting = [d for d in waiting if not d.ready()]
+            if not waiting:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError("{} didn't start, see their rserve.log".format(waiting))
+            time.sleep(.05)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._stop.set()
+        with self._lock:
+            for d in self.daemons:
+                d.stop()
+        if self._own_run_dir:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def endpoints(self):
+        """ [(host, port), ...] of the daemons """
+        return [d.endpoint for d in self.daemons]
+
+    def pool(self, **kwargs):
+        """ a MultiHostPool over the fleet. see MultiHostPool for the arguments """
+        return MultiHostPool(self.endpoints(), **kwargs)
+
+    def status(self):
+        """ per daemon: port, pid, whether it's alive and how often it was restarted """
+        return [{
+            'host': d.host,
+            'port': d.port,
+            'pid': d.pid,
+            'alive': d.alive(),
+            'restarts': d.restarts,
+        } for d in self.daemons]
+
+    def _check(self):
+        """ restart dead daemons. a daemon that keeps dying is restarted with an increasing delay. """
+        with self._lock:
+            if not self._running:
+                return
+            now = time.monotonic()
+            for d in self.daemons:
+                if d.alive():
+                    continue
+                restart_at = self._restart_at.get(d)
+                if restart_at is None:
+                    # quick deaths back off, a daemon that ran for a while is restarted right away
+                    uptime = now - (d.started_at or now)
+                    delay = 0 if uptime > MAX_RESTART_DELAY else min(2 ** d.restarts, MAX_RESTART_DELAY)
+                    logger.warning("%s died, restarting in %ss", d, delay)
+                    self._restart_at[d] = restart_at = now + delay
+                if restart_at <= now:
+                    del self._restart_at[d]
+                    d.restarts += 1
+                    try:
+                        d.start()
+                    except OSError:
+                        logger.exception("couldn't restart %s", d)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--daemons', type=int, default=None, help='defaults to one per cpu')
+    parser.add_argument('--base-port', type=int, default=connector.RSERVEPORT)
+    parser.add_argument('--conf', default='rserve.conf')
+    parser.add_argument('--run-dir', default=None)
+    parser.add_argument('--fake', action='store_true', help='run the fake Rserve instead of R')
+    args = parser.parse_args(argv)
+
+    fleet = RserveFleet(args.daemons, args.base_port, args.conf, args.run_dir,
+                        command=FAKE_RSERVE_COMMAND if args.fake else RSERVE_COMMAND)
+    fleet.start()
+    print("Rserve fleet on ports {}".format(', '.join(str(port) for _, port in fleet.endpoints())), flush=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+Counters, gauges and latency histograms for the pools and executors.
+
+Every pool records into a MetricsRegistry, the module's REGISTRY unless given another one, labelled with the pool's
+name. Recording is a lock and an add, and a histogram finds its bucket by bisection, so it's cheap enough for every
+evaluation. Gauges like pool occupancy are read from the pool when a snapshot is taken.
+
+Usage:
+
+pool = RServeConnection(pool_size=4, name='wordcount')
+...
+REGISTRY.snapshot()['rclient_pool_eval_seconds']
+REGISTRY.histogram('rclient_pool_eval_seconds', pool='wordcount').quantile(.99)
+print(REGISTRY.exposition())  # Prometheus text format
+
+start_http_server(9100)  # serve the exposition for scraping
+"""
+
+import bisect
+import math
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['MetricsRegistry', 'Counter', 'Gauge', 'Histogram', 'ExecutorMetrics', 'REGISTRY', 'start_http_server',
+           'weak_attribute']
+
+# seconds. evaluations range from sub-millisecond round trips to minutes of model fitting.
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """ a count that only goes up """
+
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class Gauge(object):
+    """ a value that goes up and down. with a function, the value is function() at collection time. """
+
+    type = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def collect(self):
+        """ the value. None if the function's object is gone. """
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram(object):
+    """ observations counted in buckets by upper bound, plus their sum
+
+        :param buckets: increasing upper bounds. a last +Inf bucket is always added.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def collect(self):
+        """ {'buckets': [(upper bound, cumulative count), ...], 'sum': ..., 'count': ...} """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative, buckets = 0, []
+        for bound, n in zip(self.bounds + (math.inf,), counts):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': total, 'count': cumulative}
+
+    def quantile(self, q):
+        """ estimate the q quantile, interpolating within its bucket. None without observations. """
+        collected = self.collect()
+        if not collected['count']:
+            return None
+        rank = q * collected['count']
+        lower, below = 0.0, 0
+        for bound, cumulative in collected['buckets']:
+            if cumulative >= rank:
+                if math.isinf(bound):
+                    return lower
+                in_bucket = cumulative - below
+                return lower + (bound - lower) * ((rank - below) / in_bucket if in_bucket else 0)
+            lower, below = bound, cumulative
+        return lower
+
+
+_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+class _Family(object):
+
+    __slots__ = ('name', 'type', 'help', 'children')
+
+    def __init__(self, name, type, help):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.children = {}  # sorted label items -> metric
+
+
+class MetricsRegistry(object):
+    """ metrics by name and labels. asking for a metric that exists returns it, so pools can share a registry. """
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help='', **labels):
+        return self._metric(name, 'counter', help, labels)
+
+    def gauge(self, name, help='', function=None, **labels):
+        """ :param function: read the value from function() when collecting, see weak_attribute """
+        gauge = self._metric(name, 'gauge', help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._metric(name, 'histogram', help, labels, buckets)
+
+    def remove(self, **labels):
+        """ drop every metric with these labels, e.g. a closed pool's """
+        match = set((k, str(v)) for k, v in labels.items())
+        with self._lock:
+            for family in self._families.values():
+                for key in [k for k in family.children if match.issubset(k)]:
+                    del family.children[key]
+
+    def snapshot(self):
+        """ {name: {'type': ..., 'help': ..., 'samples': [(labels, value), ...]}}.
+            histogram values are dicts, see Histogram.collect.
+        """
+        with self._lock:
+            families = [(f, list(f.children.items())) for f in self._families.values()]
+        snapshot = {}
+        for family, children in families:
+            samples = []
+            for key, metric in children:
+                value = metric.collect()
+                if value is not None:
+                    samples.append((dict(key), value))
+            snapshot[family.name] = {'type': family.type, 'help': family.help, 'samples': samples}
+        return snapshot
+
+    def exposition(self):
+        """ the metrics in Prometheus' text format """
+        lines = []
+        for name, family in sorted(self.snapshot().items()):
+            lines.append('# HELP {} {}'.format(name, family['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(name, family['type']))
+            for labels, value in family['samples']:
+                if family['type'] != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                    continue
+                for bound, cumulative in value['buckets']:
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=_number(bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value['sum'])))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _metric(self, name, type, help, labels, *args):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, type, help)
+            elif family.type != type:
+                raise ValueError("{} is a {}, not a {}".format(name, family.type, type))
+            metric = family.children.get(key)
+            if metric is None:
+                metric = family.children[key] = _TYPES[type](*args)
+            return metric
+
+
+REGISTRY = MetricsRegistry()
+
+
+class ExecutorMetrics(object):
+    """ what an executor of R connections or execnet gateways records: jobs waiting for a thread, how long they
+        waited and ran, and how often threads (re)connected
+
+        :param executor: the executor's kind, as a label
+        :param pool: the executor's name, as a label
+    """
+
+    def __init__(self, executor, pool, registry=REGISTRY):
+        labels = dict(executor=executor, pool=pool)
+        self._registry = registry
+        self._labels = labels
+        self.queued = registry.gauge('rclient_executor_queued_jobs', 'jobs waiting for a thread', **labels)
+        self.queue_wait = registry.histogram('rclient_executor_queue_wait_seconds', 'time jobs waited for a thread',
+                                             **labels)
+        self.run_time = registry.histogram('rclient_executor_run_seconds', 'time threads spent on jobs', **labels)
+        self.failed = registry.counter('rclient_executor_failed_total', 'jobs that raised', **labels)
+        self.connect = registry.histogram('rclient_executor_connect_seconds',
+                                          'time to connect and initialize a thread', **labels)
+        self.reconnects = registry.counter('rclient_executor_reconnects_total', 'connections opened by threads',
+                                           **labels)
+
+    def enqueued(self):
+        """ call when submitting a job
+            :return: the time to pass to started
+        """
+        self.queued.inc()
+        return time.monotonic()
+
+    def started(self, queued):
+        """ call when a thread takes the job
+            :return: the start time
+        """
+        self.queued.dec()
+        start = time.monotonic()
+        self.queue_wait.observe(start - queued)
+        return start
+
+    def remove(self):
+        """ drop the executor's metrics from the registry, when it shuts down """
+        self._registry.remove(**self._labels)
+
+
+def weak_attribute(obj, name):
+    """ a gauge function reading obj.name, without keeping obj alive. None once obj is gone. """
+    ref = weakref.ref(obj)
+
+    def read():
+        o = ref()
+        return None if o is None else getattr(o, name)
+    return read
+
+
+def _labels(labels, **more):
+    items = sorted(labels.items()) + sorted(more.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in items) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def start_http_server(port, host='', registry=REGISTRY):
+    """ serve registry.exposition() on every path, on a daemon thread
+        :return: the server. call shutdown() on it to stop.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="rclient-metrics", daemon=True).start()
+    return server
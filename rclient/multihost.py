@@ -0,0 +1,296 @@
+"""
+A pool over several Rserve endpoints.
+
+Each endpoint gets its own RServeConnection. Checkouts go to the healthy endpoint with the lowest load for its weight,
+or the lowest recent ping round trip, so evaluation scales across machines. An endpoint whose connections fail is ejected,
+and a background prober brings it back once it answers again. Failed evaluations are retried on another endpoint.
+
+Usage:
+
+pool = MultiHostPool([('r1', 6311, 2), ('r2', 6311), Endpoint('r3', 6312)], pool_size=4)
+pool.eval('some r code')
+
+with pool.connect() as c:
+    c.eval('some r code')
+
+pool.occupancy()
+"""
+
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+import pyRserve
+
+from . import connector
+from .connector import CONNECTION_ERRORS, RETRY_BACKOFF, RServeConnection
+
+__all__ = ['Endpoint', 'MultiHostPool', 'BALANCE_LEAST_LOADED', 'BALANCE_LATENCY']
+
+logger = logging.getLogger(__name__)
+
+BALANCE_LEAST_LOADED = 'least_loaded'  # fewest connections in use for the endpoint's weight
+BALANCE_LATENCY = 'latency'  # lowest recent ping round trip, scaled by the load
+BALANCE_POLICIES = (BALANCE_LEAST_LOADED, BALANCE_LATENCY)
+
+DEFAULT_EJECT_AFTER = 3
+DEFAULT_EJECT_FOR = 5
+MAX_EJECT_FOR = 300
+DEFAULT_PROBE_INTERVAL = 1
+LATENCY_SMOOTHING = .2  # weight of the newest sample in the moving average
+
+
+class Endpoint(object):
+    """ an Rserve host and port, and its share of the load relative to the other endpoints """
+
+    def __init__(self, host='localhost', port=connector.RSERVEPORT, weight=1):
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        self.host = host
+        self.port = port
+        self.weight = weight
+
+        self.pool = None
+        self.latency = None  # moving average of ping round trips, in seconds
+        self.measured_at = None
+        self.failures = 0  # consecutive
+        self.ejected_until = None
+        self.eject_for = DEFAULT_EJECT_FOR
+
+    def __repr__(self):
+        return '<Endpoint {}:{}>'.format(self.host, self.port)
+
+    @classmethod
+    def of(cls, endpoint):
+        """ an Endpoint from an Endpoint, (host, port) or (host, port, weight) """
+        if isinstance(endpoint, cls):
+            return endpoint
+        return cls(*endpoint)
+
+    @property
+    def healthy(self):
+        return self.ejected_until is None
+
+    def record(self, seconds):
+        """ add a ping round trip to the moving average. only pings are recorded, never evaluations or connects,
+            so the endpoints are compared like for like.
+        """
+        self.measured_at = time.monotonic()
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+
+class MultiHostPool(object):
+    """ :param endpoints: Endpoint, (host, port) or (host, port, weight) for each Rserve
+        :param balance: BALANCE_LEAST_LOADED or BALANCE_LATENCY
+        :param retries: how many other endpoints an idempotent evaluation is retried on when its connection fails
+        :param eject_after: consecutive connection failures before an endpoint is ejected
+        :param eject_for: seconds before an ejected endpoint is first probed. doubles each time a probe fails.
+        :param probe_interval: how often ejected endpoints are checked
+        :param pool_kwargs: arguments for each endpoint's RServeConnection, like pool_size and max_size.
+                            endpoints warm up in the background, so a host that is down doesn't stop the pool
+                            from starting.
+    """
+
+    def __init__(self, endpoints, balance=BALANCE_LEAST_LOADED, retries=connector.DEFAULT_RETRIES,
+                 eject_after=DEFAULT_EJECT_AFTER, eject_for=DEFAULT_EJECT_FOR, probe_interval=DEFAULT_PROBE_INTERVAL,
+                 **pool_kwargs):
+        self._closed = True  # until there is something to close, for __del__ if we raise
+
+        if balance not in BALANCE_POLICIES:
+            raise ValueError("balance must be one of {}".format(BALANCE_POLICIES))
+
+        self.endpoints = [Endpoint.of(e) for e in endpoints]
+        if not self.endpoints:
+            raise ValueError("need at least one endpoint")
+
+        self._balance = balance
+        self._retries = retries
+        self._eject_after = eject_after
+        self._eject_for = eject_for
+        self._probe_interval = probe_interval
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        pool_kwargs['blocking_init'] = False
+        pool_kwargs['retries'] = 0  # we retry on another endpoint instead
+        name = pool_kwargs.pop('name', None)
+        try:
+            for e in self.endpoints:
+                e.eject_for = eject_for
+                # each endpoint's pool is labelled with its endpoint in the metrics
+                endpoint = '{}:{}'.format(e.host, e.port)
+                e.pool = RServeConnection(host=e.host, port=e.port,
+                                          name='{}@{}'.format(name, endpoint) if name else endpoint, **pool_kwargs)
+        except BaseException:
+            # don't leave the endpoints built so far connecting
+            for e in self.endpoints:
+                if e.pool is not None:
+                    e.pool.close()
+            raise
+        self._closed = False
+
+        threading.Thread(target=connector._run_periodically, name="rclient-multihost-prober", daemon=True,
+                         args=(weakref.ref(self), '_probe', self._stop, probe_interval)).start()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        for e in self.endpoints:
+            e.pool.close()
+
+    def connect(self, timeout=None):
+        """ check out a connection from the best endpoint. see RServeConnection.connect """
+        e = self._choose()
+        try:
+            return e.pool.connect(timeout)
+        except CONNECTION_ERRORS:
+            self._failed(e)
+            raise
+
+    def eval(self, expression, idempotent=True, **kwargs):
+        """ evaluate on the best endpoint, retrying on another one if the connection fails.
+            see RServeConnection.eval for the arguments
+        """
+        return self._retrying(lambda pool: pool.eval(expression, idempotent=idempotent, **kwargs), idempotent)
+
+    def eval_many(self, expressions, idempotent=True, **kwargs):
+        expressions = list(expressions)
+        return self._retrying(lambda pool: pool.eval_many(expressions, idempotent=idempotent, **kwargs),
+                              idempotent)
+
+    def call(self, name, *args, **kwargs):
+        """ call a function prepared with prepare """
+        return self._retrying(lambda pool: pool.call(name, *args, **kwargs), True)
+
+    def prepare(self, name, r_source):
+        for e in self.endpoints:
+            e.pool.prepare(name, r_source)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def upload(self, archive, **kwargs):
+        for e in self.endpoints:
+            e.pool.upload(archive, **kwargs)
+
+    def occupancy(self):
+        """ per endpoint: open, idle and in use connections, health and latency """
+        return [{
+            'host': e.host,
+            'port': e.port,
+            'weight': e.weight,
+            'healthy': e.healthy,
+            'size': e.pool.size,
+            'idle': e.pool.idle,
+            'in_use': e.pool.in_use,
+            'max_size': e.pool.max_size,
+            'latency': e.latency,
+        } for e in self.endpoints]
+
+    def _retrying(self, work, idempotent):
+        tried = set()
+        for attempt in itertools.count():
+            e = self._choose(exclude=tried)
+            tried.add(e)
+            try:
+                result = work(e.pool)
+            except CONNECTION_ERRORS as error:
+                self._failed(e)
+                if not idempotent or attempt >= self._retries:
+                    raise
+                logger.warning("%s failed, retrying elsewhere: %s", e, error)
+                if len(tried) >= len(self.endpoints):
+                    # every endpoint failed once. give them a moment.
+                    tried.clear()
+                    time.sleep(RETRY_BACKOFF * 2 ** attempt)
+                continue
+            with self._lock:
+                e.failures = 0
+            return result
+
+    def _choose(self, exclude=()):
+        """ the healthy endpoint with the lowest score. if every endpoint is ejected, try them anyway.
+            ties go round robin.
+        """
+        with self._lock:
+            turn = next(self._turn) % len(self.endpoints)
+            endpoints = self.endpoints[turn:] + self.endpoints[:turn]
+            candidates = [e for e in endpoints if e.healthy and e not in exclude]
+            if not candidates:
+                candidates = [e for e in endpoints if e not in exclude] or endpoints
+            return min(candidates, key=self._score)
+
+    def _score(self, e):
+        load = (e.pool.in_use + 1) / e.weight
+        if self._balance == BALANCE_LATENCY:
+            # endpoints without a measurement yet go first, so every endpoint gets measured
+            return (e.latency or 0.0) * load
+        return load
+
+    def _failed(self, e):
+        with self._lock:
+            e.failures += 1
+            if e.healthy and e.failures >= self._eject_after:
+                e.ejected_until = time.monotonic() + e.eject_for
+                logger.warning("ejected %s after %s failures", e, e.failures)
+
+    def _probe(self):
+        """ try ejected endpoints whose time is up. bring back the ones that answer.
+            with latency balancing, also time endpoints that got no traffic lately, so a slow first measurement
+            doesn't keep an endpoint out of rotation for good.
+        """
+        now = time.monotonic()
+        for e in self.endpoints:
+            if e.healthy:
+                if (self._balance == BALANCE_LATENCY and e.pool.idle and
+                        (e.measured_at is None or now - e.measured_at > self._probe_interval)):
+                    self._time(e)
+                continue
+            if e.ejected_until > now:
+                continue
+            try:
+                probe = pyRserve.rconn.RConnector(e.host, e.port, None, False, False)
+                try:
+                    # time the ping alone. connecting takes pyRserve a fixed .2s, and evaluations aren't pings.
+                    start = time.monotonic()
+                    alive = probe.eval('TRUE') is True
+                    seconds = time.monotonic() - start
+                finally:
+                    probe.close()
+            except Exception as error:
+                alive = False
+                logger.debug("probe of %s failed: %s", e, error)
+
+            with self._lock:
+                if alive:
+                    e.record(seconds)
+                    e.failures = 0
+                    e.ejected_until = None
+                    e.eject_for = self._eject_for
+                else:
+                    e.eject_for = min(e.eject_for * 2, MAX_EJECT_FOR)
+                    e.ejected_until = time.monotonic() + e.eject_for
+            if alive:
+                logger.info("%s is back", e)
+                e.pool._refill_in_background()
+
+    def _time(self, e):
+        """ ping an idle connection of e's. see RServeConnection.ping_time """
+        try:
+            seconds = e.pool.ping_time()
+        except CONNECTION_ERRORS as error:
+            logger.debug("timing %s failed: %s", e, error)
+            self._failed(e)
+            return
+        if seconds is not None:
+            with self._lock:
+                e.record(seconds)
@@ -0,0 +1,96 @@
+"""
+Prepared R functions: define a function once per R session, then call it with binary arguments.
+
+Arguments are assigned with Rserve's binary assign instead of being formatted into R source, so large numeric
+arguments skip string formatting and R's parser. The assignments, the call and the cleanup go out in one write,
+so a call costs a single round trip.
+
+Usage:
+
+conn = pyRserve.connect()
+define(conn, 'score', 'function(x, scale) sum(x) * scale')
+call(conn, 'score', numpy.arange(1e6), scale=2)
+
+with the pools:
+
+rpool.prepare('score', 'function(x, scale) sum(x) * scale')
+rpool.call('score', numpy.arange(1e6), scale=2)
+"""
+
+import re
+
+from pyRserve.rexceptions import REvalError
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rAssign, rEval
+
+from .protocol import r_string
+
+__all__ = ['Call', 'call', 'define']
+
+ARG_PREFIX = '.rclient_arg_'
+
+_NAME = re.compile(r'^(?:[A-Za-z]|\.[A-Za-z_.])[\w.]*$')
+
+
+class Call(object):
+    """ a call of a prepared function, to submit as a job in place of R source """
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '<Call {}>'.format(self.name)
+
+    def __call__(self, conn):
+        return call(conn, self.name, *self.args, **self.kwargs)
+
+
+def check_name(name):
+    if not _NAME.match(name):
+        raise ValueError("{!r} is not a syntactic R name".format(name))
+    return name
+
+
+def define(conn, name, r_source):
+    """ assign a function, given as R source like 'function(x) x + 1', to name in the global environment """
+    conn.voidEval('{} <- {}'.format(check_name(name), r_source))
+
+
+def call(conn, name, *args, **kwargs):
+    """ call a function defined in the connection's R session, passing the arguments as binary R objects
+
+        :return: the function's result
+    """
+    names = ['{}{}'.format(ARG_PREFIX, i) for i in range(len(args))]
+    keywords = dict((k, ARG_PREFIX + check_name(k)) for k in kwargs)
+    messages = [rAssign(n, a) for n, a in zip(names, args)]
+    messages.extend(rAssign(keywords[k], v) for k, v in kwargs.items())
+
+    arguments = names + ['{} = {}'.format(k, n) for k, n in keywords.items()]
+    messages.append(rEval('{}({})'.format(check_name(name), ', '.join(arguments))))
+    assigned = names + list(keywords.values())
+    if assigned:
+        messages.append(rEval('rm(list = c({}), envir = globalenv())'.format(
+            ', '.join(r_string(n) for n in assigned)), void=True))
+
+    responses = pipeline(conn, messages)
+    for response in responses:
+        if isinstance(response, REvalError):
+            raise REvalError(conn.eval('geterrmessage()').strip())
+    return responses[len(args) + len(kwargs)]
+
+
+def pipeline(conn, messages):
+    """ send several requests in one write, then read every response, so they cost one round trip.
+        R errors are returned in place of their response rather than raised, so the socket stays in step.
+    """
+    conn.sock.sendall(b''.join(messages))
+    responses = []
+    for _ in messages:
+        try:
+            responses.append(rparse(conn.sock, atomicArray=conn.atomicArray))
+        except REvalError as e:
+            responses.append(e)
+    return responses
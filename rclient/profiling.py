@@ -0,0 +1,201 @@
+"""
+Where did a slow evaluation's time go?
+
+With a Profiler, evaluations are traced phase by phase: waiting for an executor thread (queue), checking out or
+opening a connection (checkout), writing the request (send), waiting for the first byte of the answer while R
+computes (compute), reading the rest of the answer (receive) and turning it into python objects (deserialize).
+Request and response sizes are recorded too. Each finished trace goes to the profiler's hooks, and the slowest
+calls are kept as samples.
+
+Usage:
+
+profiler = Profiler(slow_after=.5)
+profiler.add_hook(lambda trace: print(trace.as_dict()))
+pool = RServeConnection(pool_size=4, profiler=profiler)
+rp = RPoolTornado(max_workers=4, profiler=profiler)
+
+profiler.summary()       # mean phase times over all calls, and over the slow ones
+profiler.slow_calls()    # the slowest traces, slowest first
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from pyRserve.rconn import checkIfClosed
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rEval
+
+from .protocol import HEADER, message_length, read_answer, read_exactly
+
+__all__ = ['Profiler', 'Trace', 'traced_eval', 'PHASES']
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('queue', 'checkout', 'send', 'compute', 'receive', 'deserialize')
+
+DEFAULT_SLOW_AFTER = 1
+DEFAULT_SAMPLES = 100
+
+
+class Trace(object):
+    """ the timeline of one evaluation. mark(phase) ends a phase: the time since the previous mark is added to it. """
+
+    __slots__ = ('expression', 'pool', 'started', 'phases', 'bytes_sent', 'bytes_received', 'error', '_last')
+
+    def __init__(self, expression, pool=None):
+        self.expression = expression
+        self.pool = pool
+        self.started = self._last = time.monotonic()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<Trace {:.4f}s {!r}>'.format(self.total, self.expression[:40])
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases[phase] += now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def as_dict(self):
+        return {
+            'expression': self.expression,
+            'pool': self.pool,
+            'total': self.total,
+            'phases': dict(self.phases),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'error': self.error,
+        }
+
+
+class Profiler(object):
+    """ collects finished traces: passes each to the hooks, sums the phases, and keeps samples of slow calls
+
+        :param slow_after: seconds after which a call counts as slow
+        :param samples: how many of the slowest calls to keep
+        :param hooks: functions called with each finished Trace, on the evaluating thread. keep them quick.
+        :param metrics: optional metrics.MetricsRegistry to record rclient_eval_phase_seconds histograms into
+    """
+
+    def __init__(self, slow_after=DEFAULT_SLOW_AFTER, samples=DEFAULT_SAMPLES, hooks=(), metrics=None):
+        self.slow_after = slow_after
+        self.samples = samples
+        self._hooks = list(hooks)
+        self._metrics = metrics
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self.reset()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def reset(self):
+        with self._lock:
+            self._calls = 0
+            self._slow = 0
+            self._phases = dict.fromkeys(PHASES, 0.0)
+            self._slow_phases = dict.fromkeys(PHASES, 0.0)
+            self._bytes_sent = 0
+            self._bytes_received = 0
+            self._slowest = []  # min-heap of (total, seq, trace)
+
+    def record(self, trace):
+        with self._lock:
+            self._calls += 1
+            self._bytes_sent += trace.bytes_sent
+            self._bytes_received += trace.bytes_received
+            for phase, seconds in trace.phases.items():
+                self._phases[phase] += seconds
+            if trace.total >= self.slow_after:
+                self._slow += 1
+                for phase, seconds in trace.phases.items():
+                    self._slow_phases[phase] += seconds
+                entry = (trace.total, next(self._seq), trace)
+                if len(self._slowest) < self.samples:
+                    heapq.heappush(self._slowest, entry)
+                elif entry > self._slowest[0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+        if self._metrics is not None:
+            for phase, seconds in trace.phases.items():
+                self._histogram(trace.pool, phase).observe(seconds)
+
+        for hook in self._hooks:
+            try:
+                hook(trace)
+            except Exception:
+                logger.exception("profiler hook failed")
+
+    def slow_calls(self):
+        """ the slowest calls that took at least slow_after seconds, slowest first """
+        with self._lock:
+            return [trace for _, _, trace in sorted(self._slowest, reverse=True)]
+
+    def summary(self):
+        """ mean seconds per phase over every call and over the slow calls, mean payload sizes, and the phase that
+            took most of the slow calls' time
+        """
+        with self._lock:
+            calls, slow = self._calls, self._slow
+            summary = {
+                'calls': calls,
+                'slow_calls': slow,
+                'phases': dict((p, s / calls if calls else 0.0) for p, s in self._phases.items()),
+                'slow_phases': dict((p, s / slow if slow else 0.0) for p, s in self._slow_phases.items()),
+                'bytes_sent': self._bytes_sent / calls if calls else 0,
+                'bytes_received': self._bytes_received / calls if calls else 0,
+            }
+        phases = summary['slow_phases'] if slow else summary['phases']
+        summary['dominant_phase'] = max(phases, key=phases.get) if calls else None
+        return summary
+
+    def _histogram(self, pool, phase):
+        key = (pool, phase)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            labels = dict(phase=phase) if pool is None else dict(pool=pool, phase=phase)
+            histogram = self._histograms[key] = self._metrics.histogram(
+                'rclient_eval_phase_seconds', 'time evaluations spent in each phase', **labels)
+        return histogram
+
+
+@checkIfClosed
+def traced_eval(conn, expression, trace, parse=None):
+    """ evaluate like conn.eval, marking the send, compute, receive and deserialize phases of trace
+
+        :param conn: a pyRserve connection
+        :param parse: decodes the whole answer, like columnar.parse. pyRserve's rparse by default.
+    """
+    message = rEval(expression)
+    trace.bytes_sent += len(message)
+    conn.sock.sendall(message)
+    trace.mark('send')
+
+    def read():
+        header = read_exactly(conn.sock, HEADER.size)
+        trace.mark('compute')
+        body = read_exactly(conn.sock, message_length(header))
+        trace.bytes_received += len(header) + len(body)
+        trace.mark('receive')
+        try:
+            if parse is None:
+                return rparse(bytes(header + body), atomicArray=conn.atomicArray)
+            return parse(header + body, atomicArray=conn.atomicArray)
+        finally:
+            trace.mark('deserialize')
+
+    return read_answer(conn, read)
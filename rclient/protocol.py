@@ -0,0 +1,85 @@
+"""
+The pieces of QAP1, Rserve's protocol, that rclient reads and writes itself rather than through pyRserve.
+
+Every message, both ways, starts with a 16 byte header: the command or response status, the length of the body in
+two 32 bit halves, and an offset that is always 0. Answers to an eval may be preceded by out of band messages, which
+R sends with Rserve's self.oobSend and self.oobMessage, and which are handed to the connection's oobCallback.
+
+Usage:
+
+conn.sock.sendall(rEval('2 + 2'))
+result = read_answer(conn, lambda: rparse(read_message(conn.sock)))
+"""
+
+import struct
+
+from pyRserve import rtypes
+from pyRserve.rexceptions import EndOfDataError, REvalError
+from pyRserve.rparser import OOBMessage
+
+__all__ = ['HEADER', 'message_length', 'read_exactly', 'read_into', 'read_message', 'read_answer', 'qap_string',
+           'r_string']
+
+HEADER = struct.Struct('<IIII')
+
+
+def message_length(header):
+    """ length of the body following a message header """
+    _, length_lo, _, length_hi = HEADER.unpack(header)
+    return length_lo | (length_hi << 32)
+
+
+def read_exactly(sock, n):
+    """ :return: a bytearray of the next n bytes on sock. EndOfDataError if the connection closes first. """
+    buffer = bytearray(n)
+    read_into(sock, memoryview(buffer))
+    return buffer
+
+
+def read_into(sock, view):
+    """ fill a writable memoryview from sock """
+    n = 0
+    while n < len(view):
+        received = sock.recv_into(view[n:], len(view) - n)
+        if not received:
+            raise EndOfDataError()
+        n += received
+
+
+def read_message(sock):
+    """ :return: the next message, header and body, in a single bytearray """
+    header = read_exactly(sock, HEADER.size)
+    message = bytearray(HEADER.size + message_length(header))
+    message[:HEADER.size] = header
+    read_into(sock, memoryview(message)[HEADER.size:])
+    return message
+
+
+def read_answer(conn, read):
+    """ read the answer to an eval already sent on conn, like pyRserve's eval does: out of band messages that come
+        first are handed to conn.oobCallback, and an R error is raised as an REvalError with R's error message.
+
+        :param conn: a pyRserve connection
+        :param read: reads and decodes the next message on conn
+    """
+    while True:
+        try:
+            result = read()
+        except REvalError:
+            raise REvalError(conn.eval('geterrmessage()').strip())
+        if not isinstance(result, OOBMessage):
+            return result
+        answer = conn.oobCallback(result.data, result.userCode)
+        if result.type == rtypes.OOB_MSG:
+            conn._rrespond(answer)
+
+
+def qap_string(s):
+    """ a null terminated string, padded to a multiple of 4 bytes, as QAP1 sends strings and symbols """
+    data = s.encode('utf-8') + b'\0'
+    return data + b'\0' * (-len(data) % 4)
+
+
+def r_string(s):
+    """ quote a python string as an R string literal """
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
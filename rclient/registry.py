@@ -0,0 +1,291 @@
+"""
+One warm pool per model.
+
+A model bundle (an archive or a set of files, plus an R initializer) is staged once into a read-only directory.
+Every connection in the model's pool sources the initializer from there when its R session starts, so requests
+never pay for initialization.
+
+# Usage:
+
+registry = ModelRegistry(pool_size=4, realtime=False)
+registry.register(ModelBundle('wordcount', '1.0', archive='wordcount.tar.gz', initializer='WordCount.R'))
+
+result = registry.eval('wordcount', 'main("sin")')
+
+with registry.pool('wordcount').connect() as c:
+    c.eval('main("abel")')
+
+with a fleet of Rserve daemons per model, which preload the bundle's packages and scripts before forking sessions:
+
+registry = ModelRegistry(fleet=dict(daemons=4, base_port=6400), pool_size=2)
+registry.register(ModelBundle('wordcount', '1.0', archive='wordcount.tar.gz',
+                              preload=Preload(packages=['tm'], scripts=['model.R'])))
+
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from . import connector, staging
+from .connector import RServeConnection
+from .fleet import RserveFleet
+
+__all__ = ['ModelBundle', 'ModelRegistry', 'BundleChanged']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STAGE_DIR = os.path.join(tempfile.gettempdir(), 'rclient', 'models')
+DIGEST_FILE = '.rclient-digest'  # in a staged bundle: the digest of the content it was staged from
+
+
+class ModelNotFound(KeyError):
+    pass
+
+
+class BundleChanged(ValueError):
+    """ a bundle's version is already staged with other content """
+    pass
+
+
+class ModelBundle(object):
+    """ an immutable description of a model version
+
+        :param name: model name
+        :param version: model version. a staged version is never changed, register a new version instead.
+        :param archive: optional zip, tar, tar.gz, tar.bz2 or tar.xz with the model's files
+        :param files: other files the model needs
+        :param initializer: R file in the bundle that is sourced when each connection starts
+        :param preload: Preload with packages and scripts in the bundle the model's Rserve daemons load once, before
+                        forking sessions. only models served by a fleet preload, see ModelRegistry.
+    """
+
+    def __init__(self, name, version, archive=None, files=None, initializer=None, preload=None):
+        if isinstance(files, str):
+            files = [files]
+
+        self.name = name
+        self.version = str(version)
+        self.archive = archive
+        self.files = tuple(files or ())
+        self.initializer = initializer
+        self.preload = preload
+
+    def __repr__(self):
+        return '<ModelBundle {}:{}>'.format(self.name, self.version)
+
+    @property
+    def key(self):
+        return self.name, self.version
+
+    def sources(self):
+        """ the local files the bundle is staged from """
+        scripts = self.preload.scripts if self.preload else ()
+        return [f for f in (self.archive,) + self.files + (self.initializer,) + tuple(scripts) if f is not None]
+
+    def digest(self):
+        """ sha256 of the bundle's content: its files' names and content """
+        h = hashlib.sha256()
+        cache = staging.default_cache()
+        for f in self.sources():
+            h.update(os.path.basename(f).encode('utf-8') + b'\0')
+            if os.path.isfile(f):
+                h.update(cache.digest(f).encode('ascii'))
+        return h.hexdigest()
+
+    def stage(self, stage_dir=DEFAULT_STAGE_DIR):
+        """ link the bundle's content into stage_dir/name/version once. it is read-only.
+            if this version is already staged from the same content, it is reused. if the content has changed since,
+            BundleChanged is raised: register a new version instead.
+
+            :return: the bundle directory
+        """
+        target = os.path.join(stage_dir, self.name, self.version)
+        digest = self.digest()
+        if os.path.isdir(target):
+            self._check_staged(target, digest)
+            return target
+
+        parent = os.path.dirname(target)
+        os.makedirs(parent, exist_ok=True)
+        # stage next to the target, then rename, so nobody sees a half-staged bundle.
+        # the content itself comes from the staging cache, so identical files are only stored once.
+        cache = staging.default_cache()
+        tmp = tempfile.mkdtemp(prefix='.staging-', dir=parent)
+        try:
+            if self.archive is not None:
+                cache.link_into(self.archive, tmp, unpack=True)
+            for f in self.files:
+                cache.link_into(f, tmp)
+            scripts = self.preload.scripts if self.preload else ()
+            for f in (self.initializer,) + scripts:
+                if f is not None and not os.path.exists(os.path.join(tmp, f)):
+                    cache.link_into(f, tmp)
+            with open(os.path.join(tmp, DIGEST_FILE), 'w') as f:
+                f.write(digest + '\n')
+            os.chmod(os.path.join(tmp, DIGEST_FILE), 0o444)
+            os.chmod(tmp, 0o555)
+            os.rename(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(target):
+                raise
+            # someone else staged the same version first
+            self._check_staged(target, digest)
+        finally:
+            cache.forget(tmp)
+        return target
+
+    def _check_staged(self, target, digest):
+        """ raise BundleChanged unless target was staged from content with this digest """
+        try:
+            with open(os.path.join(target, DIGEST_FILE)) as f:
+                staged = f.read().strip()
+        except OSError:
+            staged = None
+        if staged != digest:
+            raise BundleChanged("{} is already staged in {} with other content. register a new version, or remove "
+                                "the directory once no pool uses it.".format(self, target))
+
+
+class ModelRegistry(object):
+    """ owns one warm RServeConnection per (model, version)
+
+        :param stage_dir: where bundles are staged
+        :param fleet: arguments for an RserveFleet per model, like daemons, base_port and conf. each model then gets
+                      its own daemons, preloading its bundle's Preload, and a MultiHostPool over them.
+                      the models' fleets take consecutive ports from base_port on.
+                      None connects every model to the one Rserve in pool_kwargs.
+        :param pool_kwargs: default arguments for each model's RServeConnection
+    """
+
+    def __init__(self, stage_dir=DEFAULT_STAGE_DIR, fleet=None, **pool_kwargs):
+        self._stage_dir = stage_dir
+        self._fleet_kwargs = None if fleet is None else dict(fleet)
+        if fleet is not None:
+            self._next_port = self._fleet_kwargs.pop('base_port', connector.RSERVEPORT)
+        self._pool_kwargs = pool_kwargs
+        self._fleets = {}
+        self._pools = {}
+        self._bundles = {}
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, model):
+        return model in self._latest
+
+    def register(self, bundle, **pool_kwargs):
+        """ stage a bundle and warm up its pool. the latest registered version of a model is its default.
+
+            :param pool_kwargs: override the registry's default pool arguments for this model
+            :return: the model's pool
+        """
+        bundle_dir = bundle.stage(self._stage_dir)
+        kwargs = dict(self._pool_kwargs, initializer=bundle.initializer, bundle_dir=bundle_dir,
+                      name='{}:{}'.format(*bundle.key))
+        kwargs.update(pool_kwargs)
+        if self._fleet_kwargs is None:
+            if bundle.preload:
+                logger.warning("%s has a preload, but only models served by a fleet preload", bundle)
+            fleet = None
+            pool = RServeConnection(**kwargs)
+        else:
+            fleet, pool = self._start_fleet(bundle, bundle_dir, kwargs)
+
+        with self._lock:
+            old = self._pools.get(bundle.key)
+            old_fleet = self._fleets.pop(bundle.key, None)
+            self._pools[bundle.key] = pool
+            if fleet is not None:
+                self._fleets[bundle.key] = fleet
+            self._bundles[bundle.key] = bundle
+            self._latest[bundle.name] = bundle.version
+        if old is not None:
+            old.close()
+        if old_fleet is not None:
+            old_fleet.stop()
+        logger.info("registered %s", bundle)
+        return pool
+
+    def unregister(self, model, version=None):
+        """ drop a model version's pool. dropping the default version makes the most recently registered
+            remaining version the default.
+        """
+        with self._lock:
+            key = self._key(model, version)
+            pool = self._pools.pop(key)
+            fleet = self._fleets.pop(key, None)
+            del self._bundles[key]
+            remaining = [v for (m, v) in self._pools if m == model]
+            if remaining:
+                self._latest[model] = remaining[-1]
+            else:
+                del self._latest[model]
+        pool.close()
+        if fleet is not None:
+            fleet.stop()
+
+    def bundle(self, model, version=None):
+        with self._lock:
+            return self._bundles[self._key(model, version)]
+
+    def pool(self, model, version=None):
+        """ the warm pool for a model. version defaults to the latest registered """
+        with self._lock:
+            return self._pools[self._key(model, version)]
+
+    def eval(self, model, expression, version=None, **kwargs):
+        """ evaluate an expression on the model's pool """
+        return self.pool(model, version).eval(expression, **kwargs)
+
+    def models(self):
+        """ [(model, version), ...] of registered models """
+        with self._lock:
+            return list(self._pools)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+            fleets, self._fleets = list(self._fleets.values()), {}
+            self._bundles.clear()
+            self._latest.clear()
+        for pool in pools:
+            pool.close()
+        for fleet in fleets:
+            fleet.stop()
+
+    def fleet(self, model, version=None):
+        """ the RserveFleet serving a model, None when the registry doesn't run fleets """
+        with self._lock:
+            return self._fleets.get(self._key(model, version))
+
+    def _start_fleet(self, bundle, bundle_dir, pool_kwargs):
+        """ start daemons preloading the bundle on the next free ports
+            :return: the fleet and a MultiHostPool over it
+        """
+        preload = bundle.preload.relative_to(bundle_dir) if bundle.preload else None
+        with self._lock:
+            fleet = RserveFleet(base_port=self._next_port, preload=preload, **self._fleet_kwargs)
+            self._next_port += len(fleet.daemons)
+        fleet.start()
+        try:
+            # connections still source the initializer. the daemons have loaded the preload already.
+            return fleet, fleet.pool(**pool_kwargs)
+        except Exception:
+            fleet.stop()
+            raise
+
+    def _key(self, model, version):
+        """ call while holding self._lock """
+        if version is None:
+            try:
+                version = self._latest[model]
+            except KeyError:
+                raise ModelNotFound(model)
+        key = (model, str(version))
+        if key not in self._pools:
+            raise ModelNotFound(key)
+        return key
@@ -15,6 +15,8 @@ import shutil
 import logging
 import re
 
+from . import arrays, columnar, fileio, staging, streaming
+
 # fixme: move somewhere central
 # NOTE: conf['tmp'] should be configured to avoid doing rm -rf on the wrong folder
 conf = {
@@ -94,18 +96,43 @@ class RContext:
             self._disconnect()
             self._connect()
 
-    def upload(self, source_archive):
+    def upload(self, source_archive, chunk_size=None):
         """ Local 'upload' and decompress
             Archive types supported:
             zip, tar, tar.gz, tar.bz2, tar.xz
+
+            The archive is extracted once into the staging cache, and linked into the connection's home.
+            Uploading identical content again is skipped.
+            If Rserve isn't on the local host, the archive is streamed through the connection in chunk_size pieces
+            and unpacked by R. see fileio.upload_file
         """
         if self.connection_home is not None:
-            try:
-                shutil.unpack_archive(source_archive, self.connection_home)
-            except ValueError:
-                # Couldn't find a suitable archive format
-                # Let's assume this is just an uncompressed file
-                shutil.copy(source_archive, self.connection_home)
+            fileio.upload(self.connection, source_archive, local_dir=self.connection_home, unpack=True,
+                          chunk_size=chunk_size)
+
+    def assign_array(self, name, array):
+        """ assign a numeric numpy array to an R variable, sent straight from its buffer.
+            arrays with several dimensions keep their dims. see arrays.assign_array
+        """
+        arrays.assign_array(self.connection, name, array)
+
+    def fetch_array(self, expression):
+        """ evaluate expression and return the value as a numpy array, received straight into its buffer.
+            R's dims become the array's shape, in Fortran order. see arrays.fetch_array
+        """
+        return arrays.fetch_array(self.connection, expression)
+
+    def eval_columnar(self, expression):
+        """ evaluate expression, returning a data frame as a columnar.Frame of numpy arrays, decoded straight from
+            the answer. other results are decoded like eval's. see columnar.eval_columnar
+        """
+        return columnar.eval_columnar(self.connection, expression)
+
+    def stream(self, expression, chunk_size=streaming.DEFAULT_CHUNK_SIZE, as_arrays=False):
+        """ evaluate expression and yield its value in slices of chunk_size rows or elements, so a big result is
+            never held in one piece. see streaming.stream
+        """
+        return streaming.stream(self.connection, expression, chunk_size, as_arrays)
 
     def close(self):
         """ override close for tmp file removal and possible pool checkin
@@ -147,6 +174,7 @@ class RContext:
             if os.path.dirname(self.connection_home) == tmp:
                 try:
                     shutil.rmtree(self.connection_home)
+                    staging.default_cache().forget(self.connection_home)
                 except:
                     logging.error("Could not remove {}".format(self.connection_home))
 
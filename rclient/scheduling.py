@@ -0,0 +1,179 @@
+"""
+Priority classes and weighted fair queueing for jobs waiting on a pool.
+
+Jobs are queued per (priority, caller). A more urgent priority class is always served first. Within a class, callers
+share the workers in proportion to their weights (start-time fair queueing), so one caller's backlog of bulk jobs
+doesn't delay the others. Each caller's queue is bounded, and so is the total.
+
+Usage:
+
+jobs = FairQueue(maxsize=1000, max_per_caller=100)
+jobs.set_weight('dashboard', 4)
+jobs.put('batch-loader', job, priority=PRIORITY_BATCH)
+jobs.put('dashboard', job, priority=PRIORITY_INTERACTIVE)
+
+job = jobs.get()  # the dashboard's job
+jobs.task_done()
+"""
+
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+__all__ = ['FairQueue', 'PRIORITY_INTERACTIVE', 'PRIORITY_NORMAL', 'PRIORITY_BATCH']
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+DEFAULT_WEIGHT = 1
+
+
+class _Flow(object):
+    """ one caller's jobs in one priority class """
+
+    __slots__ = ('jobs', 'last_finish')
+
+    def __init__(self):
+        self.jobs = deque()  # (start tag, item)
+        self.last_finish = 0.0
+
+
+class _PriorityClass(object):
+
+    __slots__ = ('flows', 'heads', 'virtual_time')
+
+    def __init__(self):
+        self.flows = {}  # caller -> _Flow with queued jobs
+        self.heads = []  # heap of (start tag, seq, caller) for each flow's first job
+        self.virtual_time = 0.0
+
+
+class FairQueue(object):
+    """ a queue.Queue-like job queue with priority classes and weighted fair sharing between callers.
+        lower priority numbers are served first.
+
+        :param maxsize: jobs waiting in total before put blocks. 0 is unbounded.
+        :param max_per_caller: jobs one caller may have waiting before its puts block. 0 is unbounded.
+    """
+
+    def __init__(self, maxsize=0, max_per_caller=0):
+        self.maxsize = maxsize
+        self.max_per_caller = max_per_caller
+        self._classes = {}
+        self._weights = {}
+        self._waiting = {}  # caller -> jobs waiting over all classes
+        self._size = 0
+        self._unfinished = 0
+        self._closed = False
+        self._seq = itertools.count()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+
+    def set_weight(self, caller, weight):
+        """ a caller with weight 2 gets twice the share of a caller with weight 1 in the same priority class """
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        with self._mutex:
+            self._weights[caller] = weight
+
+    def qsize(self):
+        return self._size
+
+    def waiting(self, caller):
+        """ number of jobs caller has waiting """
+        return self._waiting.get(caller, 0)
+
+    def put(self, caller, item, priority=PRIORITY_NORMAL, block=True, timeout=None):
+        """ queue a job for caller. raises queue.Full if it can't be queued within timeout """
+        with self._not_full:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._is_full(caller):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full
+                self._not_full.wait(remaining)
+
+            cls = self._classes.setdefault(priority, _PriorityClass())
+            flow = cls.flows.get(caller)
+            if flow is None:
+                flow = cls.flows[caller] = _Flow()
+            start = max(cls.virtual_time, flow.last_finish)
+            flow.last_finish = start + 1.0 / self._weights.get(caller, DEFAULT_WEIGHT)
+            flow.jobs.append((start, item))
+            if len(flow.jobs) == 1:
+                heapq.heappush(cls.heads, (start, next(self._seq), caller))
+
+            self._waiting[caller] = self._waiting.get(caller, 0) + 1
+            self._size += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """ take the next job: from the most urgent priority class with jobs, the job with the smallest start tag.
+            returns None once the queue is closed and empty.
+        """
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._size:
+                if self._closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+            return self._pop()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self._all_done:
+            if self._unfinished <= 0:
+                raise ValueError('task_done() called too many times')
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def join(self):
+        """ wait until every queued job has been taken and marked done """
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def close(self):
+        """ wake every waiting get. once the queue is empty, get returns None. """
+        with self._mutex:
+            self._closed = True
+            self._not_empty.notify_all()
+
+    def _is_full(self, caller):
+        """ call while holding self._mutex """
+        return ((self.maxsize > 0 and self._size >= self.maxsize) or
+                (self.max_per_caller > 0 and self._waiting.get(caller, 0) >= self.max_per_caller))
+
+    def _pop(self):
+        """ call while holding self._mutex, with at least one job queued """
+        priority = min(p for p, cls in self._classes.items() if cls.heads)
+        cls = self._classes[priority]
+        start, _, caller = heapq.heappop(cls.heads)
+        flow = cls.flows[caller]
+        _, item = flow.jobs.popleft()
+        cls.virtual_time = start
+        if flow.jobs:
+            heapq.heappush(cls.heads, (flow.jobs[0][0], next(self._seq), caller))
+        else:
+            # an idle caller keeps no state, and starts again from the current virtual time
+            del cls.flows[caller]
+
+        self._waiting[caller] -= 1
+        if not self._waiting[caller]:
+            del self._waiting[caller]
+        self._size -= 1
+        self._not_full.notify_all()
+        return item
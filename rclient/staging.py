@@ -0,0 +1,182 @@
+"""
+Content-addressed staging cache for uploads and support files.
+
+Each file is stored once under its sha256, and archives are extracted once. Connection working directories get
+hardlinks into the store (symlinks when the store is on another filesystem), so staging a bundle into many
+connections costs one copy or extraction, and re-uploading identical content into the same directory is skipped.
+
+Store entries are read-only. A connection may delete or replace its links, but can't change the shared content.
+
+Usage:
+
+cache = default_cache()
+cache.link_into('mybundle.tar.gz', connection_wd, unpack=True)
+cache.link_into('WordCount.R', connection_wd)
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+__all__ = ['StagingCache', 'default_cache']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'rclient', 'staging')
+HASH_BLOCK_SIZE = 1 << 20
+
+RAW = 'raw'  # a file as-is
+UNPACKED = 'unpacked'  # an archive's contents
+BLOB = 'blob'  # name of a raw file inside its store entry. it takes its real name when linked.
+
+
+class StagingCache(object):
+    """ :param root: directory holding the store. it must be readable by the Rserve processes. """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+        self._digests = {}  # (path, size, mtime) -> sha256, so unchanged files aren't hashed again
+        self._linked = {}  # dest_dir -> {(digest, name, unpack)} already linked there
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def digest(self, path):
+        """ sha256 of a file, read in blocks """
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        try:
+            return self._digests[key]
+        except KeyError:
+            pass
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        self._digests[key] = h.hexdigest()
+        return self._digests[key]
+
+    def stage(self, path, unpack=False):
+        """ put a file, or an archive's contents if unpack is True, in the store.
+            content that is already in the store isn't copied or extracted again.
+
+            :return: the store directory for this content
+        """
+        digest = self.digest(path)
+        kind = UNPACKED if unpack else RAW
+        entry = os.path.join(self.root, digest[:2], digest, kind)
+        if os.path.isdir(entry):
+            return entry
+
+        with self._entry_lock(entry):
+            if os.path.isdir(entry):
+                return entry
+            parent = os.path.dirname(entry)
+            os.makedirs(parent, exist_ok=True)
+            # stage next to the entry, then rename, so nobody sees half-staged content
+            tmp = tempfile.mkdtemp(prefix='.staging-', dir=parent)
+            try:
+                if unpack:
+                    try:
+                        shutil.unpack_archive(path, tmp)
+                    except (ValueError, shutil.ReadError):
+                        # Couldn't find a suitable archive format
+                        # Let's assume this is just an uncompressed file
+                        shutil.copy(path, os.path.join(tmp, os.path.basename(path)))
+                else:
+                    shutil.copy(path, os.path.join(tmp, BLOB))
+                _make_read_only(tmp)
+                os.rename(tmp, entry)
+                logger.debug("staged %s as %s", path, entry)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not os.path.isdir(entry):
+                    raise
+                # another process staged the same content first
+        return entry
+
+    def link_into(self, path, dest_dir, unpack=False):
+        """ make a file, or an archive's contents, appear in dest_dir without copying it there.
+            linking the same content into the same directory again does nothing.
+
+            :return: False if the content was already linked into dest_dir
+        """
+        digest = self.digest(path)
+        name = os.path.basename(path)
+        marker = (digest, name, unpack)
+        with self._lock:
+            linked = self._linked.setdefault(os.path.realpath(dest_dir), set())
+            if marker in linked and self._still_linked(path, dest_dir, unpack):
+                return False
+
+        entry = self.stage(path, unpack)
+        if unpack:
+            for root, dirs, files in os.walk(entry):
+                rel = os.path.relpath(root, entry)
+                target_dir = os.path.normpath(os.path.join(dest_dir, rel))
+                os.makedirs(target_dir, exist_ok=True)
+                for f in files:
+                    _link(os.path.join(root, f), os.path.join(target_dir, f))
+        else:
+            _link(os.path.join(entry, BLOB), os.path.join(dest_dir, name))
+
+        with self._lock:
+            linked.add(marker)
+        return True
+
+    def forget(self, dest_dir):
+        """ stop tracking what was linked into dest_dir, e.g. when it's removed """
+        with self._lock:
+            self._linked.pop(os.path.realpath(dest_dir), None)
+
+    @staticmethod
+    def _still_linked(path, dest_dir, unpack):
+        # the directory may have been cleaned up since. for archives, check the directory is still there.
+        if unpack:
+            return os.path.isdir(dest_dir)
+        return os.path.exists(os.path.join(dest_dir, os.path.basename(path)))
+
+    def _entry_lock(self, entry):
+        with self._lock:
+            return self._locks.setdefault(entry, threading.Lock())
+
+
+def _link(source, target):
+    """ hardlink source to target, falling back to a symlink across filesystems. replaces target. """
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(source, target)
+
+
+def _make_read_only(path):
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            os.chmod(os.path.join(root, f), 0o444)
+        for d in dirs:
+            os.chmod(os.path.join(root, d), 0o555)
+    os.chmod(path, 0o555)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """ the process-wide cache, created in DEFAULT_CACHE_DIR on first use """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = StagingCache()
+        return _default_cache
@@ -0,0 +1,109 @@
+"""
+Stream a big R result in slices instead of receiving it in one piece.
+
+The expression is evaluated once and its value kept in the R session. Then it's sent back chunk_size rows at a time
+(rows of a data frame or matrix, elements of a vector or list), so neither side ever serializes more than a slice,
+and Rserve's maxsendbuf only has to fit one. The next slice is requested before the current one is handed over,
+so R prepares it while the caller works on the current one.
+
+A connection can only run one stream at a time, and nothing else until the stream is exhausted or closed.
+
+Usage:
+
+for rows in rpool.stream('read.csv("big.csv")', chunk_size=10000):
+    ...
+
+with rpool.connect() as c:
+    for block in c.stream('predictions', chunk_size=100000, as_arrays=True):
+        ...
+"""
+
+import logging
+
+from pyRserve.rconn import checkIfClosed
+from pyRserve.rexceptions import REvalError
+from pyRserve.rparser import rparse
+from pyRserve.rserializer import rEval
+
+from . import arrays
+from .prepared import pipeline
+from .protocol import read_answer
+
+__all__ = ['stream', 'DEFAULT_CHUNK_SIZE']
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+
+STREAM_VAR = '.rclient_stream'
+SLICE_FUNCTION = '.rclient_slice'
+
+# returns rows from:to of the streamed value, or elements from:to if it has no rows
+_DEFINE_SLICE = """
+{function} <- function(from, to) {{
+    x <- get("{var}", envir = globalenv())
+    if (length(dim(x)) == 2L) x[from:to, , drop = FALSE] else x[from:to]
+}}
+""".format(function=SLICE_FUNCTION, var=STREAM_VAR)
+
+# keeps the value, and returns how many rows or elements it has
+_EVALUATE = """
+{var} <- ({{expression}}
+)
+NROW({var})
+""".format(var=STREAM_VAR)
+
+_CLEANUP = 'rm(list = c("{}", "{}"), envir = globalenv())'.format(STREAM_VAR, SLICE_FUNCTION)
+
+
+@checkIfClosed
+def stream(conn, expression, chunk_size=DEFAULT_CHUNK_SIZE, as_arrays=False):
+    """ evaluate expression, and yield its value chunk_size rows or elements at a time
+
+        :param conn: a pyRserve connection. it must not be used by anyone else until the stream is exhausted or closed.
+        :param as_arrays: receive each slice straight into a numpy array, see arrays.fetch_array
+        :return: a generator of slices, each decoded like an eval result
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+
+    responses = pipeline(conn, [rEval(_DEFINE_SLICE, void=True), rEval(_EVALUATE.format(expression=expression))])
+    if any(isinstance(r, REvalError) for r in responses):
+        raise REvalError(conn.eval('geterrmessage()').strip())
+    length = int(responses[1])
+    logger.debug("streaming %s rows of %s in slices of %s", length, expression, chunk_size)
+
+    pending = False
+    try:
+        for start in range(1, length + 1, chunk_size):
+            if not pending:
+                conn.sock.sendall(_slice(start, chunk_size, length))
+            pending = False
+            chunk = _receive(conn, as_arrays)
+            if start + chunk_size <= length:
+                conn.sock.sendall(_slice(start + chunk_size, chunk_size, length))
+                pending = True
+            yield chunk
+    finally:
+        _close(conn, pending, as_arrays)
+
+
+def _slice(start, chunk_size, length):
+    return rEval('{}({}, {})'.format(SLICE_FUNCTION, start, min(start + chunk_size - 1, length)))
+
+
+def _receive(conn, as_arrays):
+    if as_arrays:
+        return arrays.receive_array(conn)
+    return read_answer(conn, lambda: rparse(conn.sock, atomicArray=conn.atomicArray))
+
+
+def _close(conn, pending, as_arrays):
+    """ read the answer to a slice nobody wants any more, and free the value in R """
+    try:
+        if pending:
+            _receive(conn, as_arrays)
+        conn.voidEval(_CLEANUP)
+    except Exception as e:
+        # the connection is broken. whoever reads from it next finds out.
+        logger.debug("could not clean up after streaming: %s", e)
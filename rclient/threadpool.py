@@ -1,22 +1,54 @@
-import os, shutil, time
+import itertools, logging, os, time
 import threading, queue
+from concurrent.futures import Future, as_completed
 import pyRserve
+from pyRserve import rexceptions
+
+from . import fileio, prepared
+from .connector import CONNECTION_ERRORS, run_with_timeout
+from .metrics import REGISTRY, weak_attribute
+from .scheduling import FairQueue, PRIORITY_NORMAL
 
 DEFAULT_THREADCOUNT_SCALE = 5
 DEFAULT_WAITING_JOBS_SCALE = 10
-RESULT_QUEUE_SCALE = 100
 DEFAULT_SUBMIT_TIMEOUT = .5
 
+_pool_names = ('threadpool{}'.format(i) for i in itertools.count(1))
+
+logger = logging.getLogger(__name__)
+
+
+class _Metrics(object):
+    """ what a pool and its threads record """
+
+    def __init__(self, registry, pool):
+        self.submitted = registry.counter('rclient_threadpool_submitted_total', 'jobs queued', pool=pool)
+        self.rejected = registry.counter('rclient_threadpool_rejected_total', 'jobs refused by a full queue',
+                                         pool=pool)
+        self.failed = registry.counter('rclient_threadpool_failed_total', 'jobs that raised', pool=pool)
+        self.reconnects = registry.counter('rclient_threadpool_reconnects_total', 'R connections opened by workers',
+                                           pool=pool)
+        self.queue_wait = registry.histogram('rclient_threadpool_queue_wait_seconds',
+                                             'time jobs waited for a worker', pool=pool)
+        self.run_time = registry.histogram('rclient_threadpool_run_seconds', 'time workers spent on jobs', pool=pool)
+        self.connect = registry.histogram('rclient_threadpool_connect_seconds',
+                                          'time to connect and initialize a worker', pool=pool)
+
 class RConnectorThread(threading.Thread):
     """
         adapted from http://eli.thegreenplace.net/2011/12/27/python-threads-communication-and-stopping
     """
-    def __init__(self, in_q, out_q, initializer=None, support_files=None):
+    def __init__(self, in_q, initializer=None, support_files=None, functions=None, eval_timeout=None, metrics=None):
         """
 
-        :param in_q: input queue of tuples ('id', 'job R code')
-        :param out_q: output queue of tuples ('id', 'result')
+        :param in_q: input queue of tuples ('id', 'job R code', future, timeout, time queued, idempotent) or
+                     ('id', prepared.Call, ...). None stops the thread. a scheduling.FairQueue decides which job
+                     comes next.
         :param initializer: file name that R will source() after the thread starts
+        :param functions: list of (name, R source) of prepared functions, shared with the pool.
+                          functions added to it are defined before the next job.
+        :param eval_timeout: default seconds a job may run before its R process is killed. see RPool
+        :param metrics: the pool's metrics
         """
         super().__init__()
 
@@ -26,43 +58,114 @@ class RConnectorThread(threading.Thread):
             self._files = support_files
 
         self.in_q = in_q
-        self.out_q = out_q
         self._initializer = initializer
-        self._stoprequest = threading.Event()
+        self._functions = functions if functions is not None else []
+        self._defined = 0
+        self._eval_timeout = eval_timeout
+        self._metrics = metrics if metrics is not None else _Metrics(REGISTRY, 'threadpool')
         self.r = None
 
     def run(self):
         """
-             As long as we weren't asked to stop, try to take new tasks from the
-             queue. The tasks are taken with a blocking 'get', so no CPU
-             cycles are wasted while waiting.
-             Also, 'get' is given a timeout, so stoprequest is always checked,
-             even if there's nothing in the queue.
+             Take jobs from the queue until it's closed and empty. The tasks are taken with a blocking 'get',
+             so no CPU cycles are wasted while waiting.
+             Each job's result or exception goes to its future.
+             A closed connection is reopened before the next job. A job whose connection fails while it runs is only
+             run again if it was submitted as idempotent.
         :return:
         """
 
-        self.r = pyRserve.connect()  # todo: args for connection?
+        try:
+            self._connect_and_init()
+        except Exception as e:
+            # the next job tries again
+            logger.error("could not connect to R: %s", e)
         # todo: reset rconnection sometimes?
 
-        self._ready_support_files()
-
-        self._initialize_workspace()
-
-        while not self._stoprequest.isSet():
+        while True:
+            item = self.in_q.get()
+            if item is None:
+                self._close()
+                return
             try:
-                requestor, job = self.in_q.get(block=True, timeout=0.05)  # will this work when queue contains tuples?
-                result = self.r.eval(job)
-                self.out_q.put((requestor, result))
-            except queue.Empty:
-                """ todo: can we use this exception to shutdown the pool like some kind of timeout? """
-                continue
-            except queue.Full:
-                """ should we handle this?"""
+                requestor, job, future, timeout, queued, idempotent = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                start = time.monotonic()
+                self._metrics.queue_wait.observe(start - queued)
+                try:
+                    result = self._run_job_connected(job, timeout, idempotent)
+                except BaseException as e:
+                    self._metrics.failed.inc()
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                self._metrics.run_time.observe(time.monotonic() - start)
+            finally:
+                self.in_q.task_done()
+
+    def _run_job_connected(self, job, timeout, idempotent):
+        """ run a job, reconnecting first if our connection is closed. if the connection fails during the job,
+            it may have run in R already, so it's only run again on a new connection if it's idempotent.
+        """
+        if self.r is None or self.r.isClosed:
+            self._connect_and_init()
+        else:
+            try:
+                self._define_functions()
+            except CONNECTION_ERRORS:
+                # the job wasn't sent yet
+                self._connect_and_init()
+        try:
+            return self._run_job(job, timeout)
+        except CONNECTION_ERRORS:
+            # don't use the broken connection again
+            self._close()
+            if not idempotent:
                 raise
+            self._connect_and_init()
+            return self._run_job(job, timeout)
+
+    def _run_job(self, job, timeout=None):
+        """ run a job. past the timeout, our R process is killed, and we reconnect for the next job """
+        if timeout is None:
+            timeout = self._eval_timeout
+        if isinstance(job, prepared.Call):
+            return run_with_timeout(self.r, timeout, lambda: job(self.r))
+        return run_with_timeout(self.r, timeout, lambda: self.r.eval(job))
+
+    def _connect_and_init(self):
+        """ open a new connection and set it up. if that fails, we are left without one, and the next job retries. """
+        start = time.monotonic()
+        self._close()
+        self.r = None
+        self.r = pyRserve.connect()  # todo: args for connection?
+        try:
+            self._ready_support_files()
+            self._initialize_workspace()
+            self._defined = 0
+            self._define_functions()
+        except BaseException:
+            self._close()
+            self.r = None
+            raise
+        self._metrics.reconnects.inc()
+        self._metrics.connect.observe(time.monotonic() - start)
+
+    def _close(self):
+        """ close our connection, unless a timeout or a failed reconnect already did """
+        if self.r is None or self.r.isClosed:
+            return
+        try:
+            self.r.close()
+        except rexceptions.PyRserveClosed:
+            pass
 
-    def join(self, timeout=None):
-        self._stoprequest.set()
-        super().join(timeout)
+    def _define_functions(self):
+        """ define the prepared functions this R session doesn't have yet """
+        while self._defined < len(self._functions):
+            prepared.define(self.r, *self._functions[self._defined])
+            self._defined += 1
 
     def _ready_support_files(self):
         for file in self._files:
@@ -74,7 +177,7 @@ class RConnectorThread(threading.Thread):
 
     def _upload(self, file):
         if self.is_alive():
-            shutil.copy(file, self.working_dir)
+            fileio.upload(self.r, file)
 
     @property
     def working_dir(self):
@@ -91,11 +194,37 @@ class RPool:
         starts 10 threads and doesn't allow more than 100 jobs to be waiting. User must handle queue.Full exception
         when submitting
 
-        user can either watch rp.results, or call rp.get_result(timeout)
+        submit returns a concurrent.futures.Future for the job's result:
+        future = rp.submit('caller', 'some r code')
+        result = future.result(timeout)
+
+        jobs are queued per caller. more urgent priority classes go first, and callers in the same class share the
+        workers in proportion to their weights:
+        rp = RPool(workers=10, max_waiting_per_caller=100, weights={'dashboard': 4})
+        rp.submit('dashboard', 'score(1)', priority=scheduling.PRIORITY_INTERACTIVE)
+        rp.submit('nightly', 'score(2)', priority=scheduling.PRIORITY_BATCH)
+
+        prepared functions are defined on every connection, and called with binary arguments:
+        rp.prepare('score', 'function(x) sum(x)')
+        rp.submit('caller', prepared.Call('score', numpy.arange(1e6)))
+
+        queue depth, queue wait and run times are recorded in metrics.REGISTRY, labelled with the pool's name:
+        rp = RPool(workers=10, name='wordcount')
 
     """
 
-    def __init__(self, max_waiting=None, workers=None, initializer=None, support_files=None):
+    def __init__(self, max_waiting=None, workers=None, initializer=None, support_files=None,
+                 max_waiting_per_caller=None, weights=None, eval_timeout=None, name=None, metrics=None):
+        """
+        :param max_waiting: jobs waiting in total before submit blocks
+        :param max_waiting_per_caller: jobs one caller may have waiting before its submits block.
+                                       defaults to max_waiting
+        :param weights: {caller: weight} for sharing workers between callers. callers default to weight 1
+        :param eval_timeout: seconds a job may run. past it, the worker's R process is killed, the job's future
+                             raises connector.EvalTimeout, and the worker reconnects. None waits forever.
+        :param name: the pool's label in its metrics
+        :param metrics: metrics.MetricsRegistry to record into. defaults to metrics.REGISTRY
+        """
         if workers is None:
             # Use this number because ThreadPoolExecutor is often
             # used to overlap I/O instead of CPU work.
@@ -104,7 +233,10 @@ class RPool:
         if max_waiting is None:
             max_waiting = workers * DEFAULT_WAITING_JOBS_SCALE
 
-        if workers <= 0 or max_waiting < 0:
+        if max_waiting_per_caller is None:
+            max_waiting_per_caller = max_waiting
+
+        if workers <= 0 or max_waiting < 0 or max_waiting_per_caller < 0:
             raise ValueError
 
         if isinstance(support_files, str):
@@ -112,11 +244,23 @@ class RPool:
 
         self._workers = workers
         self._max_waiting = max_waiting
-        self._job_queue = queue.Queue(maxsize=max_waiting)
-        self._results_queue = queue.Queue(maxsize=max_waiting*RESULT_QUEUE_SCALE)
-        self._threads = set(RConnectorThread(in_q=self.jobs, out_q=self.results, initializer=initializer,
-                                             support_files=support_files) for _ in range(workers)
+        self._job_queue = FairQueue(maxsize=max_waiting, max_per_caller=max_waiting_per_caller)
+        for caller, weight in (weights or {}).items():
+            self._job_queue.set_weight(caller, weight)
+        self._functions = []
+        self.name = name or next(_pool_names)
+        registry = self._registry = REGISTRY if metrics is None else metrics
+        registry.gauge('rclient_threadpool_queued_jobs', 'jobs waiting for a worker',
+                       function=weak_attribute(self, 'queued'), pool=self.name)
+        self._m_workers = weak_attribute(self, 'workers')
+        registry.gauge('rclient_threadpool_workers', 'worker threads', function=self._m_workers, pool=self.name)
+        self._metrics = _Metrics(registry, self.name)
+        self._threads = set(RConnectorThread(in_q=self.jobs, initializer=initializer,
+                                             support_files=support_files, functions=self._functions,
+                                             eval_timeout=eval_timeout, metrics=self._metrics)
+                            for _ in range(workers)
                             )
+        self._started = False
         self._shutdown = False
         self._shutdown_lock = threading.Lock()
 
@@ -125,40 +269,84 @@ class RPool:
         return self._job_queue
 
     @property
-    def results(self):
-        return self._results_queue
+    def queued(self):
+        return self._job_queue.qsize()
+
+    @property
+    def workers(self):
+        return self._workers
 
-    def submit(self, caller, job, timeout=None):
-        """ adds job to queue and annotates it as from 'caller'
-            raises queue.Full if queue is full
+    def submit(self, caller, job, timeout=None, priority=PRIORITY_NORMAL, eval_timeout=None, idempotent=False):
+        """ adds job to caller's queue in the given priority class
+            raises queue.Full if the queue, or caller's queue, is full within timeout seconds
+
+            :param eval_timeout: overrides the pool's eval_timeout for this job
+            :param idempotent: the job may run twice. if its connection fails while it runs, it's run again on a new
+                               one. otherwise the future gets the connection error.
+
+            :return: concurrent.futures.Future of the job's result. cancelling it before a worker takes the job
+                     skips the job.
         """
+        future = Future()
+        future.caller = caller
         with self._shutdown_lock:  # is this a lot of overhead?
             if self._shutdown is False:
-                self.jobs.put((caller, job), block=True, timeout=timeout)
+                try:
+                    self.jobs.put(caller, (caller, job, future, eval_timeout, time.monotonic(), idempotent),
+                                  priority=priority, block=True, timeout=timeout)
+                except queue.Full:
+                    self._metrics.rejected.inc()
+                    raise
+                self._metrics.submitted.inc()
             else:
                 raise RuntimeError("Pool is shutting down. No more jobs accepted.")
+        return future
 
-    def get_result(self, timeout=None):
-        _res = self.results.get(block=True, timeout=timeout)
-        return _res
+    def set_weight(self, caller, weight):
+        """ change caller's share of the workers """
+        self.jobs.set_weight(caller, weight)
+
+    def prepare(self, name, r_source):
+        """ define an R function on every connection before its next job, and on reconnected ones.
+            submit prepared.Call(name, *args, **kwargs) jobs to call it with binary arguments.
+        """
+        self._functions.append((prepared.check_name(name), r_source))
 
     def start(self):
+        self._started = True
         for _t in self._threads:
             _t.start()
 
     def stop(self, flush=False, wait=True):
         """ Stops further submission.
-            Completes all pending jobs if flush is True
+            Completes all pending jobs if flush is True, otherwise cancels the jobs that haven't started
             Joins all threads if wait is True
-            join pooled threads. wait for queue to complete if flush==True
         """
         with self._shutdown_lock:
             self._shutdown = True
-        if flush is True:
+        if flush is False or self._started is False:
+            self._cancel_pending()
+        if flush is True and self._started is True:
             self.jobs.join()
-        if wait is True:
+        # threads finish the remaining jobs, then get None and stop
+        self.jobs.close()
+        if wait is True and self._started is True:
             for _t in self._threads:
                 _t.join()
+        # unless a newer pool with our name has taken the metrics over
+        if self._registry.gauge('rclient_threadpool_workers', pool=self.name).function is self._m_workers:
+            self._registry.remove(pool=self.name)
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                item = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            item[2].cancel()
+            self.jobs.task_done()
 
 
 if __name__ == '__main__':
@@ -176,13 +364,11 @@ if __name__ == '__main__':
 
     rpool.start()
 
-    for j in testjobs:
-        rpool.submit(*j)
+    futures = [rpool.submit(*j) for j in testjobs]
 
-    while True:
-        try:
-            print(rpool.get_result(timeout=20))
-        except queue.Empty:
-            break
+    for f in as_completed(futures, timeout=20):
+        print(f.caller, f.result())
+
+    rpool.stop()
 
 
@@ -1,10 +1,19 @@
-import shutil, threading
+import itertools
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
 import pyRserve
 from pyRserve import rexceptions
 
-from tornado.concurrent import run_on_executor
+from tornado.concurrent import Future, run_on_executor
+
+from . import fileio, prepared, profiling
+from .cache import content_version
+from .connector import CONNECTION_ERRORS, run_with_timeout
+from .metrics import REGISTRY, ExecutorMetrics
+
+_pool_names = ('tornado{}'.format(i) for i in itertools.count(1))
 
 class RPoolTornado:
     """ An interface to a concurrent.futures.ThreadPoolExecutor of R connections
@@ -24,44 +33,188 @@ class RPoolTornado:
 
         rp.r_eval("some r code", some_callback)
 
+        cache deterministic results:
+        rp = RPoolTornado(max_workers=10, cache=ResultCache(ttl=300))
+        rp.r_eval("lookup_table()")
+        rp.r_eval("runif(1)", cached=False)
+
+        prepared functions are defined on every connection, and called with binary arguments:
+        rp.prepare('score', 'function(x) sum(x)')
+        future_result = rp.r_call('score', numpy.arange(1e6))
+
+        queue depth, queue wait, run and connect times are recorded in metrics.REGISTRY:
+        rp = RPoolTornado(max_workers=10, name='wordcount')
+
     """
 
-    def __init__(self, max_workers=None, initializer=None, support_files=None, *args, **kwargs):
+    def __init__(self, max_workers=None, initializer=None, support_files=None, *args, cache=None, eval_timeout=None,
+                 name=None, metrics=None, profiler=None, **kwargs):
+        """
+        :param cache: optional cache.ResultCache for r_eval results
+        :param eval_timeout: seconds an evaluation may take. past it, the connection's R process is killed and the
+                             future raises connector.EvalTimeout. the thread reconnects on its next evaluation.
+        :param name: the pool's label in its metrics
+        :param metrics: metrics.MetricsRegistry to record into. defaults to metrics.REGISTRY
+        :param profiler: optional profiling.Profiler tracing where each r_eval's time goes, including the time it
+                         waited for a thread
+        """
         self._t_local = threading.local()
         self._pool = ThreadPoolExecutor(max_workers=max_workers)
         self.initializer = initializer
         self.support_files = support_files
+        self._functions = []  # (name, R source) of prepared functions
+        self.cache = cache
+        self._cache_version = None
+        self._update_cache_version()
+        self.eval_timeout = eval_timeout
+        self.profiler = profiler
+        self.name = name or next(_pool_names)
+        self._metrics = ExecutorMetrics('RPoolTornado', self.name, REGISTRY if metrics is None else metrics)
         self._r_conn_args = args
         self._r_conn_kwargs = kwargs
 
-    @run_on_executor(executor='_pool')
-    def r_eval(self, code, callback=None):
+    def r_eval(self, code, callback=None, cached=True, timeout=None, idempotent=False):
         """ Evaluate R Code on the pool of R servers
             Initialize the connection if it is not currently connected
 
             :param code: String of R code
             :param callback: optional function to be called with return value
+            :param cached: False to bypass the result cache for this call
+            :param timeout: overrides the pool's eval_timeout
+            :param idempotent: the code may run twice. if the connection fails while it runs, it's run again on a new
+                               connection. otherwise the future raises the connection error.
+            :return: Future
+        """
+        if self.cache is not None and cached:
+            hit, result = self.cache.get((self._cache_version, code))
+            if hit:
+                future = Future()
+                future.set_result(result)
+                return future
+        trace = profiling.Trace(code, self.name) if self.profiler is not None else None
+        return self._r_eval(code, callback, cached, timeout, self._metrics.enqueued(), trace, idempotent)
+
+    @run_on_executor(executor='_pool')
+    def _r_eval(self, code, callback=None, cached=True, timeout=None, queued=None, trace=None, idempotent=False):
+
+        if trace is None:
+            result = self._on_connection(lambda rconn: rconn.eval(code), timeout, queued, idempotent)
+        else:
+            result = self._traced_eval(code, timeout, queued, trace, idempotent)
+        #print("returning ", result)
+        if self.cache is not None and cached:
+            self.cache.put((self._cache_version, code), result)
+        return result
+
+    def _traced_eval(self, code, timeout, queued, trace, idempotent):
+        """ eval, handing a trace of where the time went to the profiler """
+        trace.mark('queue')
+
+        def work(rconn):
+            trace.mark('checkout')
+            return profiling.traced_eval(rconn, code, trace)
+
+        try:
+            return self._on_connection(work, timeout, queued, idempotent)
+        except BaseException as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            self.profiler.record(trace)
+
+    def prepare(self, name, r_source):
+        """ define an R function on every connection before its next evaluation, and on reconnected ones """
+        self._functions.append((prepared.check_name(name), r_source))
+        self._update_cache_version()
+
+    def r_call(self, name, *args, **kwargs):
+        """ Call a prepared function on the pool, passing the arguments as binary R objects
+
             :return: Future
         """
+        return self._r_call(name, args, kwargs, self._metrics.enqueued())
+
+    @run_on_executor(executor='_pool')
+    def _r_call(self, name, args, kwargs, queued):
+        return self._on_connection(lambda rconn: prepared.call(rconn, name, *args, **kwargs), queued=queued)
+
+    def shutdown(self, wait=True):
+        """ stop taking evaluations and drop the pool's metrics
+
+            :param wait: wait for the evaluations already submitted to finish
+        """
+        self._pool.shutdown(wait=wait)
+        self._metrics.remove()
 
-        # fixme: this is rather ugly
+    def _update_cache_version(self):
+        """ key cached results on the code the connections run """
+        if self.cache is not None:
+            self._cache_version = content_version(self.initializer, *(self.support_files or ())) + \
+                repr(self._functions)
+
+    def _on_connection(self, work, timeout=None, queued=None, idempotent=False):
+        """ run work(rconn) on this thread's connection, connecting and initializing it first if needed
+
+            :param queued: when the job was submitted, from ExecutorMetrics.enqueued
+            :param idempotent: run work again on a new connection if the connection fails while it runs
+        """
+        if timeout is None:
+            timeout = self.eval_timeout
+        start = self._metrics.started(queued) if queued is not None else time.monotonic()
         try:
-            result = self._t_local.rconn.eval(code)
-        except AttributeError:
-            # connection not yet made
+            return self._on_connection_timed(work, timeout, idempotent)
+        except BaseException:
+            self._metrics.failed.inc()
+            raise
+        finally:
+            self._metrics.run_time.observe(time.monotonic() - start)
+
+    def _on_connection_timed(self, work, timeout, idempotent):
+
+        def timed_work():
+            rconn = self._t_local.rconn
+            return run_with_timeout(rconn, timeout, lambda: work(rconn))
+
+        rconn = getattr(self._t_local, 'rconn', None)
+        if rconn is None or rconn.isClosed:
+            # connection not yet made, closed by a timeout, or its reconnect failed
             self._connect_and_init()
-            result = self._t_local.rconn.eval(code)
-        except rexceptions.PyRserveClosed:
-            # need to re-initialize connection
+        else:
+            try:
+                self._define_functions()
+            except CONNECTION_ERRORS:
+                # the work wasn't sent yet
+                self._connect_and_init()
+
+        try:
+            return timed_work()
+        except CONNECTION_ERRORS:
+            # the work may have run in R already. don't use the broken connection again.
+            self._close_rconn()
+            if not idempotent:
+                raise
             self._connect_and_init()
-            result = self._t_local.rconn.eval(code)
-        #print("returning ", result)
-        return result
+            return timed_work()
 
-    @staticmethod
-    def _upload(file, dest_dir):
-        """ If Rserve isn't on the local host, we'll need to update this function """
-        shutil.copy(file, dest_dir)
+    def _close_rconn(self):
+        rconn, self._t_local.rconn = getattr(self._t_local, 'rconn', None), None
+        if rconn is not None and not rconn.isClosed:
+            try:
+                rconn.close()
+            except rexceptions.PyRserveClosed:
+                pass
+
+    def _define_functions(self):
+        """ define the prepared functions this thread's R session doesn't have yet """
+        while self._t_local.defined < len(self._functions):
+            prepared.define(self._t_local.rconn, *self._functions[self._t_local.defined])
+            self._t_local.defined += 1
+
+    def _upload(self, file, dest_dir):
+        """ Files are linked from the staging cache rather than copied into every connection's working dir.
+            If Rserve isn't on the local host, they are streamed through the connection instead.
+        """
+        fileio.upload(self._t_local.rconn, file, local_dir=dest_dir)
 
     def _prepare_support_files(self):
         """ Copy any support files into working dir """
@@ -81,9 +234,22 @@ class RPoolTornado:
         self._t_local.wd = self._t_local.rconn.r.getwd()
 
     def _connect_and_init(self):
-        self._initialize_rconn()
-        self._prepare_support_files()
-        self._prepare_initializer()
+        """ open this thread's connection and set it up. if that fails, the thread is left without one, and its next
+            evaluation tries again.
+        """
+        start = time.monotonic()
+        self._close_rconn()
+        try:
+            self._initialize_rconn()
+            self._prepare_support_files()
+            self._prepare_initializer()
+            self._t_local.defined = 0
+            self._define_functions()
+        except BaseException:
+            self._close_rconn()
+            raise
+        self._metrics.reconnects.inc()
+        self._metrics.connect.observe(time.monotonic() - start)
 
 
 
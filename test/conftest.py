@@ -0,0 +1,25 @@
+import pytest
+from pyRserve.rconn import RSERVEPORT
+
+from rclient.fake_rserve import FakeRserve
+
+
+@pytest.fixture
+def server():
+    """ a fake Rserve on a free port """
+    with FakeRserve() as server:
+        yield server
+
+
+@pytest.fixture
+def slow_server():
+    """ a fake Rserve taking 50ms per eval """
+    with FakeRserve(delay=.05) as server:
+        yield server
+
+
+@pytest.fixture
+def default_port_server():
+    """ a fake Rserve on Rserve's default port, for clients that always connect there """
+    with FakeRserve(port=RSERVEPORT) as server:
+        yield server
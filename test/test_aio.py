@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+from pyRserve.rexceptions import PyRserveClosed, REvalError
+
+from rclient.aio import AsyncRConnector, AsyncRServePool
+from rclient.connector import PoolEmpty
+from rclient.fake_rserve import FakeRserve
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_connector_eval(server):
+    async def evaluate():
+        c = await AsyncRConnector(port=server.port).connect()
+        try:
+            await c.voidEval('x <- 20')
+            await c.assign({'y': 1.5})
+            return await c.eval('x + y')
+        finally:
+            await c.close()
+    assert run(evaluate()) == 21.5
+
+
+def test_connector_reports_r_errors(server):
+    async def evaluate():
+        c = await AsyncRConnector(port=server.port).connect()
+        try:
+            with pytest.raises(REvalError, match='not found'):
+                await c.eval('missing')
+            # still in step after the error
+            return await c.eval('1 + 1')
+        finally:
+            await c.close()
+    assert run(evaluate()) == 2
+
+
+def test_concurrent_evals_share_one_connection(server):
+    async def evaluate():
+        c = await AsyncRConnector(port=server.port).connect()
+        try:
+            return await asyncio.gather(*[c.eval('{} * 2'.format(i)) for i in range(20)])
+        finally:
+            await c.close()
+    assert run(evaluate()) == [i * 2 for i in range(20)]
+
+
+def test_pool_evaluates_concurrently(slow_server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=2, max_size=10, realtime=True, port=slow_server.port) as pool:
+            start = time.monotonic()
+            results = await asyncio.gather(*[pool.eval('{} + 1'.format(i)) for i in range(10)])
+            return results, time.monotonic() - start, pool.size
+    results, seconds, size = run(evaluate())
+    assert results == [i + 1 for i in range(10)]
+    # one after the other, they'd take .5s
+    assert seconds < .3
+    assert size == 10
+
+
+def test_checkout_times_out_at_max_size(slow_server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=1, realtime=True, port=slow_server.port) as pool:
+            async with pool.connect():
+                with pytest.raises(PoolEmpty):
+                    await pool.connect(timeout=.05)
+    run(evaluate())
+
+
+def test_idle_connections_above_pool_size_are_reaped(server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=4, realtime=True, idle_timeout=.1,
+                                   port=server.port) as pool:
+            checkouts = [await pool.connect() for _ in range(4)]
+            for c in checkouts:
+                await c.close()
+            grown = pool.size
+            await asyncio.sleep(.5)
+            return grown, pool.size, await pool.eval('1')
+    assert run(evaluate()) == (4, 1, 1)
+
+
+def test_server_restart_mid_request(server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=1, realtime=True, port=server.port) as pool:
+            request = asyncio.ensure_future(pool.eval('Sys.sleep(5); 1'))
+            await asyncio.sleep(.2)
+            server.drop_connections()
+            server.stop()
+            with pytest.raises(PyRserveClosed):
+                await request
+
+            with FakeRserve(port=server.port):
+                # the broken connection isn't pooled again, a new one is opened
+                return await pool.eval('1 + 1'), pool.size
+    assert run(evaluate()) == (2, 1)
+
+
+@pytest.mark.parametrize('realtime', [True, False])
+def test_cancelled_eval_does_not_leave_an_answer_behind(slow_server, realtime):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=1, realtime=realtime, port=slow_server.port) as pool:
+            request = asyncio.ensure_future(pool.eval('"stale"'))
+            await asyncio.sleep(.01)
+            request.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await request
+            await asyncio.sleep(.1)
+            # the next request gets its own answer, not the cancelled one's
+            return await pool.eval('"fresh"'), pool.size
+    assert run(evaluate()) == ('fresh', 1)
+
+
+def test_cancelled_checkout_frees_nothing_it_did_not_take(slow_server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=1, realtime=True, port=slow_server.port) as pool:
+            async with pool.connect():
+                waiting = asyncio.ensure_future(pool._checkout())
+                await asyncio.sleep(.05)
+                waiting.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await waiting
+            return await pool.eval('1'), pool.size
+    assert run(evaluate()) == (1, 1)
+
+
+def test_workspace_reset(server):
+    async def evaluate():
+        async with AsyncRServePool(pool_size=1, max_size=1, reset_strategy='workspace', port=server.port) as pool:
+            async with pool.connect() as c:
+                pid = await c.eval('Sys.getpid()')
+                await c.voidEval('leftover <- 1')
+            await asyncio.sleep(.1)
+            async with pool.connect() as c:
+                with pytest.raises(REvalError):
+                    await c.eval('leftover')
+                return pid == await c.eval('Sys.getpid()')
+    assert run(evaluate())
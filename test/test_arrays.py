@@ -0,0 +1,89 @@
+import numpy
+import pytest
+from pyRserve.rexceptions import PyRserveClosed
+
+from rclient import arrays
+from rclient.connector import RServeConnection
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=1, max_size=1, realtime=True, port=server.port)
+    yield pool
+    pool.close()
+
+
+@pytest.mark.parametrize('array', [
+    numpy.arange(10.),
+    numpy.arange(10.)[::2],
+    numpy.arange(10, dtype=numpy.int64)[::-3],
+    numpy.arange(12.).reshape(3, 4),
+    numpy.asfortranarray(numpy.arange(12.).reshape(3, 4)),
+    numpy.arange(24.).reshape(4, 6)[::2, 1::2],
+    numpy.arange(24, dtype=numpy.int32).reshape(4, 6).T[::2],
+], ids=['1d', '1d strided', '1d reversed int64', '2d C order', '2d F order', '2d strided', '2d transposed strided'])
+def test_assign_array_round_trip(pool, array):
+    with pool.connect() as c:
+        c.assign_array('x', array)
+        result = c.fetch_array('x')
+        assert c.eval('TRUE') is True
+    numpy.testing.assert_array_equal(result, array)
+    assert result.shape == array.shape
+
+
+def test_assign_array_keeps_pool_in_step(pool):
+    with pool.connect() as c:
+        c.assign_array('x', numpy.arange(10.)[::2])
+    # the same connection, after the strided assign
+    assert pool.eval('TRUE', cached=False) is True
+    assert pool.size == 1
+
+
+def test_fetch_array_of_large_matrix(pool):
+    array = numpy.random.rand(1000, 600)
+    with pool.connect() as c:
+        c.assign_array('m', array)
+        numpy.testing.assert_array_equal(c.fetch_array('m'), array)
+
+
+def test_unsupported_dtype_sends_nothing(pool):
+    with pool.connect() as c:
+        with pytest.raises(TypeError):
+            c.assign_array('x', numpy.array(['a', 'b']))
+        assert c.eval('TRUE') is True
+
+
+def test_failure_after_header_closes_connection(pool, monkeypatch):
+    sent = []
+
+    class Broken(Exception):
+        pass
+
+    with pool.connect() as c:
+        conn = c.connection
+        sendall = conn.sock.sendall
+
+        def fail_on_data(data):
+            sent.append(data)
+            if len(sent) == 2:
+                raise Broken()
+            sendall(data)
+
+        monkeypatch.setattr(conn, 'sock', _Socket(conn.sock, fail_on_data))
+        with pytest.raises(Broken):
+            arrays.assign_array(conn, 'x', numpy.arange(10.))
+        assert conn.isClosed
+        with pytest.raises(PyRserveClosed):
+            c.eval('TRUE')
+    # the closed connection was discarded, not pooled
+    assert pool.size == 0
+    assert pool.eval('TRUE', cached=False) is True
+
+
+class _Socket(object):
+    def __init__(self, sock, sendall):
+        self._sock = sock
+        self.sendall = sendall
+
+    def __getattr__(self, item):
+        return getattr(self._sock, item)
@@ -0,0 +1,17 @@
+import os
+
+from rclient import bench
+
+
+def test_run_in_process():
+    report = bench.run(targets=('realtime', 'tornado'), concurrency=(2,), requests=10, delay=0, payload=10,
+                       port=16411, in_process=True)
+    assert [(r['target'], r['requests'], r['errors']) for r in report['results']] == [('realtime', 10, 0),
+                                                                                      ('tornado', 10, 0)]
+
+
+def test_fake_server_subprocess_leaves_environment_alone():
+    environ = dict(os.environ)
+    with bench.fake_server(16412) as fleet:
+        assert fleet.daemons[0].ready()
+    assert dict(os.environ) == environ
@@ -0,0 +1,98 @@
+import time
+
+import numpy
+import pytest
+from pyRserve.taggedContainers import TaggedList
+
+from rclient.cache import ResultCache, content_version
+from rclient.connector import RServeConnection
+
+
+def test_least_recently_used_are_evicted():
+    cache = ResultCache(max_bytes=3 * 8000 + 1000)
+    for key in 'abc':
+        cache.put(key, numpy.zeros(1000))
+    cache.get('a')
+    cache.put('d', numpy.zeros(1000))
+    assert [cache.get(key)[0] for key in 'abcd'] == [True, False, True, True]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_results_bigger_than_the_cache_are_not_kept():
+    cache = ResultCache(max_bytes=1000)
+    cache.put('big', numpy.zeros(1000))
+    assert cache.get('big') == (False, None)
+    assert len(cache) == 0
+
+
+def test_entries_expire():
+    cache = ResultCache(ttl=.05)
+    cache.put('a', 1)
+    assert cache.get('a') == (True, 1)
+    time.sleep(.1)
+    assert cache.get('a') == (False, None)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations'], stats['entries']) == (1, 1, 1, 0)
+
+
+def test_content_version_follows_content(tmp_path):
+    bundle = tmp_path / 'bundle'
+    bundle.mkdir()
+    (bundle / 'model.R').write_text('f <- function(x) x')
+    version = content_version(str(bundle), None)
+    assert content_version(str(bundle)) == version
+
+    (bundle / 'model.R').write_text('f <- function(x) x * 2')
+    changed = content_version(str(bundle))
+    assert changed != version
+
+    (bundle / 'data.csv').write_text('1,2')
+    assert content_version(str(bundle)) not in (version, changed)
+    # paths that don't exist still count by name
+    assert content_version('init.R') != content_version('other.R')
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=1, realtime=True, cache=ResultCache(), port=server.port)
+    yield pool
+    pool.close()
+
+
+def test_eval_is_served_from_the_cache(pool):
+    value = pool.eval('rnorm(1)')
+    assert pool.eval('rnorm(1)') == value
+    assert pool.eval('rnorm(1)', cached=False) != value
+    assert pool.eval('rnorm(1)', idempotent=False) != value
+    assert pool.cache.stats()['hits'] == 1
+
+
+def test_upload_invalidates_cached_results(pool, tmp_path):
+    value = pool.eval('rnorm(1)')
+    upload = tmp_path / 'lookup.csv'
+    upload.write_text('1,2')
+    pool.upload(str(upload), unpack=False)
+    assert pool.eval('rnorm(1)') != value
+
+
+def test_prepare_invalidates_cached_results(pool):
+    value = pool.eval('rnorm(1)')
+    pool.prepare('double_it', 'function(x) x * 2')
+    assert pool.eval('rnorm(1)') != value
+
+
+def test_shared_buffers_are_counted_once():
+    cache = ResultCache()
+    array = numpy.zeros(1000)
+    cache.put('arrays', [array, array[::2], array[10:]])
+    assert 8000 < cache.stats()['bytes'] < 8000 + 1000
+
+
+def test_tagged_lists_are_sized_by_their_values():
+    cache = ResultCache(max_bytes=5 * 10 ** 6)
+    frame = TaggedList([('x', numpy.zeros(250000)), ('y', numpy.ones(250000))])
+    cache.put('first', frame)
+    assert cache.stats()['bytes'] > 4 * 10 ** 6
+    cache.put('second', TaggedList([('x', numpy.zeros(250000)), ('y', numpy.ones(250000))]))
+    assert cache.get('first') == (False, None)
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,126 @@
+import struct
+
+import numpy
+import pytest
+from pyRserve import rtypes
+from pyRserve.rparser import rparse
+
+from rclient import columnar
+from rclient.columnar import NA_INTEGER, Factor, Frame
+from rclient.connector import RServeConnection
+
+
+def _sexp(type, content, attributes=b''):
+    if attributes:
+        type |= rtypes.XT_HAS_ATTR
+    body = attributes + content
+    return struct.pack('<I', type | (len(body) << 8)) + body
+
+
+def _padded(data, pad):
+    return data + pad * (-len(data) % 4)
+
+
+def _strings(values):
+    data = b''.join((b'\xff' if v is None else v.encode('utf-8')) + b'\0' for v in values)
+    return _sexp(rtypes.XT_ARRAY_STR, _padded(data, b'\x01'))
+
+
+def _symbol(name):
+    return _sexp(rtypes.XT_SYMNAME, _padded(name.encode('utf-8') + b'\0', b'\0'))
+
+
+def _attributes(**attributes):
+    return _sexp(rtypes.XT_LIST_TAG, b''.join(value + _symbol(name.replace('_', '.'))
+                                              for name, value in attributes.items()))
+
+
+def _ints(values, attributes=b''):
+    return _sexp(rtypes.XT_ARRAY_INT, numpy.array(values, dtype='<i4').tobytes(), attributes)
+
+
+def _message(sexp):
+    body = struct.pack('<I', rtypes.DT_SEXP | (len(sexp) << 8)) + sexp
+    return bytearray(struct.pack('<IIII', rtypes.RESP_OK, len(body), 0, 0) + body)
+
+
+def _data_frame(nrow=3):
+    columns = [
+        _sexp(rtypes.XT_ARRAY_DOUBLE, numpy.array([1.5, 2.5, 3.5][:nrow], dtype='<f8').tobytes()),
+        _ints([1, NA_INTEGER, 3][:nrow]),
+        _ints([2, 1, 2][:nrow], _attributes(levels=_strings(['low', 'high']), **{'class': _strings(['factor'])})),
+        _strings(['a', None, 'c'][:nrow]),
+        _sexp(rtypes.XT_ARRAY_BOOL, _padded(struct.pack('<i', nrow) + bytes([1, 0, 2][:nrow]), b'\xff')),
+    ]
+    attributes = _attributes(names=_strings(['price', 'count', 'level', 'label', 'flag']),
+                             row_names=_ints([NA_INTEGER, -nrow]),
+                             **{'class': _strings(['data.frame'])})
+    return _message(_sexp(rtypes.XT_VECTOR, b''.join(columns), attributes))
+
+
+def test_data_frame_columns():
+    message = _data_frame()
+    frame = columnar.parse(message)
+    assert isinstance(frame, Frame)
+    assert (frame.nrow, frame.names, frame.row_names) == (3, ['price', 'count', 'level', 'label', 'flag'], None)
+
+    assert frame['price'].tolist() == [1.5, 2.5, 3.5]
+    assert frame['count'].tolist() == [1, NA_INTEGER, 3]
+    assert frame['label'].tolist() == ['a', None, 'c']
+    assert frame['flag'].tolist() == [True, False, None]
+
+    level = frame['level']
+    assert isinstance(level, Factor)
+    assert level.codes.tolist() == [2, 1, 2]
+    assert level.values().tolist() == ['high', 'low', 'high']
+    assert not level.ordered
+
+
+def test_numeric_columns_view_the_answer():
+    message = _data_frame()
+    frame = columnar.parse(message)
+    price = frame['price']
+    assert not price.flags.owndata
+    assert numpy.shares_memory(price, numpy.frombuffer(message, dtype=numpy.uint8))
+
+
+def test_matches_pyrserve():
+    message = _data_frame()
+    frame = columnar.parse(message)
+    expected = rparse(bytes(message))
+    assert list(expected.keys) == frame.names
+    assert list(expected['price']) == frame['price'].tolist()
+    assert list(expected['label']) == ['a', None, 'c']
+
+
+def test_empty_data_frame():
+    frame = columnar.parse(_data_frame(nrow=0))
+    assert frame.nrow == 0
+    assert [len(frame[name]) for name in frame] == [0] * 5
+
+
+def test_other_results_are_left_to_pyrserve():
+    message = _message(_ints([1, 2, 3]))
+    assert columnar.parse(message).tolist() == [1, 2, 3]
+    # a list that isn't a data frame
+    message = _message(_sexp(rtypes.XT_VECTOR, _ints([1]) + _strings(['a'])))
+    assert repr(columnar.parse(message)) == repr(rparse(bytes(message)))
+
+
+def test_to_pandas():
+    pandas = pytest.importorskip('pandas')
+    df = columnar.parse(_data_frame()).to_pandas()
+    assert list(df.columns) == ['price', 'count', 'level', 'label', 'flag']
+    assert df['count'].isna().tolist() == [False, True, False]
+    assert isinstance(df['level'].dtype, pandas.CategoricalDtype)
+
+
+def test_eval_columnar_without_a_data_frame(server):
+    pool = RServeConnection(pool_size=1, realtime=True, port=server.port)
+    try:
+        assert list(pool.eval('seq_len(3)', columnar=True)) == [1, 2, 3]
+        with pool.connect() as c:
+            assert c.eval_columnar('1 + 1') == 2
+            assert c.eval('2 + 2') == 4
+    finally:
+        pool.close()
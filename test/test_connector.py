@@ -0,0 +1,151 @@
+import gc
+import inspect
+import threading
+import time
+
+import pytest
+from pyRserve.rexceptions import REvalError
+
+from rclient.connector import PoolEmpty, RESET_RECONNECT, RESET_STRATEGIES, RServeConnection
+from rclient.tornado_executor import RPoolTornado
+
+
+def test_positional_arguments_go_to_the_constructor(server):
+    pool = RServeConnection(1, True, 'localhost', server.port)
+    try:
+        assert pool.max_size == 2
+        assert pool.eval('1 + 1') == 2
+    finally:
+        pool.close()
+
+
+def test_options_are_keyword_only():
+    for cls, positional in ((RServeConnection, ['self', 'pool_size', 'realtime']),
+                            (RPoolTornado, ['self', 'max_workers', 'initializer', 'support_files'])):
+        parameters = inspect.signature(cls.__init__).parameters.values()
+        assert [p.name for p in parameters if p.kind == p.POSITIONAL_OR_KEYWORD] == positional
+
+
+@pytest.mark.filterwarnings('error::pytest.PytestUnraisableExceptionWarning')
+@pytest.mark.parametrize('kwargs', [dict(pool_size=-1), dict(pool_size=2, max_size=1), dict(reset_strategy='nope')])
+def test_invalid_options(kwargs):
+    with pytest.raises(ValueError):
+        RServeConnection(**kwargs)
+    gc.collect()
+
+
+@pytest.mark.parametrize('strategy', RESET_STRATEGIES)
+def test_reset_clears_the_session(server, strategy):
+    pool = RServeConnection(pool_size=1, max_size=1, reset_strategy=strategy, port=server.port)
+    try:
+        with pool.connect() as c:
+            pid = c.eval('Sys.getpid()')
+            c.voidEval('x <- 1')
+        with pool.connect() as c:
+            with pytest.raises(REvalError):
+                c.eval('x')
+            assert (c.eval('Sys.getpid()') != pid) == (strategy == RESET_RECONNECT)
+    finally:
+        pool.close()
+
+
+def test_resets_run_in_parallel(server):
+    pool = RServeConnection(pool_size=4, max_size=4, reset_strategy=RESET_RECONNECT, port=server.port)
+    try:
+        connections = [pool.connect() for _ in range(4)]
+        start = time.monotonic()
+        for c in connections:
+            c.close()
+        _wait_for(lambda: pool.idle == 4)
+        # a reconnect takes pyRserve at least .2s. one worker would take .8s for the four of them.
+        assert time.monotonic() - start < .6
+    finally:
+        pool.close()
+
+
+def test_reset_after_close_closes_the_connection(server):
+    pool = RServeConnection(pool_size=1, max_size=1, reset_strategy=RESET_RECONNECT, port=server.port)
+    c = pool.connect()
+    conn = c.connection
+    c.close()
+    # the reconnect takes at least .2s, so the pool is closed while it runs
+    pool.close()
+    _wait_for(lambda: pool.size == 0)
+    assert conn.isClosed
+    assert pool.idle == 0
+
+
+def test_pool_grows_to_max_size_and_blocks(server):
+    pool = RServeConnection(pool_size=1, realtime=True, max_size=2, port=server.port)
+    try:
+        first, second = pool.connect(), pool.connect()
+        assert (pool.size, pool.in_use, pool.overflow) == (2, 2, 1)
+        with pytest.raises(PoolEmpty):
+            pool.connect(timeout=.05)
+
+        threading.Timer(.1, first.close).start()
+        start = time.monotonic()
+        third = pool.connect(timeout=5)
+        assert time.monotonic() - start >= .05
+        third.close()
+        second.close()
+        assert (pool.size, pool.idle) == (2, 2)
+    finally:
+        pool.close()
+
+
+def test_idle_connections_above_pool_size_are_reaped(server):
+    pool = RServeConnection(pool_size=1, realtime=True, max_size=3, idle_timeout=.1, port=server.port)
+    try:
+        connections = [pool.connect() for _ in range(3)]
+        for c in connections:
+            c.close()
+        assert pool.size == 3
+        _wait_for(lambda: pool.size == 1)
+        assert pool.idle == 1
+        assert pool.eval('1 + 1') == 2
+    finally:
+        pool.close()
+
+
+def test_blocking_init_opens_connections_in_parallel(server):
+    start = time.monotonic()
+    pool = RServeConnection(pool_size=4, realtime=True, port=server.port)
+    try:
+        # pyRserve takes .2s to connect. one after another, the four would take .8s.
+        assert time.monotonic() - start < .6
+        assert (pool.size, pool.idle) == (4, 4)
+    finally:
+        pool.close()
+
+
+def test_non_blocking_init_serves_callers_once_connected(server):
+    start = time.monotonic()
+    pool = RServeConnection(pool_size=2, realtime=True, blocking_init=False, port=server.port)
+    try:
+        # pyRserve takes .2s to connect
+        assert time.monotonic() - start < .2
+        assert pool.eval('1 + 1') == 2
+        _wait_for(lambda: pool.idle == 2)
+    finally:
+        pool.close()
+
+
+def test_sweeper_replaces_broken_connections(server):
+    pool = RServeConnection(pool_size=2, realtime=True, sweep_interval=.05, validate_after=None,
+                            port=server.port)
+    try:
+        broken = list(pool.pool)
+        server.drop_connections()
+        _wait_for(lambda: pool.idle == 2 and not set(pool.pool) & set(broken))
+        assert pool.size == 2
+        assert pool.eval('1 + 1') == 2
+    finally:
+        pool.close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(.01)
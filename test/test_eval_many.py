@@ -0,0 +1,44 @@
+import pytest
+from pyRserve.rexceptions import REvalError
+
+from rclient.connector import RServeConnection
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=1, max_size=1, realtime=True, port=server.port)
+    yield pool
+    pool.close()
+
+
+def test_failed_expression_gets_an_error_in_its_place(pool):
+    results = pool.eval_many(['1 + 1', 'missing', '"three"'])
+    assert results[0] == 2
+    assert isinstance(results[1], REvalError)
+    assert 'missing' in str(results[1])
+    assert results[2] == 'three'
+
+
+def test_expressions_share_the_session(pool):
+    with pool.connect() as c:
+        assert c.eval_many(['x <- 2', 'x * 3']) == [2, 6]
+        assert c.eval('x') == 2
+
+
+def test_single_expression(pool):
+    assert pool.eval_many(['1 + 1']) == [2]
+    with pool.connect() as c:
+        [error] = c.eval_many(['stop("boom")'])
+    assert isinstance(error, REvalError)
+
+
+def test_empty_batch(pool):
+    assert pool.eval_many([]) == []
+    assert pool.eval_many(iter(())) == []
+
+
+def test_batch_variable_is_removed(pool):
+    with pool.connect() as c:
+        c.eval_many(['1'])
+        with pytest.raises(REvalError):
+            c.eval('.rclient_batch')
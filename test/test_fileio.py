@@ -0,0 +1,85 @@
+import os
+
+import pyRserve
+import pytest
+
+from rclient import fileio
+from rclient.connector import RServeConnection
+from rclient.fake_rserve import FakeRserve
+
+
+@pytest.fixture
+def small_server():
+    """ a fake Rserve refusing messages over 64kb """
+    with FakeRserve(maxinbuf=64 * 1024) as server:
+        yield server
+
+
+def test_chunk_size_fits_maxinbuf():
+    assert fileio.chunk_size_for(64 * 1024) == 64 * 1024 - fileio.HEADER.size - fileio.DATA_HEADER_SIZE
+    assert fileio.chunk_size_for(None) == fileio.DEFAULT_CHUNK_SIZE
+    with pytest.raises(ValueError):
+        fileio.chunk_size_for(16)
+
+
+def test_read_maxinbuf(tmp_path):
+    path = tmp_path / 'rserve.conf'
+    path.write_text('workdir /tmp/Rserv\n# in kb\nmaxinbuf 64\n')
+    assert fileio.read_maxinbuf(str(path)) == 64 * 1024
+    assert fileio.read_maxinbuf(str(tmp_path / 'missing.conf')) is None
+
+
+def test_local_config_is_not_consulted(tmp_path, monkeypatch):
+    # an rserve.conf in the working directory says nothing about the server we upload to
+    (tmp_path / 'rserve.conf').write_text('maxinbuf 1\n')
+    monkeypatch.chdir(tmp_path)
+    written = []
+    monkeypatch.setattr(fileio, '_command', lambda sock, command, *args: written.append(args))
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(fileio.DEFAULT_CHUNK_SIZE + 1))
+
+    class Connection(object):
+        sock = None
+
+    fileio.upload_file(Connection(), str(path))
+    assert [len(data) for _, data in written[1:-1]] == [fileio.DEFAULT_CHUNK_SIZE, 1]
+
+
+def test_upload_stays_below_maxinbuf(small_server, tmp_path):
+    data = os.urandom(300 * 1024)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(data)
+    conn = pyRserve.connect(port=small_server.port)
+    try:
+        fileio.upload_file(conn, str(path), chunk_size=fileio.chunk_size_for(64 * 1024))
+        with open(os.path.join(conn.eval('getwd()'), 'big.bin'), 'rb') as f:
+            assert f.read() == data
+    finally:
+        conn.close()
+
+
+def test_default_chunk_is_refused_by_small_maxinbuf(small_server, tmp_path):
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(300 * 1024))
+    conn = pyRserve.connect(port=small_server.port)
+    try:
+        with pytest.raises(Exception):
+            fileio.upload_file(conn, str(path))
+    finally:
+        conn.close()
+
+
+def test_pool_uploads_in_its_chunk_size(small_server, tmp_path, monkeypatch):
+    # stream through Rserve, as to a remote server
+    monkeypatch.setattr(fileio, 'is_local', lambda conn: False)
+    data = os.urandom(300 * 1024)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(data)
+    pool = RServeConnection(pool_size=1, realtime=True, port=small_server.port,
+                            upload_chunk_size=fileio.chunk_size_for(64 * 1024))
+    try:
+        pool.upload(str(path), unpack=False)
+        with open(os.path.join(pool.eval('getwd()'), 'big.bin'), 'rb') as f:
+            assert f.read() == data
+    finally:
+        pool.close()
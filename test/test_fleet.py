@@ -0,0 +1,124 @@
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+from rclient.fleet import FAKE_RSERVE_COMMAND, Preload, RserveFleet, read_config, write_config
+from rclient.registry import ModelBundle, ModelRegistry
+
+PYTHONPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def fleet():
+    with RserveFleet(daemons=2, base_port=16421, conf=None, command=FAKE_RSERVE_COMMAND, check_interval=.1,
+                     env={'PYTHONPATH': PYTHONPATH}) as fleet:
+        yield fleet
+
+
+def test_fleet_serves_on_consecutive_ports(fleet):
+    assert fleet.endpoints() == [('localhost', 16421), ('localhost', 16422)]
+    pool = fleet.pool(pool_size=1)
+    try:
+        assert pool.eval('1 + 1') == 2
+    finally:
+        pool.close()
+
+
+def test_dead_daemon_is_restarted(fleet):
+    daemon = fleet.daemons[0]
+    pid = daemon.pid
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not (daemon.restarts and daemon.ready() and daemon.pid not in (None, pid)):
+        assert time.monotonic() < deadline, "not restarted"
+        time.sleep(.05)
+    assert [s['alive'] for s in fleet.status()] == [True, True]
+
+
+def test_daemons_are_stopped_when_the_fleet_does_not_start(tmp_path):
+    # a "daemon" that never listens
+    fleet = RserveFleet(daemons=2, base_port=16427, conf=None, run_dir=str(tmp_path), start_timeout=.5,
+                        command=[sys.executable, '-c', 'import time; time.sleep(60)'])
+    with pytest.raises(TimeoutError):
+        with fleet:
+            pass
+    assert [d.alive() for d in fleet.daemons] == [False, False]
+    assert all(d._process.returncode is not None for d in fleet.daemons)
+
+
+def test_started_daemons_are_stopped_when_one_fails_to_start(tmp_path, monkeypatch):
+    fleet = RserveFleet(daemons=2, base_port=16429, conf=None, run_dir=str(tmp_path), command=FAKE_RSERVE_COMMAND,
+                        env={'PYTHONPATH': PYTHONPATH})
+    monkeypatch.setattr(fleet.daemons[1], 'start', lambda: os.path.getsize(str(tmp_path / 'missing')))
+    with pytest.raises(OSError):
+        fleet.start()
+    started = fleet.daemons[0]
+    assert not started.alive()
+    assert started._process.returncode is not None
+    assert started.pid is None
+
+
+def test_config_round_trip(tmp_path):
+    path = str(tmp_path / 'rserve.conf')
+    write_config(path, None, (('source', '/models/a.R'),), port=6400, workdir='/tmp/w', socket=None)
+    settings = read_config(path)
+    assert ('port', '6400') in settings
+    assert ('source', '/models/a.R') in settings
+    assert not any(key == 'socket' for key, _ in settings)
+
+
+def test_preload_config_lines(tmp_path):
+    preload = Preload(packages=['tm', 'Matrix'], scripts=['model.R', '/abs/helpers.R'],
+                      expressions='options(digits = 4)')
+    assert preload.relative_to('/bundles/m/1').config() == [
+        ('eval', 'library("tm")'),
+        ('eval', 'library("Matrix")'),
+        ('source', '/bundles/m/1/model.R'),
+        ('source', '/abs/helpers.R'),
+        ('eval', 'options(digits = 4)'),
+    ]
+    assert not Preload()
+    with pytest.raises(ValueError):
+        Preload(expressions='f <- function()\n 1').config()
+
+
+def test_preload_goes_in_every_daemon_config(tmp_path):
+    script = tmp_path / 'model.R'
+    script.write_text('answer <- 42\n')
+    preload = Preload(packages='tm', scripts=[str(script)], expressions='scale <- 2')
+    with RserveFleet(daemons=2, base_port=16423, conf=None, command=FAKE_RSERVE_COMMAND, preload=preload,
+                     env={'PYTHONPATH': PYTHONPATH}) as fleet:
+        for daemon in fleet.daemons:
+            settings = read_config(daemon.conf)
+            assert settings[-3:] == [('eval', 'library("tm")'), ('source', str(script)), ('eval', 'scale <- 2')]
+            assert ('port', str(daemon.port)) in settings
+        pool = fleet.pool(pool_size=1)
+        try:
+            # every session starts with the preload done
+            assert pool.eval('answer * scale') == 84
+        finally:
+            pool.close()
+
+
+def test_registry_starts_a_fleet_with_the_bundle_preload(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    (source / 'model.R').write_text('answer <- 42\n')
+    registry = ModelRegistry(stage_dir=str(tmp_path / 'models'), pool_size=1, realtime=True,
+                             fleet=dict(daemons=1, base_port=16425, conf=None, command=FAKE_RSERVE_COMMAND,
+                                        env={'PYTHONPATH': PYTHONPATH}))
+    try:
+        registry.register(ModelBundle('m', '1', files=[str(source / 'model.R')],
+                                      preload=Preload(scripts=['model.R'])))
+        fleet = registry.fleet('m')
+        [daemon] = fleet.daemons
+        bundle_dir = registry.eval('m', 'getOption("rclient.bundle")')
+        assert ('source', str(tmp_path / 'models' / 'm' / '1' / 'model.R')) in read_config(daemon.conf)
+        assert bundle_dir == str(tmp_path / 'models' / 'm' / '1')
+        assert registry.eval('m', 'answer') == 42
+    finally:
+        registry.unregister('m', '1')
+    assert not fleet.daemons[0].alive()
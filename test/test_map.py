@@ -0,0 +1,79 @@
+import itertools
+
+import pytest
+from pyRserve.rexceptions import REvalError
+
+from rclient.connector import RServeConnection
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=2, max_size=2, realtime=True, port=server.port)
+    yield pool
+    pool.close()
+
+
+def test_map_keeps_input_order(pool):
+    assert pool.map('{} * 2', range(20), chunksize=3) == [i * 2 for i in range(20)]
+    assert pool.map(lambda i: '{} + 1'.format(i), range(5)) == [1, 2, 3, 4, 5]
+
+
+def test_starmap(pool):
+    assert pool.starmap('{} * {}', [(1, 2), (3, 4)]) == [2, 12]
+
+
+def test_unordered_imap_yields_the_fast_chunk_first(pool):
+    results = list(pool.imap(lambda delay: 'Sys.sleep({0}); {0}'.format(delay), [.3, 0], workers=2))
+    assert results == [0, .3]
+    ordered = list(pool.imap(lambda delay: 'Sys.sleep({0}); {0}'.format(delay), [.3, 0], ordered=True, workers=2))
+    assert ordered == [.3, 0]
+
+
+def test_chunks_are_sent_as_batches(pool, monkeypatch):
+    batches = []
+    eval_many = pool.eval_many
+
+    def recording(expressions, *args):
+        batches.append(len(expressions))
+        return eval_many(expressions, *args)
+    monkeypatch.setattr(pool, 'eval_many', recording)
+    assert pool.map('{}', range(10), chunksize=4) == list(range(10))
+    assert sorted(batches) == [2, 4, 4]
+
+
+def test_error_is_raised_where_its_result_would_be(pool):
+    expressions = ['1', '2', 'missing', '4', '5', '6']
+    results = pool.imap(lambda e: e, expressions, chunksize=2, ordered=True, workers=1)
+    assert next(results) == 1
+    assert next(results) == 2
+    with pytest.raises(REvalError, match='not found'):
+        next(results)
+
+    # within a chunk too: the results before the failing expression are yielded
+    results = pool.imap(lambda e: e, expressions, chunksize=4, ordered=True, workers=1)
+    assert [next(results), next(results)] == [1, 2]
+    with pytest.raises(REvalError):
+        next(results)
+
+    with pytest.raises(REvalError):
+        pool.map(lambda e: e, expressions)
+    assert pool.eval('1 + 1') == 2
+
+
+def test_input_is_read_lazily(pool):
+    pulled = itertools.count()
+
+    def items():
+        for i in range(1000):
+            next(pulled)
+            yield i
+    results = pool.imap('{}', items(), chunksize=5, ordered=True, workers=2)
+    assert next(results) == 0
+    # at most 2 * workers chunks in flight
+    assert next(pulled) <= 2 * 2 * 5 + 1
+    results.close()
+
+
+def test_chunksize_must_be_positive(pool):
+    with pytest.raises(ValueError):
+        pool.map('{}', range(3), chunksize=0)
@@ -0,0 +1,51 @@
+from tornado.ioloop import IOLoop
+
+from rclient.connector import RServeConnection
+from rclient.metrics import MetricsRegistry
+from rclient.threadpool import RPool
+from rclient.tornado_executor import RPoolTornado
+
+
+def _pools(registry):
+    return {labels['pool'] for family in registry.snapshot().values() for labels, _ in family['samples']}
+
+
+def test_pool_metrics_are_removed_on_close(server):
+    registry = MetricsRegistry()
+    pool = RServeConnection(pool_size=1, realtime=True, name='p', metrics=registry, port=server.port)
+    pool.eval('TRUE')
+    assert _pools(registry) == {'p'}
+    pool.close()
+    assert _pools(registry) == set()
+
+
+def test_threadpool_metrics_are_removed_on_stop(default_port_server):
+    registry = MetricsRegistry()
+    pool = RPool(workers=1, support_files=[], name='t', metrics=registry)
+    pool.start()
+    assert pool.submit('caller', 'TRUE').result(5) is True
+    assert _pools(registry) == {'t'}
+    pool.stop()
+    assert _pools(registry) == set()
+
+
+def test_newer_threadpool_keeps_its_metrics(default_port_server):
+    registry = MetricsRegistry()
+    old = RPool(workers=1, support_files=[], name='t', metrics=registry)
+    new = RPool(workers=1, support_files=[], name='t', metrics=registry)
+    old.stop()
+    assert _pools(registry) == {'t'}
+    new.stop()
+    assert _pools(registry) == set()
+
+
+def test_tornado_metrics_are_removed_on_shutdown(server):
+    registry = MetricsRegistry()
+    pool = RPoolTornado(max_workers=1, name='r', metrics=registry, port=server.port)
+    loop = IOLoop(make_current=False)
+    try:
+        loop.run_sync(lambda: pool.r_eval('TRUE', cached=False), timeout=10)
+    finally:
+        loop.close()
+    pool.shutdown()
+    assert _pools(registry) == set()
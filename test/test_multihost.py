@@ -0,0 +1,89 @@
+import gc
+import time
+
+import pytest
+
+from rclient.fake_rserve import FakeRserve
+from rclient.multihost import BALANCE_LATENCY, MultiHostPool
+
+
+@pytest.fixture
+def servers():
+    servers = [FakeRserve().start() for _ in range(2)]
+    yield servers
+    for s in servers:
+        s.stop()
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(.02)
+
+
+def _checkouts(e):
+    return e.pool._m_checkouts.value
+
+
+def test_spreads_evaluations(servers):
+    pool = MultiHostPool([('localhost', s.port) for s in servers], pool_size=1, realtime=True)
+    try:
+        _wait_for(lambda: all(e.pool.idle for e in pool.endpoints))
+        for _ in range(10):
+            assert pool.eval('1 + 1', cached=False) == 2
+        assert [_checkouts(e) for e in pool.endpoints] == [5, 5]
+    finally:
+        pool.close()
+
+
+def test_failing_endpoint_is_ejected_and_probed_back(servers):
+    pool = MultiHostPool([('localhost', s.port) for s in servers], pool_size=1, realtime=True, eject_after=3,
+                         eject_for=.2, probe_interval=.05)
+    try:
+        _wait_for(lambda: all(e.pool.idle for e in pool.endpoints))
+        down, up = pool.endpoints
+        port = servers[0].port
+        servers[0].stop()
+
+        # idempotent evaluations fail over to the other endpoint
+        while down.healthy:
+            assert pool.eval('1 + 1', cached=False) == 2
+        assert down.failures == 3
+        before = _checkouts(down)
+        for _ in range(5):
+            assert pool.eval('1 + 1', cached=False) == 2
+        assert _checkouts(down) == before
+
+        servers[0] = FakeRserve(port=port).start()
+        _wait_for(lambda: down.healthy)
+        assert down.failures == 0
+        assert down.latency is not None
+    finally:
+        pool.close()
+
+
+def test_latency_balancing_prefers_the_fast_endpoint():
+    with FakeRserve(delay=.05) as slow, FakeRserve() as fast:
+        pool = MultiHostPool([('localhost', slow.port), ('localhost', fast.port)], balance=BALANCE_LATENCY,
+                             pool_size=1, realtime=True, probe_interval=.05)
+        try:
+            slow_endpoint, fast_endpoint = pool.endpoints
+            _wait_for(lambda: slow_endpoint.latency is not None and fast_endpoint.latency is not None)
+            # pings only: the latency doesn't include connecting, which takes pyRserve .2s
+            assert fast_endpoint.latency < .05 <= slow_endpoint.latency < .2
+            before = _checkouts(slow_endpoint)
+            for _ in range(10):
+                pool.eval('1', cached=False)
+            assert _checkouts(slow_endpoint) == before
+        finally:
+            pool.close()
+
+
+@pytest.mark.filterwarnings('error::pytest.PytestUnraisableExceptionWarning')
+@pytest.mark.parametrize('kwargs', [dict(balance='nope'), dict(endpoints=[]), dict(reset_strategy='nope')])
+def test_invalid_options(server, kwargs):
+    kwargs.setdefault('endpoints', [('localhost', server.port)])
+    with pytest.raises(ValueError):
+        MultiHostPool(**kwargs)
+    gc.collect()
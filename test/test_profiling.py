@@ -0,0 +1,102 @@
+import pytest
+from pyRserve.rexceptions import REvalError
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from rclient.connector import RServeConnection
+from rclient.metrics import MetricsRegistry
+from rclient.profiling import PHASES, Profiler, Trace
+from rclient.tornado_executor import RPoolTornado
+
+
+@pytest.fixture
+def traces():
+    return []
+
+
+@pytest.fixture
+def profiler(traces):
+    return Profiler(slow_after=.15, samples=2, hooks=[traces.append])
+
+
+@pytest.fixture
+def pool(slow_server, profiler):
+    pool = RServeConnection(pool_size=1, max_size=1, realtime=True, name='traced', profiler=profiler,
+                            port=slow_server.port)
+    yield pool
+    pool.close()
+
+
+def test_phases_of_an_eval(pool, traces):
+    assert pool.eval('numeric(1000)', cached=False).shape == (1000,)
+    [trace] = traces
+    assert (trace.expression, trace.pool, trace.error) == ('numeric(1000)', 'traced', None)
+    assert set(trace.phases) == set(PHASES)
+    # the fake server takes .05s before answering
+    assert trace.phases['compute'] >= .05
+    assert max(seconds for phase, seconds in trace.phases.items() if phase != 'compute') < .05
+    assert trace.total == pytest.approx(sum(trace.phases.values()))
+    assert trace.bytes_sent > len('numeric(1000)')
+    assert trace.bytes_received > 8000
+
+
+def test_errors_are_traced(pool, traces):
+    with pytest.raises(REvalError):
+        pool.eval('missing', cached=False)
+    assert 'REvalError' in traces[0].error
+
+
+def test_slow_calls_are_sampled(pool, profiler):
+    for delay in (.2, 0, .3, .25):
+        pool.eval('Sys.sleep({}); 1'.format(delay), cached=False)
+    summary = profiler.summary()
+    assert (summary['calls'], summary['slow_calls'], summary['dominant_phase']) == (4, 3, 'compute')
+    assert summary['slow_phases']['compute'] > summary['phases']['compute']
+    # the two slowest, slowest first
+    assert [t.expression for t in profiler.slow_calls()] == ['Sys.sleep(0.3); 1', 'Sys.sleep(0.25); 1']
+
+    profiler.reset()
+    assert profiler.summary()['calls'] == 0
+    assert profiler.slow_calls() == []
+
+
+def test_hooks(profiler, traces):
+    def failing(trace):
+        raise ValueError("broken hook")
+    profiler.add_hook(failing)
+    trace = Trace('1')
+    trace.mark('compute')
+    profiler.record(trace)
+    # a failing hook doesn't stop the others
+    assert traces == [trace]
+
+    profiler.remove_hook(failing)
+    profiler.remove_hook(traces.append)
+    profiler.record(Trace('2'))
+    assert traces == [trace]
+
+
+def test_phase_histograms():
+    registry = MetricsRegistry()
+    profiler = Profiler(metrics=registry)
+    trace = Trace('1', pool='p')
+    trace.mark('compute')
+    profiler.record(trace)
+    samples = registry.snapshot()['rclient_eval_phase_seconds']['samples']
+    assert {labels['phase'] for labels, _ in samples} == set(PHASES)
+    assert all(labels['pool'] == 'p' for labels, _ in samples)
+
+
+def test_tornado_queue_wait_is_traced(slow_server, profiler, traces):
+    pool = RPoolTornado(max_workers=1, profiler=profiler, port=slow_server.port)
+    loop = IOLoop(make_current=False)
+    try:
+        loop.run_sync(lambda: gen.multi([pool.r_eval('Sys.sleep(.1); 1'), pool.r_eval('2')]), timeout=10)
+    finally:
+        loop.close()
+        pool.shutdown()
+    first, second = sorted(traces, key=lambda t: t.phases['queue'])
+    # the second waited for the only thread while the first ran
+    assert first.phases['queue'] < .05
+    assert second.phases['queue'] >= .1
+    assert second.expression == '2'
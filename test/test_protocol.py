@@ -0,0 +1,78 @@
+import socket
+import threading
+
+import pytest
+from pyRserve import rtypes
+from pyRserve.rexceptions import EndOfDataError, REvalError
+from pyRserve.rparser import OOBMessage
+
+from rclient.protocol import HEADER, qap_string, r_string, read_answer, read_exactly, read_message
+
+
+@pytest.fixture
+def sockets():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def test_read_message_in_pieces(sockets):
+    a, b = sockets
+    message = HEADER.pack(rtypes.RESP_OK, 5, 0, 0) + b'hello'
+
+    def send():
+        for i in range(len(message)):
+            a.send(message[i:i + 1])
+    sender = threading.Thread(target=send)
+    sender.start()
+    assert read_message(b) == message
+    sender.join()
+
+
+def test_read_exactly_raises_at_end_of_data(sockets):
+    a, b = sockets
+    a.sendall(b'abc')
+    a.close()
+    with pytest.raises(EndOfDataError):
+        read_exactly(b, 4)
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.oob = []
+        self.responses = []
+
+    def oobCallback(self, data, code):
+        self.oob.append((data, code))
+        return data * 2
+
+    def _rrespond(self, answer):
+        self.responses.append(answer)
+
+    def eval(self, expression):
+        assert expression == 'geterrmessage()'
+        return 'Error: boom\n'
+
+
+def test_read_answer_hands_out_of_band_messages_over():
+    conn = _Connection()
+    messages = iter([OOBMessage(rtypes.OOB_SEND, 1, 'sent'), OOBMessage(rtypes.OOB_MSG, 2, 'asked'), 42])
+    assert read_answer(conn, lambda: next(messages)) == 42
+    assert conn.oob == [('sent', 1), ('asked', 2)]
+    # only OOB_MSG waits for an answer
+    assert conn.responses == ['askedasked']
+
+
+def test_read_answer_raises_r_errors_with_their_message():
+    def read():
+        raise REvalError()
+    with pytest.raises(REvalError, match='Error: boom'):
+        read_answer(_Connection(), read)
+
+
+def test_strings():
+    assert qap_string('dim') == b'dim\0'
+    assert qap_string('ab') == b'ab\0\0'
+    assert r_string('a "b" \\c') == '"a \\"b\\" \\\\c"'
@@ -0,0 +1,39 @@
+import pytest
+
+from rclient.registry import BundleChanged, ModelBundle, ModelRegistry
+
+
+@pytest.fixture
+def model(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    (source / 'model.R').write_text('answer <- 42\n')
+    return source / 'model.R'
+
+
+def test_stage_is_reused_for_the_same_content(model, tmp_path):
+    stage_dir = str(tmp_path / 'models')
+    first = ModelBundle('m', '1', files=[str(model)]).stage(stage_dir)
+    assert ModelBundle('m', '1', files=[str(model)]).stage(stage_dir) == first
+
+
+def test_changed_content_is_refused(model, tmp_path):
+    stage_dir = str(tmp_path / 'models')
+    ModelBundle('m', '1', files=[str(model)]).stage(stage_dir)
+    model.write_text('answer <- 43\n')
+    with pytest.raises(BundleChanged):
+        ModelBundle('m', '1', files=[str(model)]).stage(stage_dir)
+    ModelBundle('m', '2', files=[str(model)]).stage(stage_dir)
+
+
+def test_registry_serves_each_version(server, model, tmp_path):
+    registry = ModelRegistry(stage_dir=str(tmp_path / 'models'), pool_size=1, realtime=True, port=server.port)
+    try:
+        registry.register(ModelBundle('m', '1', files=[str(model)], initializer='model.R'))
+        registry.register(ModelBundle('m', '2', files=[str(model)]))
+        assert registry.eval('m', 'answer', version='1') == 42
+        assert registry.eval('m', 'getOption("rclient.bundle")').endswith('2')
+        assert registry.eval('m', 'getOption("rclient.bundle")', version='1').endswith('1')
+    finally:
+        for version in ('1', '2'):
+            registry.unregister('m', version)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from rclient.connector import CONNECTION_ERRORS, RServeConnection
+
+
+def _pool(server, **kwargs):
+    kwargs.setdefault('validate_after', None)
+    return RServeConnection(pool_size=1, max_size=1, realtime=True, port=server.port, **kwargs)
+
+
+def _count_checkouts(pool, monkeypatch):
+    checkouts = []
+    checkout = pool._checkout
+
+    def counting(*args, **kwargs):
+        checkouts.append(1)
+        return checkout(*args, **kwargs)
+    monkeypatch.setattr(pool, '_checkout', counting)
+    return checkouts
+
+
+def test_dropped_idle_connection_is_retried(server):
+    pool = _pool(server)
+    try:
+        server.drop_connections()
+        assert pool.eval('1 + 1', cached=False) == 2
+        assert pool.size == 1
+    finally:
+        pool.close()
+
+
+def test_connection_dropped_mid_request_is_retried(server):
+    pool = _pool(server)
+    try:
+        threading.Timer(.2, server.drop_connections).start()
+        assert pool.eval('Sys.sleep(.5); 1', cached=False) == 1
+    finally:
+        pool.close()
+
+
+def test_non_idempotent_eval_is_not_retried(server, monkeypatch):
+    pool = _pool(server)
+    try:
+        checkouts = _count_checkouts(pool, monkeypatch)
+        server.drop_connections()
+        with pytest.raises(CONNECTION_ERRORS):
+            pool.eval('1 + 1', idempotent=False)
+        assert len(checkouts) == 1
+        # the broken connection was discarded
+        assert pool.eval('1 + 1', idempotent=False) == 2
+    finally:
+        pool.close()
+
+
+def test_gives_up_after_the_configured_retries(server, monkeypatch):
+    pool = _pool(server, retries=2)
+    try:
+        checkouts = _count_checkouts(pool, monkeypatch)
+        server.stop()
+        start = time.monotonic()
+        with pytest.raises(CONNECTION_ERRORS):
+            pool.eval('1 + 1', cached=False)
+        assert len(checkouts) == 3
+        # backing off .1s, then .2s
+        assert time.monotonic() - start >= .3
+        assert pool.size == 0
+    finally:
+        pool.close()
+
+
+def test_stale_connection_is_validated_on_checkout(server):
+    pool = _pool(server, validate_after=0, retries=0)
+    try:
+        broken = pool.pool[0]
+        server.drop_connections()
+        # no retries: the ping on checkout replaces the broken connection before the eval is sent
+        with pool.connect() as c:
+            assert c.connection is not broken
+            assert c.eval('1 + 1') == 2
+    finally:
+        pool.close()
+
+
+def test_without_validation_a_dropped_connection_is_handed_out(server):
+    pool = _pool(server, retries=0)
+    try:
+        server.drop_connections()
+        with pytest.raises(CONNECTION_ERRORS):
+            pool.eval('1 + 1', cached=False)
+    finally:
+        pool.close()
+
+
+def test_recently_seen_connection_is_not_pinged(server, monkeypatch):
+    pool = _pool(server, validate_after=60)
+    try:
+        pings = []
+        monkeypatch.setattr(type(pool.pool[0]), 'ping', lambda c: pings.append(c) or True)
+        pool.eval('1', cached=False)
+        assert pings == []
+    finally:
+        pool.close()
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from rclient.scheduling import FairQueue, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+
+
+def _drain(jobs):
+    items = []
+    while jobs.qsize():
+        items.append(jobs.get_nowait())
+        jobs.task_done()
+    return items
+
+
+def test_urgent_priority_is_served_first():
+    jobs = FairQueue()
+    jobs.put('a', 'batch', priority=PRIORITY_BATCH)
+    jobs.put('a', 'normal')
+    jobs.put('b', 'interactive', priority=PRIORITY_INTERACTIVE)
+    assert _drain(jobs) == ['interactive', 'normal', 'batch']
+
+
+def test_callers_take_turns():
+    jobs = FairQueue()
+    for i in range(4):
+        jobs.put('bulk', ('bulk', i))
+    jobs.put('other', ('other', 0))
+    jobs.put('other', ('other', 1))
+    # the bulk caller's backlog doesn't hold the other caller up
+    assert _drain(jobs) == [('bulk', 0), ('other', 0), ('bulk', 1), ('other', 1), ('bulk', 2), ('bulk', 3)]
+
+
+def test_weights_share_in_proportion():
+    jobs = FairQueue()
+    jobs.set_weight('heavy', 3)
+    for i in range(12):
+        jobs.put('heavy', 'heavy')
+        jobs.put('light', 'light')
+    first = _drain(jobs)[:8]
+    assert first.count('heavy') == 6
+    assert first.count('light') == 2
+
+
+def test_caller_starting_late_does_not_catch_up():
+    jobs = FairQueue()
+    for _ in range(3):
+        jobs.put('early', 'early')
+    for _ in range(3):
+        jobs.get_nowait()
+        jobs.task_done()
+    # an idle caller keeps no credit from before: both start from the current virtual time
+    for _ in range(2):
+        jobs.put('early', 'early')
+        jobs.put('late', 'late')
+    assert _drain(jobs) == ['early', 'late', 'early', 'late']
+
+
+def test_bounds():
+    jobs = FairQueue(maxsize=3, max_per_caller=2)
+    jobs.put('a', 1)
+    jobs.put('a', 2)
+    with pytest.raises(queue.Full):
+        jobs.put('a', 3, block=False)
+    jobs.put('b', 1)
+    with pytest.raises(queue.Full):
+        jobs.put('c', 1, timeout=.01)
+    assert (jobs.qsize(), jobs.waiting('a'), jobs.waiting('b')) == (3, 2, 1)
+
+    threading.Timer(.05, jobs.get).start()
+    jobs.put('c', 1, timeout=5)
+    assert jobs.waiting('c') == 1
+
+
+def test_set_weight_must_be_positive():
+    with pytest.raises(ValueError):
+        FairQueue().set_weight('a', 0)
+
+
+def test_get_times_out_and_returns_none_once_closed():
+    jobs = FairQueue()
+    with pytest.raises(queue.Empty):
+        jobs.get(timeout=.01)
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(jobs.get()))
+    waiter.start()
+    time.sleep(.05)
+    jobs.close()
+    waiter.join(5)
+    assert got == [None]
+
+
+def test_join_waits_for_task_done():
+    jobs = FairQueue()
+    jobs.put('a', 1)
+    jobs.get()
+    threading.Timer(.05, jobs.task_done).start()
+    start = time.monotonic()
+    jobs.join()
+    assert time.monotonic() - start >= .04
+    with pytest.raises(ValueError):
+        jobs.task_done()
@@ -0,0 +1,123 @@
+import errno
+import os
+import shutil
+import stat
+import tarfile
+
+import pytest
+
+from rclient import staging
+from rclient.staging import StagingCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return StagingCache(str(tmp_path / 'store'))
+
+
+@pytest.fixture
+def archive(tmp_path):
+    source = tmp_path / 'bundle'
+    (source / 'R').mkdir(parents=True)
+    (source / 'R' / 'model.R').write_text('f <- function(x) x')
+    (source / 'weights.csv').write_text('1,2,3')
+    path = tmp_path / 'bundle.tar.gz'
+    with tarfile.open(str(path), 'w:gz') as tar:
+        for name in ('R', 'weights.csv'):
+            tar.add(str(source / name), arcname=name)
+    return str(path)
+
+
+def _connection_dirs(tmp_path, n):
+    dirs = [tmp_path / 'conn{}'.format(i) for i in range(n)]
+    for d in dirs:
+        d.mkdir()
+    return [str(d) for d in dirs]
+
+
+def test_archive_is_extracted_once_for_every_connection(cache, archive, tmp_path, monkeypatch):
+    extractions = []
+    unpack_archive = shutil.unpack_archive
+    monkeypatch.setattr(shutil, 'unpack_archive', lambda *args: extractions.append(args) or unpack_archive(*args))
+
+    dirs = _connection_dirs(tmp_path, 3)
+    for d in dirs:
+        assert cache.link_into(archive, d, unpack=True)
+    assert len(extractions) == 1
+
+    inodes = {os.stat(os.path.join(d, 'R', 'model.R')).st_ino for d in dirs}
+    assert len(inodes) == 1
+    with open(os.path.join(dirs[2], 'weights.csv')) as f:
+        assert f.read() == '1,2,3'
+
+
+def test_file_is_linked_under_its_own_name(cache, tmp_path):
+    path = tmp_path / 'WordCount.R'
+    path.write_text('count <- 1')
+    [d] = _connection_dirs(tmp_path, 1)
+    cache.link_into(str(path), d)
+    linked = os.path.join(d, 'WordCount.R')
+    assert os.stat(linked).st_ino == os.stat(os.path.join(cache.stage(str(path)), staging.BLOB)).st_ino
+
+
+def test_unchanged_content_is_skipped(cache, archive, tmp_path):
+    path = tmp_path / 'WordCount.R'
+    path.write_text('count <- 1')
+    [d] = _connection_dirs(tmp_path, 1)
+    assert cache.link_into(str(path), d)
+    assert not cache.link_into(str(path), d)
+    assert cache.link_into(archive, d, unpack=True)
+    assert not cache.link_into(archive, d, unpack=True)
+
+    # changed content, or a link that has gone, is linked again
+    path.write_text('count <- 2')
+    assert cache.link_into(str(path), d)
+    os.remove(os.path.join(d, 'WordCount.R'))
+    assert cache.link_into(str(path), d)
+    with open(os.path.join(d, 'WordCount.R')) as f:
+        assert f.read() == 'count <- 2'
+
+    cache.forget(d)
+    assert cache.link_into(str(path), d)
+
+
+def test_identical_content_is_stored_once(cache, tmp_path):
+    first, second = tmp_path / 'a.R', tmp_path / 'b.R'
+    first.write_text('x <- 1')
+    second.write_text('x <- 1')
+    assert cache.stage(str(first)) == cache.stage(str(second))
+
+
+def test_symlink_fallback_across_filesystems(cache, tmp_path, monkeypatch):
+    def cross_device(source, target):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', cross_device)
+
+    path = tmp_path / 'WordCount.R'
+    path.write_text('count <- 1')
+    [d] = _connection_dirs(tmp_path, 1)
+    cache.link_into(str(path), d)
+    linked = os.path.join(d, 'WordCount.R')
+    assert os.path.islink(linked)
+    assert os.readlink(linked) == os.path.join(cache.stage(str(path)), staging.BLOB)
+    with open(linked) as f:
+        assert f.read() == 'count <- 1'
+
+
+def test_other_link_errors_are_raised(cache, tmp_path, monkeypatch):
+    def denied(source, target):
+        raise OSError(errno.EACCES, 'Permission denied')
+    monkeypatch.setattr(os, 'link', denied)
+    path = tmp_path / 'WordCount.R'
+    path.write_text('count <- 1')
+    [d] = _connection_dirs(tmp_path, 1)
+    with pytest.raises(PermissionError):
+        cache.link_into(str(path), d)
+
+
+def test_store_is_read_only(cache, archive):
+    entry = cache.stage(archive, unpack=True)
+    for root, dirs, files in os.walk(entry):
+        assert stat.S_IMODE(os.stat(root).st_mode) == 0o555
+        for f in files:
+            assert stat.S_IMODE(os.stat(os.path.join(root, f)).st_mode) == 0o444
@@ -0,0 +1,47 @@
+import numpy
+import pytest
+from pyRserve.rexceptions import REvalError
+
+from rclient.connector import RServeConnection
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=1, max_size=1, realtime=True, port=server.port)
+    yield pool
+    pool.close()
+
+
+@pytest.mark.parametrize('as_arrays', [False, True])
+def test_stream_in_slices(pool, as_arrays):
+    slices = list(pool.stream('seq_len(25)', chunk_size=10, as_arrays=as_arrays))
+    assert [len(s) for s in slices] == [10, 10, 5]
+    assert numpy.concatenate(slices).tolist() == list(range(1, 26))
+    if as_arrays:
+        assert all(isinstance(s, numpy.ndarray) for s in slices)
+
+
+def test_stream_of_one_slice(pool):
+    assert [list(s) for s in pool.stream('seq_len(3)', chunk_size=10)] == [[1, 2, 3]]
+
+
+def test_closing_early_leaves_the_connection_in_step(pool):
+    stream = pool.stream('seq_len(100)', chunk_size=10)
+    assert list(next(stream)) == list(range(1, 11))
+    # the second slice is already on its way. closing reads it and cleans up the R session.
+    stream.close()
+    with pool.connect() as c:
+        assert c.eval('1 + 1') == 2
+        with pytest.raises(REvalError):
+            c.eval('.rclient_stream')
+
+
+def test_error_in_expression(pool):
+    with pytest.raises(REvalError, match='not found'):
+        list(pool.stream('missing', chunk_size=10))
+    assert pool.eval('1 + 1') == 2
+
+
+def test_chunk_size_must_be_positive(pool):
+    with pytest.raises(ValueError):
+        list(pool.stream('seq_len(3)', chunk_size=0))
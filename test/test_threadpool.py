@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+from pyRserve.rconn import RSERVEPORT
+from pyRserve.rexceptions import REvalError
+
+from rclient.connector import CONNECTION_ERRORS, EvalTimeout
+from rclient.fake_rserve import FakeRserve
+from rclient.scheduling import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from rclient.threadpool import RPool
+
+
+@pytest.fixture
+def errors_in_threads(monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    return errors
+
+
+def test_stop_after_timeout(default_port_server, errors_in_threads):
+    pool = RPool(workers=1, eval_timeout=.3, support_files=[])
+    pool.start()
+    with pytest.raises(EvalTimeout):
+        pool.submit('caller', 'Sys.sleep(5)').result(5)
+    pool.stop()
+    assert not errors_in_threads
+
+
+@pytest.fixture
+def pool(default_port_server):
+    pool = RPool(workers=1, support_files=[])
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+def test_jobs(pool):
+    futures = [pool.submit('caller', '{} + 1'.format(i)) for i in range(10)]
+    assert [f.result(5) for f in futures] == [i + 1 for i in range(10)]
+
+
+def test_jobs_run_by_priority_then_fair_share(pool):
+    blocker = pool.submit('caller', 'Sys.sleep(.3)')
+    order = []
+    futures = [pool.submit('bulk', '1', priority=PRIORITY_BATCH),
+               pool.submit('bulk', '2'),
+               pool.submit('bulk', '3'),
+               pool.submit('other', '4'),
+               pool.submit('urgent', '5', priority=PRIORITY_INTERACTIVE)]
+    for f in futures:
+        f.add_done_callback(lambda f: order.append(f.result()))
+    blocker.result(5)
+    for f in futures:
+        f.result(5)
+    assert order == [5, 2, 4, 3, 1]
+
+
+def test_cancelled_job_is_skipped(pool):
+    blocker = pool.submit('caller', 'Sys.sleep(.3)')
+    skipped = pool.submit('caller', 'x <- 1')
+    assert skipped.cancel()
+    blocker.result(5)
+    # the worker's session lives on between jobs, so x would be there had the job run
+    assert pool.submit('caller', 'y <- 2').result(5) == 2
+    assert pool.submit('caller', 'y').result(5) == 2
+    with pytest.raises(REvalError):
+        pool.submit('caller', 'x').result(5)
+
+
+def test_connection_failure_is_not_retried(pool, default_port_server):
+    threading.Timer(.3, default_port_server.drop_connections).start()
+    with pytest.raises(CONNECTION_ERRORS):
+        pool.submit('caller', 'Sys.sleep(1); 1').result(5)
+    assert pool.submit('caller', '1 + 1').result(5) == 2
+
+
+def test_idempotent_job_is_retried(pool, default_port_server):
+    threading.Timer(.3, default_port_server.drop_connections).start()
+    assert pool.submit('caller', 'Sys.sleep(1); 1', idempotent=True).result(5) == 1
+
+
+def test_worker_survives_failed_reconnect(pool, default_port_server):
+    assert pool.submit('caller', '1').result(5) == 1
+    default_port_server.stop()
+    with pytest.raises(CONNECTION_ERRORS):
+        pool.submit('caller', '2').result(5)
+    with FakeRserve(port=RSERVEPORT):
+        assert pool.submit('caller', '3').result(5) == 3
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from rclient.connector import EvalTimeout, RServeConnection
+
+
+@pytest.fixture
+def pool(server):
+    pool = RServeConnection(pool_size=1, max_size=2, realtime=True, eval_timeout=.3, port=server.port)
+    yield pool
+    pool.close()
+
+
+def test_runaway_eval_is_killed(pool):
+    start = time.monotonic()
+    with pytest.raises(EvalTimeout):
+        pool.eval('Sys.sleep(5)', cached=False)
+    assert time.monotonic() - start < 2
+    assert pool.eval('1 + 1', cached=False) == 2
+
+
+def test_timeout_per_call(server):
+    pool = RServeConnection(pool_size=1, realtime=True, port=server.port)
+    try:
+        assert pool.eval('Sys.sleep(.1); 1', timeout=1) == 1
+        with pytest.raises(EvalTimeout):
+            pool.eval('Sys.sleep(5)', timeout=.2)
+    finally:
+        pool.close()
+
+
+def test_pid_is_fetched_on_connect(server):
+    pool = RServeConnection(pool_size=1, max_size=1, realtime=True, port=server.port)
+    try:
+        with pool.connect() as c:
+            assert c.pid == c.eval('Sys.getpid()')
+    finally:
+        pool.close()
+
+
+def test_terminate_kills_the_r_process(pool, server):
+    c = pool.connect()
+    conn = c.connection
+    pool.terminate(c)
+    assert conn.isClosed
+    assert pool.eval('1 + 1', cached=False) == 2
+
+
+def test_terminate_without_a_timeout_aborts_the_evaluation(server, monkeypatch):
+    killed = []
+    kill = server.kill
+    monkeypatch.setattr(server, 'kill', lambda pid: killed.append(pid) or kill(pid))
+    pool = RServeConnection(pool_size=1, max_size=2, realtime=True, port=server.port)
+    try:
+        c = pool.connect()
+        pid = c.pid
+        runaway = threading.Thread(target=lambda: _ignore_errors(c.eval, 'Sys.sleep(30)'))
+        runaway.start()
+        time.sleep(.2)
+        pool.terminate(c)
+        runaway.join(5)
+        assert not runaway.is_alive()
+        assert killed == [pid]
+        assert pool.eval('1 + 1', cached=False) == 2
+    finally:
+        pool.close()
+
+
+def _ignore_errors(function, *args):
+    try:
+        function(*args)
+    except Exception:
+        pass
@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from rclient.cache import ResultCache
+from rclient.connector import CONNECTION_ERRORS
+from rclient.fake_rserve import FakeRserve
+from rclient.tornado_executor import RPoolTornado
+
+
+def run(make_future):
+    loop = IOLoop(make_current=False)
+    try:
+        return loop.run_sync(make_future, timeout=10)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def pool(server):
+    pool = RPoolTornado(max_workers=2, port=server.port)
+    yield pool
+    pool.shutdown()
+
+
+def test_r_eval(pool):
+    async def evaluate():
+        return await gen.multi([pool.r_eval('{} * 2'.format(i)) for i in range(10)])
+    assert run(evaluate) == [i * 2 for i in range(10)]
+
+
+def test_connection_failure_is_not_retried(pool, server):
+    threading.Timer(.3, server.drop_connections).start()
+    with pytest.raises(CONNECTION_ERRORS):
+        run(lambda: pool.r_eval('Sys.sleep(1); 1'))
+    assert run(lambda: pool.r_eval('1 + 1')) == 2
+
+
+def test_idempotent_eval_is_retried(pool, server):
+    threading.Timer(.3, server.drop_connections).start()
+    assert run(lambda: pool.r_eval('Sys.sleep(1); 1', idempotent=True)) == 1
+
+
+def test_thread_survives_failed_reconnect(server):
+    pool = RPoolTornado(max_workers=1, port=server.port)
+    try:
+        assert run(lambda: pool.r_eval('1')) == 1
+        server.stop()
+        with pytest.raises(CONNECTION_ERRORS):
+            run(lambda: pool.r_eval('2'))
+        with FakeRserve(port=server.port):
+            assert run(lambda: pool.r_eval('3')) == 3
+    finally:
+        pool.shutdown()
+
+
+def test_cached_results(server):
+    pool = RPoolTornado(max_workers=1, cache=ResultCache(), port=server.port)
+    try:
+        value = run(lambda: pool.r_eval('rnorm(1)'))
+        assert run(lambda: pool.r_eval('rnorm(1)')) == value
+        assert run(lambda: pool.r_eval('rnorm(1)', cached=False)) != value
+        pool.prepare('double_it', 'function(x) x * 2')
+        assert run(lambda: pool.r_eval('rnorm(1)')) != value
+    finally:
+        pool.shutdown()